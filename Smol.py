@@ -1,10 +1,18 @@
 import streamlit as st
-from transformers import Qwen2VLForConditionalGeneration, AutoProcessor
-from qwen_vl_utils import process_vision_info
-from PIL import Image
-import torch
+import os
+from cache import VerdictCache, image_key
+from backend import AnalysisBackend
+from ui import render_jobs, render_debug_panel, submit_job
+from jobs import JobManager
+from result_store import ResultStore, model_id
+from server_client import InferenceClient
+from scheduler import InferenceScheduler
+from registry import ModelRegistry, MODEL_SPECS
+from preprocess import preprocess_image, RESOLUTION_TIERS
+from quantize import available_precisions
+from speculative import tokenizers_compatible, DEFAULT_DRAFT_TOKENS
+from router import CascadeRouter, RoutingPolicy
 from prompts import (
-    FOOD_VALIDATION_PROMPT,
     INGREDIENTS_SYSTEM_PROMPT,
     RECIPE_SYSTEM_PROMPT,
     NUTRITION_SYSTEM_PROMPT,
@@ -16,11 +24,7 @@ st.markdown("*Upload a food image and choose your analysis type*")
 
 # Sidebar for model selection
 st.sidebar.title("🤖 Model Configuration")
-model_options = {
-    "Qwen2-VL-7B-Instruct": "Qwen/Qwen2-VL-7B-Instruct",
-    "SmolVLM-256M-Instruct": "HuggingFaceTB/SmolVLM-256M-Instruct",
-    "SmolVLM2-2.2B-Instruct": "HuggingFaceTB/SmolVLM2-2.2B-Instruct"
-}
+model_options = {name: spec.path for name, spec in MODEL_SPECS.items()}
 
 selected_model_name = st.sidebar.selectbox(
     "Select Vision-Language Model:",
@@ -30,104 +34,167 @@ selected_model_name = st.sidebar.selectbox(
 )
 
 selected_model_path = model_options[selected_model_name]
+selected_spec = MODEL_SPECS[selected_model_name]
+
+resolution_tier = st.sidebar.selectbox(
+    "Image Resolution:",
+    options=["model default"] + list(RESOLUTION_TIERS.keys()),
+    help="Caps the pixels sent to the model; fewer pixels means fewer visual tokens and faster answers"
+)
+max_pixels = selected_spec.max_pixels if resolution_tier == "model default" else RESOLUTION_TIERS[resolution_tier]
+
+# Remembered per model, so each one keeps the precision it was last run at
+precision = st.sidebar.selectbox(
+    "Precision:",
+    options=available_precisions(),
+    key=f"precision_{selected_model_name}",
+    help="bf16, int8 and int4 trade some accuracy for memory and CPU decode speed"
+)
 
 st.sidebar.markdown("---")
 st.sidebar.markdown(f"**Selected Model:** {selected_model_name}")
 st.sidebar.markdown(f"**Model Path:** `{selected_model_path}`")
 
 @st.cache_resource
-def load_model(model_path):
-    model = Qwen2VLForConditionalGeneration.from_pretrained(
-        model_path,
-        torch_dtype="auto",
-        device_map="auto"
+def get_registry():
+    # One registry for all sessions; it decides which models stay resident
+    return ModelRegistry()
+
+@st.cache_resource
+def get_jobs():
+    # One pool for all sessions, so identical requests share a generation
+    return JobManager()
+
+@st.cache_resource
+def get_verdict_cache():
+    # Set VERDICT_CACHE_DB to keep verdicts across restarts
+    return VerdictCache(max_entries=1024, db_path=os.getenv("VERDICT_CACHE_DB"))
+
+@st.cache_resource
+def get_result_store():
+    # Set RESULT_STORE_DB to keep every answer across restarts
+    return ResultStore.from_env()
+
+# Thin client (INFERENCE_SERVER_URL): server.py holds the model and runs the analyses
+inference_client = InferenceClient.from_env()
+
+# Load model with selected model path (lazily, evicting the least recently used if over budget)
+registry = get_registry()
+if inference_client is None:
+    loaded_model = registry.get(selected_model_name, precision)
+    model, processor = loaded_model.model, loaded_model.processor
+else:
+    model = processor = None
+    served = inference_client.health()
+    st.sidebar.caption(f"Served by {inference_client.base_url}: {served['model']} ({served['precision']})")
+
+# Generations on this model run one at a time unless the scheduler batches them
+model_group = f"{selected_model_name}:{precision}"
+jobs = get_jobs()
+
+# Speculative decoding: the registered draft model proposes tokens this model verifies
+draft, draft_tokens = None, DEFAULT_DRAFT_TOKENS
+if inference_client is None and selected_spec.draft and st.sidebar.checkbox(
+    "⚡ Speculative decoding",
+    help=f"Draft tokens with {selected_spec.draft}; answers are unchanged, decoding is faster"
+):
+    draft_tokens = st.sidebar.slider("Draft tokens per step:", 1, 8, DEFAULT_DRAFT_TOKENS)
+    draft_entry = registry.get(selected_spec.draft, precision)
+    compatible = registry.resource(
+        selected_model_name,
+        f"draft_compatible:{selected_spec.draft}",
+        lambda entry: tokenizers_compatible(entry.processor, draft_entry.processor),
+        precision
     )
-    processor = AutoProcessor.from_pretrained(
-        model_path
+    if compatible:
+        draft = (draft_entry.model, draft_entry.processor)
+    else:
+        st.sidebar.warning(f"{selected_spec.draft} does not share this model's vocabulary; decoding normally")
+
+# Structured mode: JSON answers parsed into typed records, rendered as markdown
+structured_output = st.sidebar.checkbox(
+    "🧾 Structured output (JSON)",
+    value=os.getenv("STRUCTURED_OUTPUT") == "1",
+    help="Ingredients, recipe and nutrition come back as JSON in a fixed schema and are formatted here: "
+         "fewer tokens to generate and nothing to scrape from free-form text"
+)
+
+# Nutrition from the nutrient table needs only the ingredients analysis from the model
+computed_nutrition = st.sidebar.checkbox(
+    "🧮 Compute nutrition from nutrient table",
+    value=os.getenv("NUTRITION_FROM_TABLE", "1") == "1",
+    help="Look up the ingredients and quantities the model lists in a local nutrient table "
+         "instead of having it write the nutrition tables; faster and the same every run"
+)
+
+def build_scheduler(entry):
+    return InferenceScheduler(
+        entry.model,
+        entry.processor,
+        max_batch_size=int(os.getenv("BATCH_MAX_SIZE", "1")),
+        max_wait_ms=float(os.getenv("BATCH_WAIT_MS", "20"))
     )
-    return model, processor
-
-def validate_food_image(image, model, processor):
-    """Check if image contains food items"""
-    messages = [
-        {"role": "system", "content": [{"type": "text", "text": FOOD_VALIDATION_PROMPT}]},
-        {"role": "user", "content": [
-            {"type": "image", "image": image},
-            {"type": "text", "text": "Is this image a food item?"},
-        ]}
-    ]
-    
-    text = processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-    image_inputs, video_inputs = process_vision_info(messages)
-    inputs = processor(
-        text=[text],
-        images=image_inputs,
-        videos=video_inputs,
-        padding=True,
-        return_tensors="pt"
-    ).to("cuda" if torch.cuda.is_available() else "cpu")
-    
-    generated_ids = model.generate(**inputs, max_new_tokens=10)
-    generated_ids_trimmed = [
-        out_ids[len(in_ids):] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
-    ]
-    output_text = processor.batch_decode(
-        generated_ids_trimmed,
-        skip_special_tokens=True,
-        clean_up_tokenization_spaces=False
-    )[0].strip()
-    
-    return "VALID_FOOD" in output_text
 
-def analyze_food(image, system_prompt, analysis_type, model, processor, user_question=""):
-    """Analyze food image with specific system prompt"""
-    
-    user_text = f"Please provide a detailed {analysis_type} analysis of this food image."
-    if user_question.strip():
-        user_text = f"{user_question.strip()}"
-    
-    messages = [
-        {"role": "system", "content": [{"type": "text", "text": system_prompt}]},
-        {"role": "user", "content": [
-            {"type": "image", "image": image},
-            {"type": "text", "text": user_text},
-        ]}
-    ]
-    
-    text = processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-    image_inputs, video_inputs = process_vision_info(messages)
-    inputs = processor(
-        text=[text],
-        images=image_inputs,
-        videos=video_inputs,
-        padding=True,
-        return_tensors="pt"
-    ).to("cuda" if torch.cuda.is_available() else "cpu")
-    
-    generated_ids = model.generate(**inputs, max_new_tokens=1024)
-    generated_ids_trimmed = [
-        out_ids[len(in_ids):] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
-    ]
-    output_text = processor.batch_decode(
-        generated_ids_trimmed,
-        skip_special_tokens=True,
-        clean_up_tokenization_spaces=False
-    )[0]
-    
-    return output_text
+# Cascade routing: the small model takes validation and short questions
+routing_policy = RoutingPolicy.from_env()
+router = None
+if inference_client is None and selected_model_name != routing_policy.small and st.sidebar.checkbox(
+    "🔀 Cascade routing",
+    value=os.getenv("ROUTER_ENABLED") == "1",
+    help=f"{routing_policy.small} validates images and answers short questions; "
+         f"{selected_model_name} handles the rest and anything the small model is unsure about"
+):
+    router = registry.resource(
+        selected_model_name,
+        "router",
+        lambda entry: CascadeRouter(registry, selected_model_name, routing_policy, precision),
+        precision
+    )
 
-# Load model with selected model path
-model, processor = load_model(selected_model_path)
+st.sidebar.markdown("**Resident models**")
+for resident in registry.info():
+    st.sidebar.caption(
+        f"{resident['name']} ({resident['precision']}): {resident['size_gb']:.2f} GB, "
+        f"loaded in {resident['load_s']:.1f}s"
+    )
+
+# Batching is opt-in (BATCH_MAX_SIZE > 1); otherwise results stream per session.
+# The scheduler lives with the model in the registry and is closed when it unloads.
+scheduler = (
+    registry.resource(selected_model_name, "scheduler", build_scheduler, precision)
+    if inference_client is None and int(os.getenv("BATCH_MAX_SIZE", "1")) > 1 else None
+)
+
+backend = AnalysisBackend(
+    jobs, get_result_store(), model_group, model=model, processor=processor, client=inference_client,
+    router=router, scheduler=scheduler, draft=draft, draft_tokens=draft_tokens, structured=structured_output
+)
+
+def submit(slot, header, work_spec):
+    """Run an analysis as a background job and show it in this session's slot for the image"""
+    submit_job(jobs, image_id, slot, header, work_spec)
 
 # File uploader
 uploaded_file = st.file_uploader("📸 Upload a Food Image", type=["jpg", "png", "jpeg"])
 
 if uploaded_file:
-    image = Image.open(uploaded_file)
+    image = preprocess_image(uploaded_file.getvalue(), selected_spec.min_pixels, max_pixels)
     st.image(image, caption='Uploaded Food Image', use_column_width=True)
     
-    # Validate if image contains food
-    if not validate_food_image(image, model, processor):
+    # Validate if image contains food (cached per image bytes and the model that answers)
+    if inference_client is not None:
+        answering_model = model_id(MODEL_SPECS[served['model']].path, served['precision'], max_pixels)
+    else:
+        answering_model = model_id(selected_model_path, precision, max_pixels)
+    image_id = image_key(uploaded_file.getvalue(), answering_model)
+    verdict_cache = get_verdict_cache()
+    is_food = verdict_cache.get_or_compute(image_id, lambda: backend.validate(image, image_id))
+    cache_stats = verdict_cache.stats()
+    st.sidebar.caption(
+        f"Validation cache: {cache_stats['hits']} hits / {cache_stats['misses']} misses"
+    )
+
+    if not is_food:
         st.error("🚫 **Not Recognized as Food Item**")
         st.warning("The uploaded image is not recognized as a food item. Please upload an image containing food, beverages, or edible items.")
     else:
@@ -145,6 +212,8 @@ if uploaded_file:
         with col3:
             calories_btn = st.button("🔢 **Calories & Nutrition**", use_container_width=True)
         
+        full_report_btn = st.button("📋 **Full Report (all three in one pass)**", use_container_width=True)
+        
         # Additional questions section
         st.markdown("---")
         st.subheader("❓ Ask Additional Questions")
@@ -156,34 +225,36 @@ if uploaded_file:
         
         ask_question_btn = st.button("💬 **Ask Question**", use_container_width=True)
         
-        # Handle button clicks
+        # Analyses run in the background, so several can be in flight and reruns don't interrupt them
         if ingredients_btn:
-            with st.spinner("🔍 Analyzing ingredients..."):
-                result = analyze_food(image, INGREDIENTS_SYSTEM_PROMPT, "ingredients", model, processor)
-                st.markdown("## 🥕 Ingredients Analysis")
-                st.markdown(result)
+            submit("ingredients", "## 🥕 Ingredients Analysis",
+                   backend.panel_work(image, image_id, INGREDIENTS_SYSTEM_PROMPT, "ingredients"))
         
         elif recipe_btn:
-            with st.spinner("👨‍🍳 Creating recipe..."):
-                result = analyze_food(image, RECIPE_SYSTEM_PROMPT, "recipe", model, processor)
-                st.markdown("## 👨‍🍳 Complete Recipe & Cooking Instructions")
-                st.markdown(result)
+            submit("recipe", "## 👨‍🍳 Complete Recipe & Cooking Instructions",
+                   backend.panel_work(image, image_id, RECIPE_SYSTEM_PROMPT, "recipe"))
         
         elif calories_btn:
-            with st.spinner("🔢 Calculating nutrition..."):
-                result = analyze_food(image, NUTRITION_SYSTEM_PROMPT, "nutrition", model, processor)
-                st.markdown("## 🔢 Calorie Count & Nutritional Analysis")
-                st.markdown(result)
+            submit("nutrition", "## 🔢 Calorie Count & Nutritional Analysis",
+                   backend.nutrition_work(image, image_id) if computed_nutrition
+                   else backend.panel_work(image, image_id, NUTRITION_SYSTEM_PROMPT, "nutrition"))
+        
+        elif full_report_btn:
+            submit("full report", "", backend.full_report_work(image, image_id))
         
         elif ask_question_btn:
             if user_question.strip():
-                with st.spinner("💭 Processing your question..."):
-                    result = analyze_food(image, GENERAL_FOOD_PROMPT, "general", model, processor, user_question)
-                    st.markdown("## 💬 Answer to Your Question")
-                    st.markdown(result)
+                submit("question", "## 💬 Answer to Your Question",
+                       backend.panel_work(image, image_id, GENERAL_FOOD_PROMPT, "general", user_question))
             else:
                 st.warning("Please enter a question first.")
 
+        render_jobs(jobs, image_id)
+
+    for line in backend.stats_lines():
+        st.sidebar.caption(line)
+    render_debug_panel(jobs)
+
 else:
     st.info("👆 Please upload a food image to begin analysis")
 
@@ -0,0 +1,207 @@
+# Analysis plumbing shared by the local VLM apps (Smol.py and Qwen-VLM.py)
+#
+# Every panel an app shows is a (work, job key, job group) triple for
+# jobs.JobManager. The work goes to an inference server when the app is a thin
+# client, otherwise to the cascade router, the batching scheduler or the model
+# itself, and is read through the result store. Structured records and full
+# reports are stored as batch.py and server.py store them (record dicts, section
+# dicts) and rendered as markdown after the read. The apps only pick the model
+# and options in their sidebars and lay out the buttons.
+
+from dataclasses import asdict
+
+from nutrition import nutrition_report
+from prefix_cache import PREFIX_STATS
+from prompts import FULL_REPORT_SYSTEM_PROMPT, INGREDIENTS_SYSTEM_PROMPT, STRUCTURED_PROMPTS
+from speculative import DEFAULT_DRAFT_TOKENS, SPECULATIVE_STATS
+from structured import RECORD_TYPES, parse_record
+from vlm import (
+    EMBEDDING_CACHE,
+    FULL_REPORT_MAX_NEW_TOKENS,
+    analyze_structured,
+    full_report,
+    split_full_report,
+    stream_analyze_food,
+    validate_food_image
+)
+
+# Result panels the full report is split into
+REPORT_PANELS = [
+    ("ingredients", "## 🥕 Ingredients Analysis"),
+    ("recipe", "## 👨‍🍳 Complete Recipe & Cooking Instructions"),
+    ("nutrition", "## 🔢 Calorie Count & Nutritional Analysis"),
+]
+
+
+def render_full_report(sections):
+    """Full report sections as the usual result panels, one after another"""
+    return "\n\n".join(
+        f"{header}\n\n{sections[section] or '_This section was missing from the model output._'}"
+        for section, header in REPORT_PANELS
+    )
+
+
+class AnalysisBackend:
+    """Builds the apps' analysis work for one model and the way the app reaches it.
+
+    Either client (a server_client.InferenceClient) or model and processor are
+    given. router, scheduler and draft, a (draft_model, draft_processor) pair,
+    are optional. group is the JobManager group of jobs running on the model
+    here; structured asks for JSON answers where the analysis type has a schema.
+    """
+
+    def __init__(self, jobs, store, group, model=None, processor=None, client=None, router=None, scheduler=None,
+                 draft=None, draft_tokens=DEFAULT_DRAFT_TOKENS, structured=False):
+        self.jobs = jobs
+        self.store = store
+        self.group = group
+        self.model = model
+        self.processor = processor
+        self.client = client
+        self.router = router
+        self.scheduler = scheduler
+        self.draft = draft
+        self.draft_tokens = draft_tokens if draft is not None else DEFAULT_DRAFT_TOKENS
+        self.structured = structured
+
+    def _draft_key(self):
+        return f"draft={self.draft_tokens if self.draft is not None else 0}"
+
+    def analysis_work(self, image, image_id, system_prompt, analysis_type, user_question=""):
+        """(work, job key, group) for a free-form answer"""
+        key = f"{image_id}:{analysis_type}:{user_question}:{self._draft_key()}"
+        if self.client is not None:
+            # The server serializes generations itself
+            return (lambda: self.client.stream_analyze(image, analysis_type, user_question)), f"{key}:remote", None
+        if self.router is not None:
+            return (lambda: self.router.stream_analyze(
+                image, system_prompt, analysis_type, user_question, image_id=image_id,
+                draft=self.draft, draft_tokens=self.draft_tokens
+            )), f"{key}:routed", self.group
+        if self.scheduler is not None:
+            # The scheduler batches concurrent requests itself
+            return (lambda: self.scheduler.analyze(
+                image, system_prompt, analysis_type, user_question
+            )), f"{key}:batched", None
+        return (lambda: stream_analyze_food(
+            image, system_prompt, analysis_type, self.model, self.processor, user_question, image_id=image_id,
+            draft=self.draft, draft_tokens=self.draft_tokens
+        )), key, self.group
+
+    def structured_work(self, image, image_id, analysis_type):
+        """(work, job key, group) for a JSON answer as the typed record's dict, the form the result store keeps"""
+        key = f"{image_id}:{analysis_type}:json:{self._draft_key()}"
+        prompt = STRUCTURED_PROMPTS[analysis_type]
+        if self.client is not None:
+            return (lambda: self.client.analyze(image, analysis_type, structured=True)), f"{key}:remote", None
+        if self.router is not None:
+            return (lambda: asdict(parse_record(analysis_type, self.router.analyze(
+                image, prompt, analysis_type, image_id=image_id, structured=True,
+                draft=self.draft, draft_tokens=self.draft_tokens
+            )))), f"{key}:routed", self.group
+        if self.scheduler is not None:
+            return (lambda: asdict(parse_record(analysis_type, self.scheduler.analyze(
+                image, prompt, analysis_type, structured=True
+            )))), f"{key}:batched", None
+        return (lambda: asdict(analyze_structured(
+            image, analysis_type, self.model, self.processor, image_id=image_id,
+            draft=self.draft, draft_tokens=self.draft_tokens
+        ))), key, self.group
+
+    def stored(self, work_spec, image, image_id, analysis_type, system_prompt, user_question=""):
+        """work_spec answered from the result store when this model already answered this prompt for the image"""
+        work, key, group = work_spec
+        if self.client is not None:
+            # The server reads through its own result store
+            return work_spec
+        model_id, digest = image_id.rsplit(":", 1)
+        if self.router is not None:
+            model_id += ":routed"
+        return self.store.through(
+            work, digest, analysis_type, model_id, system_prompt, user_question, image=image
+        ), key, group
+
+    def panel_work(self, image, image_id, system_prompt, analysis_type, user_question=""):
+        """structured_work() in structured mode, rendered as markdown, else analysis_work(); read through the store"""
+        if self.structured and analysis_type in STRUCTURED_PROMPTS:
+            work, key, group = self.stored(
+                self.structured_work(image, image_id, analysis_type), image, image_id,
+                f"{analysis_type}:json", STRUCTURED_PROMPTS[analysis_type]
+            )
+            return (lambda: RECORD_TYPES[analysis_type].from_dict(work()).markdown()), key, group
+        return self.stored(
+            self.analysis_work(image, image_id, system_prompt, analysis_type, user_question), image, image_id,
+            analysis_type, system_prompt, user_question
+        )
+
+    def nutrition_work(self, image, image_id):
+        """(work, job key, group) computing nutrition from the ingredients analysis and the nutrient table"""
+        work, key, group = self.panel_work(image, image_id, INGREDIENTS_SYSTEM_PROMPT, "ingredients")
+        return (lambda: nutrition_report("".join(work()))), f"{key}:computed nutrition", group
+
+    def full_report_work(self, image, image_id):
+        """(work, job key, group) generating all three analyses in one pass, rendered as the usual panels.
+
+        The sections are read through the result store like the single panels.
+        """
+        key = f"{image_id}:full report"
+        if self.client is not None:
+            work_spec = (lambda: self.client.analyze(image, "full report")), f"{key}:remote", None
+        elif self.scheduler is not None:
+            work_spec = (lambda: split_full_report(self.scheduler.analyze(
+                image, FULL_REPORT_SYSTEM_PROMPT, "full report", max_new_tokens=FULL_REPORT_MAX_NEW_TOKENS
+            ))), f"{key}:batched", None
+        else:
+            work_spec = (lambda: full_report(image, self.model, self.processor, image_id=image_id)), key, self.group
+        work, key, group = self.stored(work_spec, image, image_id, "full report", FULL_REPORT_SYSTEM_PROMPT)
+        return (lambda: render_full_report(work())), key, group
+
+    def validate(self, image, image_id):
+        """Food verdict, holding the model's job group lock while it runs on the model here"""
+        if self.client is not None:
+            return self.client.validate(image)
+        if self.router is None and self.scheduler is not None:
+            return self.scheduler.validate(image)
+        # Not concurrently with a group-locked analysis: generate() on one model is not thread-safe
+        with self.jobs.group_lock(self.group):
+            if self.router is not None:
+                return self.router.validate(image, image_id)
+            return validate_food_image(image, self.model, self.processor, image_id=image_id)
+
+    def stats_lines(self):
+        """Sidebar captions for the caches, batching, routing, drafts, result store and jobs"""
+        embedding_stats = EMBEDDING_CACHE.stats()
+        lines = [
+            f"Vision cache: {embedding_stats['hits']} hits / {embedding_stats['misses']} misses, "
+            f"{embedding_stats['used_mb']:.0f}/{embedding_stats['max_mb']:.0f} MB"
+        ]
+        if self.scheduler is not None:
+            batch_stats = self.scheduler.stats()
+            lines.append(
+                f"Batching: {batch_stats['images_per_min']:.1f} images/min, "
+                f"mean batch {batch_stats['mean_batch_size']:.1f}, {batch_stats['queued']} queued"
+            )
+        prefix_stats = PREFIX_STATS.stats()
+        lines.append(
+            f"Prefix cache: {prefix_stats['last_tokens_saved']} prefill tokens saved on the last request, "
+            f"{prefix_stats['tokens_saved']} in total"
+        )
+        if self.router is not None:
+            routing_stats = self.router.stats()
+            lines.append(
+                f"Routing: {routing_stats['small_share']:.0%} of {routing_stats['total']} requests "
+                f"answered by {self.router.policy.small}"
+            )
+            lines += [f"  {route}: {count}" for route, count in routing_stats["routes"].items()]
+        if self.draft is not None:
+            speculative_stats = SPECULATIVE_STATS.stats()
+            lines.append(
+                f"Speculative decoding: {speculative_stats['acceptance_rate']:.0%} of drafted tokens accepted, "
+                f"{speculative_stats['tokens_per_target_forward']:.2f} tokens per target forward"
+            )
+        if self.store.enabled:
+            store_stats = self.store.stats()
+            lines.append(f"Result store: {store_stats['hits']} answers reused, {store_stats['writes']} stored")
+        job_stats = self.jobs.stats()
+        lines.append(f"Jobs: {job_stats['running']} running, {job_stats['coalesced']} duplicate requests shared")
+        return lines
@@ -0,0 +1,319 @@
+# Headless batch analysis of a directory (or manifest) of food images
+#
+#   python batch.py photos/ --analyses validate,ingredients --output results.jsonl
+#   python batch.py manifest.txt --backend gemini --analyses calories --num-shards 4 --shard-index 0
+#   python batch.py photos/ --analyses ingredients,recipe --structured
+#
+# Results are appended to JSONL as each image finishes. Rerunning the same command
+# skips the images already analyzed in the output file, so a crashed run resumes
+# where it stopped and images that failed are retried.
+# With --store (default RESULT_STORE_DB) every answer is also read through the
+# SQLite result store, so images the apps or an earlier run analyzed are not rerun.
+
+import argparse
+import json
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
+
+from cache import image_digest, image_key
+from preprocess import preprocess_image
+from prompts import FULL_REPORT_SYSTEM_PROMPT, LOCAL_ANALYSES, LOCAL_BATCH_ANALYSES, STRUCTURED_PROMPTS
+from result_store import ResultStore, model_id
+
+logger = logging.getLogger("batch")
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp"}
+
+# Store outputs in one transaction per this many answers
+STORE_FLUSH_EVERY = 64
+
+# FoodAnalyzer method behind each Gemini analysis name
+GEMINI_ANALYSES = {
+    "calories": "get_calorie_count",
+    "ingredients": "get_ingredients",
+    "recipe": "get_recipe",
+}
+
+
+def iter_image_paths(source):
+    """Image paths from a directory tree (in sorted order) or a manifest file.
+
+    A manifest has one path per line, or one JSON object with a "path" key per line.
+    """
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for name in sorted(files):
+                if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                    yield os.path.join(root, name)
+        return
+
+    with open(source) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            yield json.loads(line)["path"] if line.startswith("{") else line
+
+
+def shard(paths, num_shards, shard_index):
+    """Every num_shards-th path, starting at shard_index"""
+    for index, path in enumerate(paths):
+        if index % num_shards == shard_index:
+            yield path
+
+
+def shard_output_path(output, num_shards, shard_index):
+    if num_shards == 1:
+        return output
+    stem, ext = os.path.splitext(output)
+    return f"{stem}.shard-{shard_index}-of-{num_shards}{ext}"
+
+
+def completed_paths(output_path):
+    """Paths with a successful record in the output file.
+
+    Paths whose records are all errors are left out so a rerun retries them;
+    a torn last line is ignored.
+    """
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(record, dict) and "path" in record and "error" not in record:
+                done.add(record["path"])
+    return done
+
+
+def load_image(path, min_pixels=None, max_pixels=None):
+    """Read, decode and downscale one image (runs in the prefetch pool)"""
+    with open(path, "rb") as f:
+        data = f.read()
+    return data, preprocess_image(data, min_pixels, max_pixels)
+
+
+def prefetch(paths, workers, lookahead, min_pixels=None, max_pixels=None):
+    """Decode images in a thread pool while the caller runs the model, keeping input order"""
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for path in paths:
+            pending.append((path, pool.submit(load_image, path, min_pixels, max_pixels)))
+            if len(pending) >= lookahead:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+
+
+def local_analyzer(model_name, analyses, precision="auto", structured=False, store=None):
+    """analyze(data, image) -> record fields, backed by a local VLM from the registry.
+
+    With structured=True, ingredients, recipe and nutrition results are the
+    typed records from structured.py as dicts instead of markdown. Answers,
+    full reports included, are read through store (a result_store.ResultStore)
+    when given, under the same keys as the apps. The ingredients analysis is
+    run once per image whether it is asked for or only needed by
+    computed_nutrition, in any order.
+    """
+    from registry import ModelRegistry, MODEL_SPECS
+    from vlm import validate_food_image, analyze_food, analyze_structured, full_report
+    from nutrition import nutrition_report
+    from structured import RECORD_TYPES
+
+    loaded = ModelRegistry().get(model_name, precision)
+    model, processor = loaded.model, loaded.processor
+    spec = MODEL_SPECS[model_name]
+    answering_model = model_id(spec.path, precision, spec.max_pixels)
+    store = store or ResultStore()
+
+    def analyze(data, image):
+        image_id = image_key(data, answering_model)
+        digest = image_digest(data)
+
+        def stored(work, analysis_type, prompt):
+            return store.through(
+                work, digest, analysis_type, answering_model, prompt, image=image, size_bytes=len(data)
+            )()
+
+        record = {}
+        if "validate" in analyses:
+            record["is_food"] = validate_food_image(image, model, processor, image_id=image_id)
+            if not record["is_food"]:
+                return record
+
+        answers = {}
+
+        def answer(name):
+            """name's answer, a record dict in structured mode, else markdown; once per image"""
+            if name not in answers:
+                if structured:
+                    answers[name] = stored(
+                        lambda: asdict(analyze_structured(image, name, model, processor, image_id=image_id)),
+                        f"{name}:json", STRUCTURED_PROMPTS[name]
+                    )
+                else:
+                    answers[name] = stored(
+                        lambda: analyze_food(image, LOCAL_ANALYSES[name], name, model, processor, image_id=image_id),
+                        name, LOCAL_ANALYSES[name]
+                    )
+            return answers[name]
+
+        results = {}
+        for name in analyses:
+            if name == "full_report":
+                results.update(stored(
+                    lambda: full_report(image, model, processor, image_id=image_id),
+                    "full report", FULL_REPORT_SYSTEM_PROMPT
+                ))
+            elif name == "computed_nutrition":
+                ingredients = answer("ingredients")
+                if structured:
+                    ingredients = RECORD_TYPES["ingredients"].from_dict(ingredients).markdown()
+                results[name] = nutrition_report(ingredients)
+            elif name != "validate":
+                results[name] = answer(name)
+        record["results"] = results
+        return record
+
+    return analyze
+
+
+def gemini_analyzer(analyses, structured=False, store=None):
+    """analyze(data, image) -> record fields, backed by FoodAnalyzer"""
+    from gemini import FoodAnalyzer
+
+    analyzer = FoodAnalyzer(store=store)
+
+    def analyze(data, image):
+        image_id = image_digest(data)
+        if structured:
+            return {"results": {
+                name: asdict(getattr(analyzer, GEMINI_ANALYSES[name])(image, structured=True, image_id=image_id))
+                for name in analyses
+            }}
+        return {
+            "results": {name: getattr(analyzer, GEMINI_ANALYSES[name])(image, image_id=image_id) for name in analyses}
+        }
+
+    return analyze
+
+
+def run(args):
+    analyses = [name.strip() for name in args.analyses.split(",") if name.strip()]
+    if args.backend == "gemini":
+        allowed = set(GEMINI_ANALYSES)
+    else:
+        allowed = LOCAL_BATCH_ANALYSES
+    unknown = [name for name in analyses if name not in allowed]
+    if unknown:
+        raise SystemExit(f"Unknown analyses for the {args.backend} backend: {', '.join(unknown)}")
+
+    output_path = shard_output_path(args.output, args.num_shards, args.shard_index)
+    done = completed_paths(output_path)
+    if done:
+        logger.info("resuming: %d images already in %s", len(done), output_path)
+
+    store = ResultStore(args.store, flush_every=STORE_FLUSH_EVERY)
+    if args.backend == "gemini":
+        analyze = gemini_analyzer(analyses, args.structured, store)
+        min_pixels, max_pixels = None, None
+    else:
+        from registry import MODEL_SPECS
+        analyze = local_analyzer(args.model, analyses, args.precision, args.structured, store)
+        spec = MODEL_SPECS[args.model]
+        min_pixels, max_pixels = spec.min_pixels, spec.max_pixels
+
+    paths = (
+        path for path in shard(iter_image_paths(args.source), args.num_shards, args.shard_index)
+        if path not in done
+    )
+
+    processed = 0
+    start = time.perf_counter()
+    with open(output_path, "a+") as out:
+        # A crash can leave a torn last line; start the next record on a fresh one
+        out.seek(0, os.SEEK_END)
+        if out.tell() > 0:
+            out.seek(out.tell() - 1)
+            if out.read(1) != "\n":
+                out.write("\n")
+
+        for path, decoded in prefetch(paths, args.workers, args.prefetch, min_pixels, max_pixels):
+            item_start = time.perf_counter()
+            record = {"path": path}
+            try:
+                data, image = decoded.result()
+                record["sha256"] = image_digest(data)
+                record.update(analyze(data, image))
+            except Exception as e:
+                logger.warning("%s failed: %s", path, e)
+                record["error"] = str(e)
+            record["elapsed_s"] = round(time.perf_counter() - item_start, 3)
+
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+
+            processed += 1
+            if processed % args.log_every == 0:
+                rate = processed / (time.perf_counter() - start)
+                logger.info("%d images, %.2f images/sec", processed, rate)
+
+    store.close()
+    if store.enabled:
+        stats = store.stats()
+        logger.info("result store: %d answers reused, %d stored in %s", stats["hits"], stats["writes"], args.store)
+    elapsed = time.perf_counter() - start
+    logger.info(
+        "done: %d images in %.1fs (%.2f images/sec) -> %s",
+        processed, elapsed, processed / elapsed if elapsed else 0.0, output_path
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyze a directory or manifest of food images")
+    parser.add_argument("source", help="directory of images, or a manifest with one path (or JSON object) per line")
+    parser.add_argument("--backend", choices=["local", "gemini"], default="local")
+    parser.add_argument("--model", default="Qwen2-VL-7B-Instruct", help="registry model name (local backend)")
+    parser.add_argument(
+        "--precision", default="auto", choices=["auto", "bf16", "int8", "int4"],
+        help="weight precision (local backend); int8/int4 are CPU-only"
+    )
+    parser.add_argument(
+        "--analyses",
+        default="validate,ingredients",
+        help="comma-separated: validate, ingredients, recipe, nutrition, full_report, computed_nutrition (local) "
+             "or calories, ingredients, recipe (gemini)"
+    )
+    parser.add_argument(
+        "--structured", action="store_true",
+        help="ingredients, recipe and nutrition/calories as JSON records in a fixed schema instead of markdown"
+    )
+    parser.add_argument("--output", default="batch_results.jsonl")
+    parser.add_argument(
+        "--store", default=os.getenv("RESULT_STORE_DB"),
+        help="SQLite result store to read answers from and add new ones to (default: RESULT_STORE_DB)"
+    )
+    parser.add_argument("--workers", type=int, default=4, help="image decoding threads")
+    parser.add_argument("--prefetch", type=int, default=8, help="images decoded ahead of the model")
+    parser.add_argument("--num-shards", type=int, default=1)
+    parser.add_argument("--shard-index", type=int, default=0)
+    parser.add_argument("--log-every", type=int, default=50)
+    args = parser.parse_args()
+
+    if not 0 <= args.shard_index < args.num_shards:
+        parser.error("--shard-index must be in [0, --num-shards)")
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
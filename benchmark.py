@@ -0,0 +1,667 @@
+# Offline benchmarks for the local VLM inference path
+#
+#   python benchmark.py full-report --model Qwen2-VL-7B-Instruct food1.jpg food2.jpg
+#   python benchmark.py resolution --model Qwen2-VL-7B-Instruct food1.jpg food2.jpg
+#   python benchmark.py offline --output offline.json
+#   python benchmark.py precision --model SmolVLM-256M-Instruct --food food/*.jpg --not-food other/*.jpg
+#   python benchmark.py speculative --model SmolVLM2-2.2B-Instruct food1.jpg food2.jpg
+#   python benchmark.py workers --model SmolVLM2-2.2B-Instruct --workers 1,2,4 --threads 2,4,8 food1.jpg food2.jpg
+#
+# Results are printed and, with --output, saved as JSON so runs can be compared.
+# The offline benchmark needs no weights or network: it drives a tiny random
+# Qwen2-VL (tiny_model.py) and FoodAnalyzer against a fake Gemini endpoint
+# (fake_gemini.py) with synthetic images. The near-duplicate result cache is
+# bypassed throughout, since the benchmarks deliberately repeat similar images.
+
+import argparse
+import difflib
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from cache import image_key
+from metrics import last_trace
+from preprocess import preprocess_image, RESOLUTION_TIERS
+from prompts import (
+    INGREDIENTS_SYSTEM_PROMPT,
+    RECIPE_SYSTEM_PROMPT,
+    NUTRITION_SYSTEM_PROMPT,
+    FULL_REPORT_SYSTEM_PROMPT
+)
+from quantize import PRECISION_MODES
+from registry import ModelRegistry, MODEL_SPECS, GB
+from speculative import tokenizers_compatible
+from worker_pool import WorkerPool, DISPATCH_MODES, available_cores, load_mapped
+from vlm import (
+    analyze_food,
+    validate_food_image,
+    score_food_image,
+    generate_food_verdict,
+    count_visual_tokens,
+    split_full_report,
+    analysis_user_text,
+    build_messages,
+    prepare_inputs,
+    FULL_REPORT_MAX_NEW_TOKENS
+)
+
+SEQUENTIAL_ANALYSES = [
+    (INGREDIENTS_SYSTEM_PROMPT, "ingredients"),
+    (RECIPE_SYSTEM_PROMPT, "recipe"),
+    (NUTRITION_SYSTEM_PROMPT, "nutrition"),
+]
+
+
+def count_tokens(processor, text):
+    return len(processor.tokenizer.encode(text, add_special_tokens=False))
+
+
+def count_prompt_tokens(image, system_prompt, analysis_type, processor):
+    messages = build_messages(image, system_prompt, analysis_user_text(analysis_type))
+    return int(prepare_inputs(messages, processor).input_ids.shape[1])
+
+
+def bench_full_report(image_path, model, processor, model_path):
+    """Three sequential analyze_food() calls vs one full-report generation for one image"""
+    image = Image.open(image_path)
+    image_bytes = open(image_path, "rb").read()
+
+    # Separate ids so each mode pays for its own vision encoding once
+    sequential_id = image_key(image_bytes, f"{model_path}#sequential")
+    report_id = image_key(image_bytes, f"{model_path}#report")
+
+    sequential = {"prompt_tokens": 0, "generated_tokens": 0}
+    start = time.perf_counter()
+    for system_prompt, analysis_type in SEQUENTIAL_ANALYSES:
+        text = analyze_food(
+            image, system_prompt, analysis_type, model, processor,
+            image_id=sequential_id, near_duplicates=False
+        )
+        sequential["prompt_tokens"] += count_prompt_tokens(image, system_prompt, analysis_type, processor)
+        sequential["generated_tokens"] += count_tokens(processor, text)
+    sequential["wall_s"] = time.perf_counter() - start
+
+    report = {}
+    start = time.perf_counter()
+    text = analyze_food(
+        image, FULL_REPORT_SYSTEM_PROMPT, "full report", model, processor,
+        image_id=report_id, max_new_tokens=FULL_REPORT_MAX_NEW_TOKENS, near_duplicates=False
+    )
+    report["wall_s"] = time.perf_counter() - start
+    report["prompt_tokens"] = count_prompt_tokens(image, FULL_REPORT_SYSTEM_PROMPT, "full report", processor)
+    report["generated_tokens"] = count_tokens(processor, text)
+    report["missing_sections"] = [name for name, body in split_full_report(text).items() if not body]
+
+    return {"image": image_path, "sequential": sequential, "full_report": report}
+
+
+def bench_resolution(image_path, model, processor, model_path, min_pixels):
+    """Visual tokens, latency and answer drift per resolution tier for one image.
+
+    Quality is measured against the "full" tier: whether the food verdict agrees
+    and how similar the ingredients answer is (difflib ratio, 1.0 = identical).
+    """
+    image_bytes = open(image_path, "rb").read()
+    tiers = {}
+    for tier, max_pixels in RESOLUTION_TIERS.items():
+        image_id = image_key(image_bytes, f"{model_path}@{tier}")
+
+        start = time.perf_counter()
+        image = preprocess_image(image_bytes, min_pixels, max_pixels)
+        preprocess_s = time.perf_counter() - start
+
+        messages = build_messages(image, INGREDIENTS_SYSTEM_PROMPT, analysis_user_text("ingredients"))
+        visual_tokens = count_visual_tokens(prepare_inputs(messages, processor), processor)
+
+        start = time.perf_counter()
+        p_food = score_food_image(image, model, processor, image_id=image_id)
+        if p_food is None:
+            p_food = float(generate_food_verdict(image, model, processor, image_id=image_id))
+        validate_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        answer = analyze_food(
+            image, INGREDIENTS_SYSTEM_PROMPT, "ingredients", model, processor,
+            image_id=image_id, near_duplicates=False
+        )
+        analyze_s = time.perf_counter() - start
+
+        tiers[tier] = {
+            "size": list(image.size),
+            "visual_tokens": visual_tokens,
+            "preprocess_s": preprocess_s,
+            "validate_s": validate_s,
+            "analyze_s": analyze_s,
+            "p_food": p_food,
+            "answer": answer,
+        }
+
+    reference = tiers["full"]
+    for result in tiers.values():
+        result["verdict_agrees"] = (result["p_food"] >= 0.5) == (reference["p_food"] >= 0.5)
+        result["answer_similarity"] = difflib.SequenceMatcher(None, result["answer"], reference["answer"]).ratio()
+        del result["answer"]
+    return {"image": image_path, "tiers": tiers}
+
+
+def summarize_tiers(rows):
+    """Mean of each numeric per-tier measurement across images"""
+    summary = {}
+    for tier in RESOLUTION_TIERS:
+        results = [row["tiers"][tier] for row in rows]
+        summary[tier] = {
+            key: sum(float(result[key]) for result in results) / len(results)
+            for key in ("visual_tokens", "preprocess_s", "validate_s", "analyze_s",
+                        "verdict_agrees", "answer_similarity")
+        }
+    return summary
+
+
+def summarize(rows, modes):
+    totals = {}
+    for mode in modes:
+        totals[mode] = {
+            key: sum(row[mode][key] for row in rows)
+            for key in ("wall_s", "prompt_tokens", "generated_tokens")
+        }
+    return totals
+
+
+def bench_precision(model_name, modes, food_paths, not_food_paths):
+    """Memory, decode speed and validation accuracy of one model per precision mode.
+
+    The first mode is the reference: accuracy_delta and verdict_agreement
+    compare every mode against it on the same labelled images.
+    """
+    spec = MODEL_SPECS[model_name]
+    labelled = [(path, True) for path in food_paths] + [(path, False) for path in not_food_paths]
+    images = [(preprocess_image(open(path, "rb").read(), spec.min_pixels, spec.max_pixels), label)
+              for path, label in labelled]
+
+    registry = ModelRegistry()
+    results = {}
+    for precision in modes:
+        loaded = registry.get(model_name, precision)
+        model, processor = loaded.model, loaded.processor
+
+        verdicts = [validate_food_image(image, model, processor) for image, _ in images]
+        correct = sum(verdict == label for verdict, (_, label) in zip(verdicts, images))
+
+        # Decode speed on one analysis; the trace splits prefill from decode
+        analyze_food(
+            images[0][0], INGREDIENTS_SYSTEM_PROMPT, "ingredients", model, processor, near_duplicates=False
+        )
+        trace = last_trace().as_dict()
+
+        results[precision] = {
+            "size_gb": loaded.size_bytes / GB,
+            "load_s": loaded.load_s,
+            "decode_tokens_per_s": trace.get("tokens_per_s"),
+            "ttft_s": trace.get("ttft_s"),
+            "accuracy": correct / len(images),
+            "verdicts": verdicts,
+        }
+        registry.unload(model_name, precision)
+
+    reference = results[modes[0]]
+    for result in results.values():
+        result["accuracy_delta"] = result["accuracy"] - reference["accuracy"]
+        result["verdict_agreement"] = sum(
+            a == b for a, b in zip(result["verdicts"], reference["verdicts"])
+        ) / len(images)
+    for result in results.values():
+        del result["verdicts"]
+    return results
+
+
+def bench_speculative(image_path, model, processor, draft, draft_lengths, spec):
+    """Recipe generation with and without the draft model for one image.
+
+    identical is False if speculative decoding changed the answer, which
+    greedy verification should never do.
+    """
+    image = preprocess_image(open(image_path, "rb").read(), spec.min_pixels, spec.max_pixels)
+
+    def run(**draft_kwargs):
+        start = time.perf_counter()
+        text = analyze_food(
+            image, RECIPE_SYSTEM_PROMPT, "recipe", model, processor, near_duplicates=False, **draft_kwargs
+        )
+        trace = last_trace().as_dict()
+        return text, {
+            "wall_s": time.perf_counter() - start,
+            "decode_s": trace["stages"].get("decode"),
+            "decode_tokens_per_s": trace.get("tokens_per_s"),
+            "generated_tokens": trace.get("generated_tokens"),
+            "acceptance_rate": trace.get("draft_acceptance"),
+        }
+
+    reference, baseline = run()
+    results = {"baseline": baseline}
+    for draft_tokens in draft_lengths:
+        text, result = run(draft=draft, draft_tokens=draft_tokens)
+        result["identical"] = text == reference
+        result["speedup"] = baseline["wall_s"] / result["wall_s"]
+        results[f"draft_{draft_tokens}"] = result
+    return {"image": image_path, "modes": results}
+
+
+def summarize_modes(rows):
+    """Mean of each numeric per-mode measurement across images"""
+    summary = {}
+    for mode in rows[0]["modes"]:
+        results = [row["modes"][mode] for row in rows]
+        summary[mode] = {
+            key: sum(float(result[key]) for result in results) / len(results)
+            for key, value in results[0].items()
+            if isinstance(value, (int, float)) and all(result[key] is not None for result in results)
+        }
+    return summary
+
+
+def synthetic_image(width, height, seed):
+    """Deterministic RGB noise; the tiny model does not care what is in the picture"""
+    data = random.Random(seed).randbytes(width * height * 3)
+    return Image.frombytes("RGB", (width, height), data)
+
+
+def percentile(values, q):
+    """Nearest-rank percentile, q in [0, 100]"""
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    rank = max(1, round(q / 100 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def latency_summary(values):
+    return {
+        "count": len(values),
+        "mean_s": sum(values) / len(values) if values else None,
+        "p50_s": percentile(values, 50),
+        "p95_s": percentile(values, 95),
+    }
+
+
+def stage_summary(traces):
+    """p50/p95 per stage over a list of trace dicts"""
+    stages = {}
+    for trace in traces:
+        for name, seconds in trace["stages"].items():
+            stages.setdefault(name, []).append(seconds)
+    return {name: latency_summary(values) for name, values in stages.items()}
+
+
+def current_rss_bytes():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+class ResourceSampler:
+    """Peak RSS (sampled) and peak Python allocations (tracemalloc) over a block.
+
+    tracemalloc only sees Python-level allocations; tensor storage shows up in RSS.
+    """
+
+    def __init__(self, interval_s=0.005):
+        self.interval_s = interval_s
+        self.peak_rss = 0
+        self._stop = threading.Event()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval_s):
+            self.peak_rss = max(self.peak_rss, current_rss_bytes())
+
+    def __enter__(self):
+        self.start_rss = self.peak_rss = current_rss_bytes()
+        tracemalloc.start()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak_rss = max(self.peak_rss, current_rss_bytes())
+        _, self.peak_py_alloc = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    def as_dict(self):
+        mb = 1024 ** 2
+        return {
+            "peak_rss_mb": self.peak_rss / mb,
+            "rss_growth_mb": (self.peak_rss - self.start_rss) / mb,
+            "peak_py_alloc_mb": self.peak_py_alloc / mb,
+        }
+
+
+def timed_requests(call, count):
+    """Run call(i) count times; latencies, trace dicts, wall time and resource peaks"""
+    latencies, traces = [], []
+    with ResourceSampler() as resources:
+        start = time.perf_counter()
+        for index in range(count):
+            request_start = time.perf_counter()
+            call(index)
+            latencies.append(time.perf_counter() - request_start)
+            trace = last_trace()
+            if trace is not None:
+                traces.append(trace.as_dict())
+        wall_s = time.perf_counter() - start
+    return {
+        "latency": latency_summary(latencies),
+        "throughput_rps": count / wall_s,
+        "stages": stage_summary(traces),
+        **resources.as_dict(),
+    }
+
+
+def bench_offline_local(resolutions, requests, max_new_tokens, seed):
+    """Validation and ingredients analysis on the tiny random Qwen2-VL per resolution"""
+    from tiny_model import build_tiny_qwen2_vl
+
+    model, processor = build_tiny_qwen2_vl(seed=seed)
+    results = {}
+    for size in resolutions:
+        images = [synthetic_image(size, size, seed + index) for index in range(requests)]
+        # Fresh ids per resolution: validation pays for the vision tower, analysis reuses it
+        image_ids = [image_key(image.tobytes(), f"tiny@{size}") for image in images]
+
+        validate = timed_requests(
+            lambda i: validate_food_image(images[i], model, processor, image_id=image_ids[i]), requests
+        )
+        analyze = timed_requests(
+            lambda i: analyze_food(
+                images[i], INGREDIENTS_SYSTEM_PROMPT, "ingredients", model, processor,
+                image_id=image_ids[i], max_new_tokens=max_new_tokens, near_duplicates=False
+            ),
+            requests
+        )
+        results[f"{size}x{size}"] = {"validate": validate, "analyze": analyze}
+    return results
+
+
+def bench_offline_gemini(requests, latency_ms, chunk_ms, seed, error_rate=0.0):
+    """FoodAnalyzer against the fake endpoint: blocking, streamed, and all three analyses in parallel"""
+    from fake_gemini import start_fake_gemini
+    from gemini import FoodAnalyzer
+    from gemini_client import GeminiClient
+
+    server = start_fake_gemini(latency_ms=latency_ms, chunk_ms=chunk_ms, error_rate=error_rate, seed=seed)
+    # No quota to respect locally; short backoff so injected 429s show up as retries, not idle time
+    client = GeminiClient(
+        api_key="offline", endpoint=server.url, requests_per_minute=60_000, base_delay_s=0.05, max_delay_s=1
+    )
+    pool = ThreadPoolExecutor(max_workers=3)
+    try:
+        analyzer = FoodAnalyzer(near_duplicates=False, client=client)
+        image = synthetic_image(512, 512, seed)
+        analyses = (analyzer.get_calorie_count, analyzer.get_ingredients, analyzer.get_recipe)
+
+        def run_all(i):
+            # What the app's "Run All Three" does: the three requests at once
+            return [future.result() for future in [pool.submit(analysis, image) for analysis in analyses]]
+
+        return {
+            "endpoint_latency_ms": latency_ms,
+            "chunk_ms": chunk_ms,
+            "error_rate": error_rate,
+            "blocking": timed_requests(lambda i: analyzer.get_ingredients(image), requests),
+            "streaming": timed_requests(lambda i: "".join(analyzer.get_ingredients(image, stream=True)), requests),
+            "run_all": timed_requests(run_all, requests),
+            "server_requests": server.requests,
+            "server_rate_limited": server.rate_limited,
+            "client": client.stats(),
+        }
+    finally:
+        pool.shutdown()
+        client.close()
+        server.shutdown()
+
+
+def bench_workers(model_name, images, worker_counts, thread_counts, requests, max_new_tokens,
+                  precision="auto", dispatch="queue_depth", tiny=False):
+    """Ingredients throughput and latency of a WorkerPool per (workers, threads per worker).
+
+    All requests are submitted at once, so the pool is saturated and the
+    sweep finds the split of the cores that answers the most per second.
+    Combinations needing more cores than this process may use are skipped.
+    """
+    from tiny_model import load_tiny_qwen2_vl
+
+    cores = available_cores()
+    rows = []
+    for workers in worker_counts:
+        for threads in thread_counts:
+            if workers * threads > len(cores):
+                continue
+            pool = WorkerPool(
+                model_name, workers, threads, precision, dispatch,
+                loader=load_tiny_qwen2_vl if tiny else load_mapped
+            )
+            try:
+                # One request per worker first, so first-call warm-up is not timed
+                for future in [pool.submit("validate", images[i % len(images)]) for i in range(workers)]:
+                    future.result()
+                submitted, finished, futures = {}, {}, []
+                start = time.perf_counter()
+                for index in range(requests):
+                    submitted[index] = time.perf_counter()
+                    future = pool.submit(
+                        "analyze", images[index % len(images)], INGREDIENTS_SYSTEM_PROMPT, "ingredients",
+                        max_new_tokens=max_new_tokens, near_duplicates=False
+                    )
+                    future.add_done_callback(lambda _, index=index: finished.__setitem__(index, time.perf_counter()))
+                    futures.append(future)
+                for future in futures:
+                    future.result()
+                wall_s = time.perf_counter() - start
+                worker_stats = pool.stats()["workers"]
+            finally:
+                pool.close()
+            rows.append({
+                "workers": workers,
+                "threads_per_worker": threads,
+                "throughput_rps": requests / wall_s,
+                "latency": latency_summary([finished[index] - submitted[index] for index in range(requests)]),
+                "requests_per_worker": [worker["completed"] for worker in worker_stats],
+                "rss_mb_per_worker": sum(worker["rss_mb"] for worker in worker_stats) / workers,
+                "weights_shared_mb": worker_stats[0]["weights_shared_mb"],
+            })
+            print(
+                f"{workers} workers x {threads} threads: {rows[-1]['throughput_rps']:.2f} req/s, "
+                f"p95 {rows[-1]['latency']['p95_s']:.2f}s"
+            )
+    best = max(rows, key=lambda row: row["throughput_rps"]) if rows else None
+    return {
+        "cores": len(cores),
+        "dispatch": dispatch,
+        "best": {key: best[key] for key in ("workers", "threads_per_worker", "throughput_rps")} if best else None,
+        "sweep": rows,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the local food analysis pipeline")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    full = subparsers.add_parser("full-report", help="one-pass report vs three sequential analyses")
+    full.add_argument("images", nargs="+", help="food image files")
+    full.add_argument("--model", default="Qwen2-VL-7B-Instruct", choices=list(MODEL_SPECS))
+    full.add_argument("--output", help="write results as JSON to this path")
+
+    resolution = subparsers.add_parser("resolution", help="visual tokens and latency per resolution tier")
+    resolution.add_argument("images", nargs="+", help="a fixed set of food image files")
+    resolution.add_argument("--model", default="Qwen2-VL-7B-Instruct", choices=list(MODEL_SPECS))
+    resolution.add_argument("--output", help="write results as JSON to this path")
+
+    offline = subparsers.add_parser("offline", help="tiny random model and fake Gemini endpoint, no downloads")
+    offline.add_argument("--resolutions", default="224,448,896", help="comma-separated square image sizes")
+    offline.add_argument("--requests", type=int, default=8, help="requests per scenario")
+    offline.add_argument("--max-new-tokens", type=int, default=64)
+    offline.add_argument("--gemini-latency-ms", type=float, default=300)
+    offline.add_argument("--gemini-chunk-ms", type=float, default=20)
+    offline.add_argument("--gemini-error-rate", type=float, default=0.0,
+                         help="share of fake Gemini requests answered with 429")
+    offline.add_argument("--skip-gemini", action="store_true")
+    offline.add_argument("--seed", type=int, default=0)
+    offline.add_argument("--output", help="write results as JSON to this path")
+
+    precision = subparsers.add_parser("precision", help="memory, decode speed and accuracy per precision mode")
+    precision.add_argument("--model", default="SmolVLM-256M-Instruct", choices=list(MODEL_SPECS))
+    precision.add_argument("--modes", default="auto,bf16,int8,int4",
+                           help="comma-separated precision modes; the first is the reference")
+    precision.add_argument("--food", nargs="+", required=True, help="images that are food")
+    precision.add_argument("--not-food", nargs="+", required=True, help="images that are not food")
+    precision.add_argument("--output", help="write results as JSON to this path")
+
+    speculative = subparsers.add_parser("speculative", help="decode speed with a draft model")
+    speculative.add_argument("images", nargs="+", help="food image files")
+    speculative.add_argument("--model", default="SmolVLM2-2.2B-Instruct", choices=list(MODEL_SPECS))
+    speculative.add_argument("--draft", help="draft model name (default: the model's registered draft)")
+    speculative.add_argument("--draft-tokens", default="2,4,6", help="comma-separated draft lengths to try")
+    speculative.add_argument("--output", help="write results as JSON to this path")
+
+    workers = subparsers.add_parser("workers", help="throughput per worker-process count x threads per worker")
+    workers.add_argument("images", nargs="*", help="food image files (with --tiny, synthetic images if none)")
+    workers.add_argument("--model", default="SmolVLM-256M-Instruct", choices=list(MODEL_SPECS))
+    workers.add_argument("--tiny", action="store_true", help="tiny random Qwen2-VL instead of --model, no downloads")
+    workers.add_argument("--workers", default="1,2,4", help="comma-separated worker process counts")
+    workers.add_argument("--threads", default="1,2,4,8", help="comma-separated intra-op threads per worker")
+    workers.add_argument("--precision", default="auto", choices=PRECISION_MODES)
+    workers.add_argument("--dispatch", default="queue_depth", choices=DISPATCH_MODES)
+    workers.add_argument("--requests", type=int, default=32, help="requests per combination")
+    workers.add_argument("--max-new-tokens", type=int, default=64)
+    workers.add_argument("--output", help="write results as JSON to this path")
+
+    args = parser.parse_args()
+
+    if args.command == "workers":
+        if args.images:
+            spec = MODEL_SPECS[args.model]
+            images = [
+                preprocess_image(open(path, "rb").read(), spec.min_pixels, spec.max_pixels) for path in args.images
+            ]
+        elif args.tiny:
+            images = [synthetic_image(448, 448, seed) for seed in range(4)]
+        else:
+            parser.error("pass food image files, or --tiny")
+        results = {
+            "benchmark": "workers",
+            "commit": git_commit(),
+            "model": "tiny" if args.tiny else args.model,
+            "precision": args.precision,
+            "requests": args.requests,
+            "totals": bench_workers(
+                args.model, images,
+                [int(count) for count in args.workers.split(",")],
+                [int(count) for count in args.threads.split(",")],
+                args.requests, args.max_new_tokens, args.precision, args.dispatch, args.tiny
+            ),
+        }
+
+    elif args.command == "speculative":
+        spec = MODEL_SPECS[args.model]
+        draft_name = args.draft or spec.draft
+        if draft_name is None:
+            parser.error(f"{args.model} has no registered draft model; pass --draft")
+        registry = ModelRegistry()
+        loaded = registry.get(args.model)
+        draft_loaded = registry.get(draft_name)
+        if not tokenizers_compatible(loaded.processor, draft_loaded.processor):
+            parser.error(f"{draft_name} does not share {args.model}'s vocabulary")
+        draft_lengths = [int(length) for length in args.draft_tokens.split(",")]
+        rows = [
+            bench_speculative(
+                path, loaded.model, loaded.processor,
+                (draft_loaded.model, draft_loaded.processor), draft_lengths, spec
+            )
+            for path in args.images
+        ]
+        results = {
+            "benchmark": "speculative",
+            "model": args.model,
+            "draft": draft_name,
+            "images": rows,
+            "totals": summarize_modes(rows),
+        }
+
+    elif args.command == "precision":
+        modes = [mode.strip() for mode in args.modes.split(",") if mode.strip()]
+        unknown = [mode for mode in modes if mode not in PRECISION_MODES]
+        if unknown:
+            parser.error(f"unknown precision modes: {', '.join(unknown)}")
+        results = {
+            "benchmark": "precision",
+            "model": args.model,
+            "images": len(args.food) + len(args.not_food),
+            "totals": bench_precision(args.model, modes, args.food, args.not_food),
+        }
+
+    elif args.command == "offline":
+        import torch
+
+        resolutions = [int(size) for size in args.resolutions.split(",")]
+        totals = {"local": bench_offline_local(resolutions, args.requests, args.max_new_tokens, args.seed)}
+        if not args.skip_gemini:
+            totals["gemini"] = bench_offline_gemini(
+                args.requests, args.gemini_latency_ms, args.gemini_chunk_ms, args.seed, args.gemini_error_rate
+            )
+        results = {
+            "benchmark": "offline",
+            "commit": git_commit(),
+            "torch": torch.__version__,
+            "threads": torch.get_num_threads(),
+            "requests": args.requests,
+            "totals": totals,
+        }
+
+    elif args.command == "full-report":
+        loaded = ModelRegistry().get(args.model)
+        model_path = MODEL_SPECS[args.model].path
+        rows = [bench_full_report(path, loaded.model, loaded.processor, model_path) for path in args.images]
+        results = {
+            "benchmark": "full-report",
+            "model": args.model,
+            "images": rows,
+            "totals": summarize(rows, ["sequential", "full_report"]),
+        }
+
+    elif args.command == "resolution":
+        loaded = ModelRegistry().get(args.model)
+        spec = MODEL_SPECS[args.model]
+        rows = [
+            bench_resolution(path, loaded.model, loaded.processor, spec.path, spec.min_pixels)
+            for path in args.images
+        ]
+        results = {
+            "benchmark": "resolution",
+            "model": args.model,
+            "images": rows,
+            "totals": summarize_tiers(rows),
+        }
+
+    print(json.dumps(results["totals"], indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,386 @@
+# Caches shared by the local VLM apps
+# Everything here is keyed by the content of the uploaded image, never by file name
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from PIL import Image
+
+
+def image_digest(image_bytes):
+    """Content hash of the raw uploaded image bytes"""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def image_key(image_bytes, model_id):
+    """Cache key for an image as seen by a specific model"""
+    return f"{model_id}:{image_digest(image_bytes)}"
+
+
+class VerdictCache:
+    """LRU cache of food-validation verdicts with an optional on-disk SQLite tier"""
+
+    def __init__(self, max_entries=1024, db_path=None):
+        self.max_entries = max_entries
+        self.db_path = db_path
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if db_path:
+            # Streamlit serves every session from its own thread
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS verdicts ("
+                "key TEXT PRIMARY KEY, is_food INTEGER NOT NULL, created REAL NOT NULL)"
+            )
+            self._db.commit()
+
+    def get(self, key):
+        """Return the cached verdict for key, or None on a miss"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT is_food FROM verdicts WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    verdict = bool(row[0])
+                    self._remember(key, verdict)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return verdict
+
+            self.misses += 1
+            return None
+
+    def put(self, key, verdict):
+        """Store a verdict in memory and, if configured, on disk"""
+        with self._lock:
+            self._remember(key, bool(verdict))
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO verdicts (key, is_food, created) VALUES (?, ?, ?)",
+                    (key, int(bool(verdict)), time.time())
+                )
+                self._db.commit()
+
+    def get_or_compute(self, key, compute):
+        """Return the cached verdict, running compute() only on a miss"""
+        verdict = self.get(key)
+        if verdict is None:
+            verdict = bool(compute())
+            self.put(key, verdict)
+        return verdict
+
+    def stats(self):
+        """Hit/miss counters for display in the sidebar"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def _remember(self, key, verdict):
+        self._entries[key] = verdict
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+class EmbeddingCache:
+    """LRU cache of per-image tensors (pixel values, grid, visual tokens) bounded in MB"""
+
+    def __init__(self, max_mb=512):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached dict of tensors for key, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, tensors):
+        """Store a dict of tensors, evicting least-recently-used entries to fit"""
+        size = sum(tensor.nbytes for tensor in tensors.values())
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.used_bytes -= self._entries.pop(key)[1]
+            while self._entries and self.used_bytes + size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.used_bytes -= evicted_size
+            self._entries[key] = (tensors, size)
+            self.used_bytes += size
+
+    def stats(self):
+        """Hit/miss counters and memory use"""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "used_mb": self.used_bytes / (1024 * 1024),
+                "max_mb": self.max_bytes / (1024 * 1024),
+            }
+
+
+class ResultCache:
+    """In-memory LRU of analysis results, keyed by image id plus analysis type"""
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached result for key, or None on a miss"""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+    def put(self, key, result):
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+def dhash(image, hash_size=8):
+    """Difference hash: one bit per horizontally adjacent pixel pair of a tiny grayscale copy.
+
+    Re-encoding, rescaling and small crops or colour shifts flip only a few
+    bits, so near-duplicate photos land within a small Hamming distance.
+    """
+    gray = image.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS)
+    pixels = gray.tobytes()
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+class BKTree:
+    """Burkhard-Keller tree over integer hashes under Hamming distance.
+
+    Each node is [hash, items, children by distance]; a search only descends
+    into children whose edge distance is within max_distance of the query's
+    distance to the node. Removing an item leaves its node in place as a
+    routing point.
+    """
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, value, item):
+        if self.root is None:
+            self.root = [value, [item], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [item], {}]
+                return
+            node = child
+
+    def remove(self, value, item):
+        node = self.root
+        while node is not None:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                if item in node[1]:
+                    node[1].remove(item)
+                return
+            node = node[2].get(distance)
+
+    def search(self, value, max_distance):
+        """(distance, item) pairs within max_distance, closest first"""
+        matches = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(value, node[0])
+            if distance <= max_distance:
+                matches.extend((distance, item) for item in node[1])
+            for edge, child in node[2].items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    stack.append(child)
+        return sorted(matches, key=lambda match: match[0])
+
+
+class NearDuplicateCache:
+    """Analysis results keyed by a perceptual hash of the image plus a namespace.
+
+    The namespace identifies what was asked of which model (e.g. model, analysis
+    type, prompt), so a re-compressed or slightly cropped re-upload of the same
+    photo is answered from the cache. Entries expire after ttl_s and the least
+    recently used are evicted beyond max_entries; with db_path they also live in
+    SQLite and are reloaded on start. Results must be JSON-serializable.
+    max_distance < 0 disables the cache.
+    """
+
+    def __init__(self, max_entries=512, max_distance=6, ttl_s=7 * 24 * 3600, db_path=None):
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self.ttl_s = ttl_s
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # id -> (namespace, hash, result, created)
+        self._trees = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS near_duplicates ("
+                "id INTEGER PRIMARY KEY, namespace TEXT NOT NULL, hash TEXT NOT NULL, "
+                "result TEXT NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._db.commit()
+            self._load()
+
+    @classmethod
+    def from_env(cls):
+        """Configured by NEAR_DUP_CACHE_DB, NEAR_DUP_MAX_DISTANCE and NEAR_DUP_TTL_HOURS"""
+        return cls(
+            max_distance=int(os.getenv("NEAR_DUP_MAX_DISTANCE", "6")),
+            ttl_s=float(os.getenv("NEAR_DUP_TTL_HOURS", "168")) * 3600,
+            db_path=os.getenv("NEAR_DUP_CACHE_DB")
+        )
+
+    @property
+    def enabled(self):
+        return self.max_distance >= 0
+
+    def get(self, image, namespace):
+        """The result cached for the nearest matching image in namespace, or None"""
+        if not self.enabled:
+            return None
+        value = dhash(image)
+        with self._lock:
+            tree = self._trees.get(namespace)
+            for _, entry_id in tree.search(value, self.max_distance) if tree else []:
+                _, _, result, created = self._entries[entry_id]
+                if time.time() - created > self.ttl_s:
+                    self._evict(entry_id)
+                    continue
+                self._entries.move_to_end(entry_id)
+                if self._db is not None:
+                    self._db.execute(
+                        "UPDATE near_duplicates SET last_used = ? WHERE id = ?", (time.time(), entry_id)
+                    )
+                    self._db.commit()
+                self.hits += 1
+                return result
+            self.misses += 1
+            return None
+
+    def put(self, image, namespace, result):
+        if not self.enabled:
+            return
+        value = dhash(image)
+        now = time.time()
+        with self._lock:
+            entry_id = self._next_id
+            self._remember(entry_id, namespace, value, result, now)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO near_duplicates (id, namespace, hash, result, created, last_used) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (entry_id, namespace, format(value, "x"), json.dumps(result), now, now)
+                )
+                self._db.commit()
+            while len(self._entries) > self.max_entries:
+                self._evict(next(iter(self._entries)))
+
+    def get_or_compute(self, image, namespace, compute):
+        result = self.get(image, namespace)
+        if result is None:
+            result = compute()
+            self.put(image, namespace, result)
+        return result
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def _remember(self, entry_id, namespace, value, result, created):
+        self._entries[entry_id] = (namespace, value, result, created)
+        self._trees.setdefault(namespace, BKTree()).add(value, entry_id)
+        self._next_id = max(self._next_id, entry_id + 1)
+
+    def _evict(self, entry_id):
+        namespace, value, _, _ = self._entries.pop(entry_id)
+        self._trees[namespace].remove(value, entry_id)
+        if self._db is not None:
+            self._db.execute("DELETE FROM near_duplicates WHERE id = ?", (entry_id,))
+            self._db.commit()
+
+    def _load(self):
+        """Reload the most recently used unexpired rows, oldest first so LRU order holds"""
+        self._db.execute("DELETE FROM near_duplicates WHERE created < ?", (time.time() - self.ttl_s,))
+        self._db.commit()
+        rows = self._db.execute(
+            "SELECT id, namespace, hash, result, created FROM near_duplicates "
+            "ORDER BY last_used DESC LIMIT ?", (self.max_entries,)
+        ).fetchall()
+        for entry_id, namespace, value, result, created in reversed(rows):
+            self._remember(entry_id, namespace, int(value, 16), json.loads(result), created)
+        max_id = self._db.execute("SELECT MAX(id) FROM near_duplicates").fetchone()[0]
+        if max_id is not None:
+            self._next_id = max(self._next_id, max_id + 1)
@@ -0,0 +1,181 @@
+# Local stand-in for the Gemini REST API, for offline benchmarks and tests
+#
+#   python fake_gemini.py --port 8765 --latency-ms 400 --chunk-ms 30 --error-rate 0.2
+#
+# Serves models/<name>:generateContent and :streamGenerateContent (JSON array, or
+# server-sent events with ?alt=sse) with a canned answer after a configurable
+# delay, and can answer a share of requests with 429 to exercise retries. Point
+# the client at it with GeminiClient(endpoint=url) or GEMINI_API_ENDPOINT=url.
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_REPLY = (
+    "## Ingredients\n\n"
+    "| Ingredient | Quantity |\n"
+    "|---|---|\n"
+    "| Spaghetti | 200 g |\n"
+    "| Tomato sauce | 150 ml |\n"
+    "| Parmesan | 20 g |\n"
+    "| Basil | 5 leaves |\n\n"
+    "Total calories: about 620 kcal."
+)
+
+_ROUTE = re.compile(r"^/v1beta/models/(?P<model>[^:/]+):(?P<method>generateContent|streamGenerateContent)")
+
+
+def response_body(text, prompt_tokens, finished=True):
+    """A GenerateContentResponse as the REST API serializes it"""
+    candidate = {"content": {"role": "model", "parts": [{"text": text}]}, "index": 0}
+    if finished:
+        candidate["finishReason"] = "STOP"
+    generated = max(1, len(text) // 4)
+    return {
+        "candidates": [candidate],
+        "usageMetadata": {
+            "promptTokenCount": prompt_tokens,
+            "candidatesTokenCount": generated,
+            "totalTokenCount": prompt_tokens + generated,
+        },
+    }
+
+
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        match = _ROUTE.match(self.path)
+        if match is None:
+            self.send_error(404, "unknown route")
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        server = self.server
+        rate_limited = server.count_request()
+        # Roughly what a prompt of this size would cost; images count as their base64 length
+        prompt_tokens = max(1, len(body) // 4)
+
+        time.sleep(server.latency_s)
+        if rate_limited:
+            self._send_rate_limited()
+            return
+        if match.group("method") == "generateContent":
+            self._send_json(response_body(server.reply, prompt_tokens))
+            return
+
+        # A streamed JSON array of responses, or one server-sent event per response
+        sse = "alt=sse" in self.path
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream" if sse else "application/json")
+        self.end_headers()
+        chunks = split_reply(server.reply, server.chunks)
+        if not sse:
+            self.wfile.write(b"[")
+        for index, chunk in enumerate(chunks):
+            if index:
+                time.sleep(server.chunk_s)
+                if not sse:
+                    self.wfile.write(b",")
+            last = index == len(chunks) - 1
+            payload = json.dumps(response_body(chunk, prompt_tokens, finished=last)).encode()
+            self.wfile.write(b"data: " + payload + b"\r\n\r\n" if sse else payload)
+            self.wfile.flush()
+        if not sse:
+            self.wfile.write(b"]")
+
+    def _send_rate_limited(self):
+        data = json.dumps({"error": {
+            "code": 429, "message": "Resource has been exhausted (e.g. check quota).", "status": "RESOURCE_EXHAUSTED"
+        }}).encode()
+        self.send_response(429)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        if self.server.retry_after_s is not None:
+            self.send_header("Retry-After", str(self.server.retry_after_s))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_json(self, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # Benchmarks issue many requests; keep stderr quiet
+        pass
+
+
+def split_reply(text, chunks):
+    """text in roughly equal pieces, split on whitespace"""
+    words = text.split(" ")
+    size = max(1, -(-len(words) // chunks))
+    return [" ".join(words[i:i + size]) + (" " if i + size < len(words) else "")
+            for i in range(0, len(words), size)]
+
+
+class FakeGeminiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency_ms=300, chunk_ms=20, chunks=8, reply=DEFAULT_REPLY,
+                 error_rate=0.0, fail_first=0, retry_after_s=None, seed=0):
+        super().__init__(address, FakeGeminiHandler)
+        self.latency_s = latency_ms / 1000
+        self.chunk_s = chunk_ms / 1000
+        self.chunks = chunks
+        self.reply = reply
+        # The first fail_first requests, then a random error_rate share, get a 429
+        self.error_rate = error_rate
+        self.fail_first = fail_first
+        self.retry_after_s = retry_after_s
+        self.requests = 0
+        self.rate_limited = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def count_request(self):
+        """Count a request; True when it should be answered with a 429"""
+        with self._lock:
+            self.requests += 1
+            limited = self.requests <= self.fail_first or self._random.random() < self.error_rate
+            self.rate_limited += limited
+            return limited
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+def start_fake_gemini(port=0, **options):
+    """Serve a FakeGeminiServer from a daemon thread; port=0 picks a free port"""
+    server = FakeGeminiServer(("127.0.0.1", port), **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a fake Gemini generateContent endpoint")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=300, help="delay before the first byte")
+    parser.add_argument("--chunk-ms", type=float, default=20, help="delay between streamed chunks")
+    parser.add_argument("--chunks", type=int, default=8, help="pieces a streamed answer is split into")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--fail-first", type=int, default=0, help="answer the first N requests with 429")
+    parser.add_argument("--retry-after-s", type=float, default=None, help="Retry-After header on 429s")
+    args = parser.parse_args()
+
+    server = FakeGeminiServer(
+        ("127.0.0.1", args.port), latency_ms=args.latency_ms, chunk_ms=args.chunk_ms, chunks=args.chunks,
+        error_rate=args.error_rate, fail_first=args.fail_first, retry_after_s=args.retry_after_s
+    )
+    print(f"fake Gemini endpoint on {server.url}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
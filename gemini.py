@@ -1,58 +1,193 @@
 import streamlit as st
-import google.generativeai as genai
 from PIL import Image
 import os
 from dotenv import load_dotenv
-import io
-import base64
+import hashlib
+import logging
+import time
 from prompt import SYSTEM_PROMPT
+from ui import render_jobs, render_debug_panel, track_job
+from metrics import trace, stage, record, current_trace
+from cache import NearDuplicateCache, image_digest
+from result_store import ResultStore, prompt_version
+from jobs import JobManager
+from gemini_client import IMAGE_PAYLOADS, build_request, response_text, shared_client
+from prompts import STRUCTURED_PROMPTS
+from structured import gemini_generation_config, parse_record
 
 # Load environment variables
 load_dotenv()
 
-# Configure Gemini API
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+logger = logging.getLogger(__name__)
+
+# Answers for re-encoded, rescaled or lightly cropped re-uploads, shared by all sessions
+NEAR_DUPLICATE_CACHE = NearDuplicateCache.from_env()
+
+# Every answer by image hash, model and prompt version when RESULT_STORE_DB is set
+RESULT_STORE = ResultStore.from_env()
+
+def record_usage(response, first_chunk_at=None):
+    """Token counts from a response (the last chunk when streaming) into the current trace"""
+    usage = response.get("usageMetadata")
+    if usage is None:
+        return
+    generated = usage.get("candidatesTokenCount", 0)
+    record(prompt_tokens=usage.get("promptTokenCount", 0), generated_tokens=generated)
+    if first_chunk_at is not None and generated > 1:
+        record(tokens_per_s=(generated - 1) / max(time.perf_counter() - first_chunk_at, 1e-9))
 
 class FoodAnalyzer:
-    def __init__(self):
-        self.model = genai.GenerativeModel('gemini-1.5-flash')
+    """Gemini analyses of a food image.
+
+    Pass image_id (cache.image_digest of the uploaded bytes) to the analysis
+    methods to read through the result store, which keeps answers across
+    restarts; near-duplicate images are answered from NEAR_DUPLICATE_CACHE.
+    """
+
+    def __init__(self, near_duplicates=True, client=None, store=None):
+        # Long-lived, rate-limited and retrying; shared by every analyzer in the process
+        self.client = client or shared_client()
+        # Answer near-duplicate images from NEAR_DUPLICATE_CACHE
+        self.near_duplicates = near_duplicates
+        self.store = store or RESULT_STORE
+
+    def _namespace(self, name, prompt):
+        return f"{self.client.model}:{name}:{hashlib.sha256(prompt.encode()).hexdigest()[:16]}"
+
+    def _cached(self, name, prompt, image, image_id=None):
+        if image_id is not None:
+            stored = self.store.get(image_id, name, self.client.model, prompt_version(prompt))
+            if stored is not None:
+                record(result_store_hit=True)
+                return stored
+        if not self.near_duplicates:
+            return None
+        cached = NEAR_DUPLICATE_CACHE.get(image, self._namespace(name, prompt))
+        if cached is not None:
+            record(near_duplicate_hit=True)
+        return cached
+
+    def _remember(self, name, prompt, image, text, image_id=None):
+        if image_id is not None:
+            request_trace = current_trace()
+            values = request_trace.values if request_trace is not None else {}
+            self.store.put(
+                image_id, name, self.client.model, prompt_version(prompt), text, image=image,
+                latency_s=time.perf_counter() - request_trace.started if request_trace is not None else None,
+                prompt_tokens=values.get("prompt_tokens"),
+                generated_tokens=values.get("generated_tokens")
+            )
+        if self.near_duplicates:
+            NEAR_DUPLICATE_CACHE.put(image, self._namespace(name, prompt), text)
+
+    def _request(self, name, prompt, image, generation_config=None, image_id=None):
+        """Request body with the image's cached upload payload; logs what it cost to send"""
+        with stage("encode_image"):
+            part, info = IMAGE_PAYLOADS.part(image, image_id)
+        record(upload_bytes=info["upload_bytes"], encode_s=info["encode_s"], payload_cache_hit=info["hit"])
+        logger.info(
+            "gemini.%s: uploading %d bytes, image %s in %.1f ms", name, info["upload_bytes"],
+            "reused" if info["hit"] else "encoded", info["encode_s"] * 1000
+        )
+        return build_request(prompt, part, generation_config)
+
+    def _generate(self, name, prompt, image, stream, image_id=None):
+        """generateContent timed into a metrics trace; a text generator when streaming.
+
+        Raises gemini_client.GeminiError once the client's retries are used up.
+        """
+        if stream:
+            return self._stream_text(name, prompt, image, image_id)
+        with trace(f"gemini.{name}"):
+            cached = self._cached(name, prompt, image, image_id)
+            if cached is not None:
+                return cached
+            with stage("generate_content"):
+                response = self.client.generate(self._request(name, prompt, image, image_id=image_id))
+            text = response_text(response)
+            record_usage(response)
+            self._remember(name, prompt, image, text, image_id)
+            return text
+
+    def _stream_text(self, name, prompt, image, image_id=None):
+        """Yield response text chunk by chunk as the client receives it; a failed stream raises"""
+        with trace(f"gemini.{name}") as request_trace:
+            cached = self._cached(name, prompt, image, image_id)
+            if cached is not None:
+                yield cached
+                return
+            body = self._request(name, prompt, image, image_id=image_id)
+            first_chunk_at = None
+            chunk = {}
+            pieces = []
+            with stage("stream"):
+                for chunk in self.client.stream(body):
+                    if first_chunk_at is None:
+                        first_chunk_at = time.perf_counter()
+                        record(ttft_s=first_chunk_at - request_trace.started)
+                    text = response_text(chunk)
+                    pieces.append(text)
+                    yield text
+            record_usage(chunk, first_chunk_at)
+            self._remember(name, prompt, image, "".join(pieces), image_id)
     
-    def get_calorie_count(self, image):
-        """Get calorie count of all food items in the image"""
-        try:
-            prompt = f"""{SYSTEM_PROMPT}
+    def _structured(self, name, analysis_type, image, image_id=None):
+        """A typed record (structured.py) from a JSON answer constrained to the analysis type's schema"""
+        with trace(f"gemini.{name}.json"):
+            prompt = STRUCTURED_PROMPTS[analysis_type]
+            text = self._cached(name, prompt, image, image_id)
+            if text is None:
+                with stage("generate_content"):
+                    response = self.client.generate(
+                        self._request(name, prompt, image, gemini_generation_config(analysis_type), image_id)
+                    )
+                text = response_text(response)
+                record_usage(response)
+                self._remember(name, prompt, image, text, image_id)
+            return parse_record(analysis_type, text)
+
+    def get_calorie_count(self, image, stream=False, structured=False, image_id=None):
+        """Get calorie count of all food items in the image.
+
+        With structured=True, returns a structured.NutritionRecord. A failed request raises GeminiError.
+        """
+        if structured:
+            return self._structured("calories", "nutrition", image, image_id)
+        prompt = f"""{SYSTEM_PROMPT}
 
 IMPORTANT: Please provide ONLY the calorie information for the food in this image. Answer this specific question only:
 
 "What is the calorie count of each food item visible in this image and what is the total calorie count?"
 
 Please list each food item with its estimated calories and provide the total calories. Do not provide any other information."""
-            
-            response = self.model.generate_content([prompt, image])
-            return response.text
-        except Exception as e:
-            return f"Error getting calorie count: {str(e)}"
+
+        return self._generate("calories", prompt, image, stream, image_id)
     
-    def get_ingredients(self, image):
-        """Get ingredients needed to make the food"""
-        try:
-            prompt = f"""{SYSTEM_PROMPT}
+    def get_ingredients(self, image, stream=False, structured=False, image_id=None):
+        """Get ingredients needed to make the food.
+
+        With structured=True, returns a structured.IngredientsRecord. A failed request raises GeminiError.
+        """
+        if structured:
+            return self._structured("ingredients", "ingredients", image, image_id)
+        prompt = f"""{SYSTEM_PROMPT}
 
 IMPORTANT: Please provide ONLY the ingredients information. Answer this specific question only:
 
 "What are all the ingredients needed to make this dish?"
 
 Please list only the ingredients with approximate quantities. Do not provide cooking instructions or other information."""
-            
-            response = self.model.generate_content([prompt, image])
-            return response.text
-        except Exception as e:
-            return f"Error getting ingredients: {str(e)}"
+
+        return self._generate("ingredients", prompt, image, stream, image_id)
     
-    def get_recipe(self, image):
-        """Get recipe for the food"""
-        try:
-            prompt = f"""{SYSTEM_PROMPT}
+    def get_recipe(self, image, stream=False, structured=False, image_id=None):
+        """Get recipe for the food.
+
+        With structured=True, returns a structured.RecipeRecord. A failed request raises GeminiError.
+        """
+        if structured:
+            return self._structured("recipe", "recipe", image, image_id)
+        prompt = f"""{SYSTEM_PROMPT}
 
 IMPORTANT: Please provide ONLY a detailed, comprehensive recipe. Answer this specific question only:
 
@@ -67,32 +202,35 @@ Please provide:
 6. Serving suggestions
 
 Make it detailed enough for a beginner to follow successfully. Do not provide calorie information or other details."""
-            
-            response = self.model.generate_content([prompt, image])
-            return response.text
-        except Exception as e:
-            return f"Error getting recipe: {str(e)}"
+
+        return self._generate("recipe", prompt, image, stream, image_id)
     
-    def analyze_food_image(self, image, user_question):
+    def analyze_food_image(self, image, user_question, stream=False, image_id=None):
         """
-        Analyze food image and answer only the specific user question
+        Analyze food image and answer only the specific user question.
+        With stream=True, returns a generator of text chunks instead of a string.
+        A failed request raises GeminiError.
         """
-        try:
-            # Use system prompt but focus only on the user's question
-            prompt = f"""{SYSTEM_PROMPT}
+        # Use system prompt but focus only on the user's question
+        prompt = f"""{SYSTEM_PROMPT}
 
 IMPORTANT: The user has asked a specific question. Please answer ONLY that question directly and concisely. Do not provide additional information unless specifically requested.
 
 User Question: {user_question}
 
 Please provide a focused answer to this question only."""
-            
-            # Generate response
-            response = self.model.generate_content([prompt, image])
-            return response.text
-        
-        except Exception as e:
-            return f"Error analyzing image: {str(e)}"
+
+        return self._generate("question", prompt, image, stream, image_id)
+
+@st.cache_resource
+def get_jobs():
+    # One pool for all sessions; the shared client bounds requests in flight
+    return JobManager()
+
+def submit(scope, slot, header, work, request=""):
+    """Run a request as a background job, shown under header in this session's slot"""
+    job = get_jobs().submit(f"{scope}:{slot}:{request}", work, label=slot)
+    track_job(scope, slot, header, job)
 
 def main():
     st.set_page_config(
@@ -116,7 +254,7 @@ def main():
     if uploaded_file is not None:
         image = Image.open(uploaded_file)
         st.image(image, caption="Uploaded Food Image", use_container_width=True)
-        st.session_state.uploaded_image = image
+        image_id = image_digest(uploaded_file.getvalue())
         
         # Initialize analyzer
         analyzer = FoodAnalyzer()
@@ -125,38 +263,35 @@ def main():
         col1, col2, col3 = st.columns(3)
         
         with col1:
-            if st.button("🔥 Get Calories", use_container_width=True):
-                with st.spinner("Calculating calories..."):
-                    result = analyzer.get_calorie_count(st.session_state.uploaded_image)
-                    st.session_state.calorie_result = result
+            calories_clicked = st.button("🔥 Get Calories", use_container_width=True)
         
         with col2:
-            if st.button("🥬 Get Ingredients", use_container_width=True):
-                with st.spinner("Identifying ingredients..."):
-                    result = analyzer.get_ingredients(st.session_state.uploaded_image)
-                    st.session_state.ingredients_result = result
+            ingredients_clicked = st.button("🥬 Get Ingredients", use_container_width=True)
         
         with col3:
-            if st.button("👨‍🍳 Get Recipe", use_container_width=True):
-                with st.spinner("Generating recipe..."):
-                    result = analyzer.get_recipe(st.session_state.uploaded_image)
-                    st.session_state.recipe_result = result
+            recipe_clicked = st.button("👨‍🍳 Get Recipe", use_container_width=True)
         
-        # Display results
-        if 'calorie_result' in st.session_state:
-            st.markdown("### 🔥 Calorie Count")
-            st.markdown(st.session_state.calorie_result)
-            st.markdown("---")
-        
-        if 'ingredients_result' in st.session_state:
-            st.markdown("### 🥬 Ingredients")
-            st.markdown(st.session_state.ingredients_result)
-            st.markdown("---")
-        
-        if 'recipe_result' in st.session_state:
-            st.markdown("### 👨‍🍳 Recipe")
-            st.markdown(st.session_state.recipe_result)
-            st.markdown("---")
+        # Analyses run as background jobs: reruns don't interrupt them and several can be in flight
+        run_all = st.button("⚡ Run All Three", use_container_width=True)
+        structured = st.checkbox(
+            "🧾 Structured output",
+            help="Answers come back as JSON in a fixed schema and are formatted here"
+        )
+        # Structured answers arrive whole; free-form ones stream
+        mode = "json" if structured else ""
+        if calories_clicked or run_all:
+            submit(image_id, "calories", "### 🔥 Calorie Count",
+                   (lambda: analyzer.get_calorie_count(image, structured=True, image_id=image_id).markdown()) if structured
+                   else lambda: analyzer.get_calorie_count(image, stream=True, image_id=image_id), mode)
+        if ingredients_clicked or run_all:
+            submit(image_id, "ingredients", "### 🥬 Ingredients",
+                   (lambda: analyzer.get_ingredients(image, structured=True, image_id=image_id).markdown()) if structured
+                   else lambda: analyzer.get_ingredients(image, stream=True, image_id=image_id), mode)
+        if recipe_clicked or run_all:
+            submit(image_id, "recipe", "### 👨‍🍳 Recipe",
+                   (lambda: analyzer.get_recipe(image, structured=True, image_id=image_id).markdown()) if structured
+                   else lambda: analyzer.get_recipe(image, stream=True, image_id=image_id), mode)
+        render_jobs(get_jobs(), image_id)
         
         # Custom question section
         st.subheader("💬 Ask Your Own Question")
@@ -169,16 +304,17 @@ def main():
         # Custom question analyze button
         if st.button("🤖 Ask Custom Question", type="primary", use_container_width=True):
             if user_question:
-                with st.spinner("Analyzing your question..."):
-                    result = analyzer.analyze_food_image(st.session_state.uploaded_image, user_question)
-                    st.markdown("### 🤖 Custom Analysis")
-                    st.markdown(result)
+                submit(f"{image_id}:question", "question", "### 🤖 Custom Analysis",
+                       lambda: analyzer.analyze_food_image(image, user_question, stream=True, image_id=image_id), user_question)
             else:
                 st.error("Please enter a question.")
+        render_jobs(get_jobs(), f"{image_id}:question")
     
     else:
         st.info("👆 Please upload a food image to get started!")
     
+    render_debug_panel(get_jobs())
+
     # Simple footer
     st.markdown("---")
     st.markdown("*Made with ❤️ using Gemini AI*")
@@ -0,0 +1,335 @@
+# Shared Gemini REST client for gemini.py and batch.py
+#
+# One long-lived client per process: a requests.Session keeps connections to the
+# API open, a token bucket keeps request starts under the per-minute quota, a
+# semaphore bounds requests in flight, and transient failures (429, 5xx, dropped
+# connections) are retried with jittered exponential backoff. The client runs its
+# own asyncio loop in a background thread, so synchronous callers such as a
+# Streamlit script can submit several requests at once and collect them as they
+# finish.
+
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from PIL import Image
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL = "gemini-1.5-flash"
+DEFAULT_ENDPOINT = "https://generativelanguage.googleapis.com"
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+class GeminiError(Exception):
+    """A request that failed for good: not retryable, or out of retries"""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class TokenBucket:
+    """Async token bucket: rate tokens per second, bursts of up to capacity"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def encode_image(image, max_edge=1024, image_format="JPEG", quality=85):
+    """image shrunk to max_edge on its long side and compressed; returns the encoded bytes"""
+    image = image.convert("RGB")
+    if max(image.size) > max_edge:
+        image.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_format, quality=quality)
+    return buffer.getvalue()
+
+
+class ImagePayloadCache:
+    """inline_data parts for recently seen images, so each upload is resized and encoded once.
+
+    Keyed by the upload's digest (cache.image_digest) when the caller has one,
+    so the fresh PIL object Streamlit opens on every rerun hits without being
+    decoded; otherwise by the image's pixels. Gemini bills an image at a fixed
+    token count, so beyond about a thousand pixels a larger upload mostly
+    costs bandwidth.
+    """
+
+    MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+    def __init__(self, max_edge=1024, image_format="JPEG", quality=85, max_entries=32):
+        image_format = image_format.upper()
+        if image_format not in self.MIME_TYPES:
+            raise ValueError(f"Unsupported upload format {image_format!r}; expected JPEG or WEBP")
+        self.max_edge = max_edge
+        self.image_format = image_format
+        self.quality = quality
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """Configured by GEMINI_IMAGE_MAX_EDGE, GEMINI_IMAGE_FORMAT and GEMINI_IMAGE_QUALITY"""
+        return cls(
+            max_edge=int(os.getenv("GEMINI_IMAGE_MAX_EDGE", "1024")),
+            image_format=os.getenv("GEMINI_IMAGE_FORMAT", "JPEG"),
+            quality=int(os.getenv("GEMINI_IMAGE_QUALITY", "85"))
+        )
+
+    def _key(self, image, image_id=None):
+        if image_id is not None:
+            return f"upload:{image_id}"
+        digest = hashlib.blake2b(image.tobytes(), digest_size=16).hexdigest()
+        return f"{image.mode}:{image.size[0]}x{image.size[1]}:{digest}"
+
+    def part(self, image, image_id=None):
+        """(inline_data part, info) where info has upload_bytes, encode_s and hit.
+
+        image_id is the digest of the uploaded bytes the image was decoded from.
+        """
+        started = time.perf_counter()
+        key = self._key(image, image_id)
+        with self._lock:
+            part = self._entries.get(key)
+            if part is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        hit = part is not None
+        if not hit:
+            data = encode_image(image, self.max_edge, self.image_format, self.quality)
+            part = {"inline_data": {
+                "mime_type": self.MIME_TYPES[self.image_format],
+                "data": base64.b64encode(data).decode()
+            }}
+            with self._lock:
+                self.misses += 1
+                self._entries[key] = part
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return part, {
+            "upload_bytes": len(part["inline_data"]["data"]),
+            "encode_s": time.perf_counter() - started,
+            "hit": hit,
+        }
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+IMAGE_PAYLOADS = ImagePayloadCache.from_env()
+
+
+def build_request(prompt, image_part, generation_config=None):
+    """generateContent request body for one text + image user turn; image_part from ImagePayloadCache.part()"""
+    body = {"contents": [{"role": "user", "parts": [{"text": prompt}, image_part]}]}
+    if generation_config:
+        body["generationConfig"] = generation_config
+    return body
+
+
+def response_text(response):
+    """Text of the first candidate of a (possibly partial) response"""
+    candidates = response.get("candidates") or []
+    if not candidates:
+        feedback = response.get("promptFeedback", {})
+        raise GeminiError(f"no answer returned (prompt feedback: {feedback})")
+    parts = candidates[0].get("content", {}).get("parts", [])
+    return "".join(part.get("text", "") for part in parts)
+
+
+def backoff_delay(attempt, base_s, max_s, retry_after=None):
+    """Full-range jitter around an exponential delay, or the server's Retry-After"""
+    if retry_after is not None:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return min(max_s, base_s * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+
+class GeminiClient:
+    """Rate-limited, retrying client for one Gemini model.
+
+    Settings default to GEMINI_API_KEY, GEMINI_API_ENDPOINT, GEMINI_RPM
+    (default 15 requests/minute) and GEMINI_MAX_CONCURRENCY (default 4).
+    """
+
+    def __init__(self, model=DEFAULT_MODEL, api_key=None, endpoint=None, requests_per_minute=None,
+                 max_concurrency=None, max_retries=5, base_delay_s=0.5, max_delay_s=30, timeout_s=120):
+        self.model = model
+        self.api_key = api_key if api_key is not None else os.getenv("GEMINI_API_KEY", "")
+        self.endpoint = (endpoint or os.getenv("GEMINI_API_ENDPOINT") or DEFAULT_ENDPOINT).rstrip("/")
+        self.requests_per_minute = requests_per_minute or float(os.getenv("GEMINI_RPM", "15"))
+        self.max_concurrency = max_concurrency or int(os.getenv("GEMINI_MAX_CONCURRENCY", "4"))
+        self.max_retries = max_retries
+        self.base_delay_s = base_delay_s
+        self.max_delay_s = max_delay_s
+        self.timeout_s = timeout_s
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_concurrency)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self._stats_lock = threading.Lock()
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="gemini-client", daemon=True)
+        self._thread.start()
+        # The limiter and semaphore belong to the client's loop
+        asyncio.run_coroutine_threadsafe(self._setup(), self._loop).result()
+
+    async def _setup(self):
+        rate = self.requests_per_minute / 60
+        self._bucket = TokenBucket(rate, capacity=max(1, self.max_concurrency))
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    def _url(self, method):
+        url = f"{self.endpoint}/v1beta/models/{self.model}:{method}"
+        return url + "?alt=sse" if method == "streamGenerateContent" else url
+
+    def _post(self, method, body, stream=False):
+        return self.session.post(
+            self._url(method),
+            json=body,
+            headers={"x-goog-api-key": self.api_key},
+            timeout=self.timeout_s,
+            stream=stream
+        )
+
+    def _count(self, **deltas):
+        with self._stats_lock:
+            for name, delta in deltas.items():
+                setattr(self, name, getattr(self, name) + delta)
+
+    async def _send(self, method, body, stream=False):
+        """POST with rate limiting, bounded concurrency and retries; returns the OK response"""
+        for attempt in range(self.max_retries + 1):
+            await self._bucket.acquire()
+            async with self._semaphore:
+                self._count(requests=1)
+                retry_after = None
+                try:
+                    response = await self._loop.run_in_executor(None, self._post, method, body, stream)
+                except requests.RequestException as e:
+                    status, error = None, e
+                else:
+                    if response.status_code < 400:
+                        return response
+                    status = response.status_code
+                    error = response.text[:300]
+                    retry_after = response.headers.get("Retry-After")
+                    response.close()
+                    if status not in RETRYABLE_STATUS:
+                        self._count(failures=1)
+                        raise GeminiError(f"HTTP {status}: {error}", status)
+
+            if attempt == self.max_retries:
+                self._count(failures=1)
+                raise GeminiError(f"gave up after {attempt + 1} attempts: {error}", status)
+            delay = backoff_delay(attempt, self.base_delay_s, self.max_delay_s, retry_after)
+            self._count(retries=1)
+            logger.warning("gemini %s: %s, retrying in %.2fs", method, status or error, delay)
+            await asyncio.sleep(delay)
+
+    async def generate_async(self, body):
+        """generateContent response as a dict"""
+        response = await self._send("generateContent", body)
+        return response.json()
+
+    def submit(self, body):
+        """Start a generateContent request; returns a concurrent.futures.Future of the response dict"""
+        return asyncio.run_coroutine_threadsafe(self.generate_async(body), self._loop)
+
+    def generate(self, body):
+        """Blocking generateContent"""
+        return self.submit(body).result()
+
+    def stream(self, body):
+        """Yield streamGenerateContent response chunks (dicts) as they arrive.
+
+        Retries only happen before the first chunk; a stream that breaks
+        midway raises.
+        """
+        chunks = queue.Queue()
+
+        async def produce():
+            try:
+                response = await self._send("streamGenerateContent", body, stream=True)
+                await self._loop.run_in_executor(None, self._read_events, response, chunks)
+            except Exception as e:
+                chunks.put(e)
+            finally:
+                chunks.put(None)
+
+        asyncio.run_coroutine_threadsafe(produce(), self._loop)
+        while True:
+            item = chunks.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    @staticmethod
+    def _read_events(response, chunks):
+        with response:
+            for line in response.iter_lines(decode_unicode=True):
+                if line and line.startswith("data:"):
+                    chunks.put(json.loads(line[len("data:"):]))
+
+    def stats(self):
+        with self._stats_lock:
+            return {"requests": self.requests, "retries": self.retries, "failures": self.failures}
+
+    def close(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self.session.close()
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_client():
+    """The process-wide client, created on first use"""
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = GeminiClient()
+        return _shared
@@ -0,0 +1,189 @@
+# Per-analysis generation profiles for the local VLMs
+#
+# Each analysis type gets its own token budget, stop strings and repetition
+# controls, and can end early once the last section its prompt asks for has been
+# written: models tend to keep going with closing remarks, a second summary or an
+# invented follow-up turn after the template is complete.
+
+import os
+import re
+from dataclasses import dataclass, replace
+
+import torch
+from transformers import StoppingCriteria
+
+# A model inventing the next chat turn
+COMMON_STOP_STRINGS = ("\nUser:", "\nHuman:", "\nuser\n")
+
+# Lines that still belong to the section they follow: bullets, numbered items,
+# table rows and bold labels
+_CONTINUATION = re.compile(r"^(?:[-*•|]|\d+[.)]\s|\*\*)")
+# Lines that open a new section whatever came before them
+_SECTION_BREAK = re.compile(r"^(?:---|#)")
+# A "Label: value" final line is content in itself
+_INLINE_VALUE = re.compile(r":\**\s*\w")
+
+
+@dataclass(frozen=True)
+class GenerationProfile:
+    max_new_tokens: int = 1024
+    stop_strings: tuple = COMMON_STOP_STRINGS
+    repetition_penalty: float = 1.0
+    no_repeat_ngram_size: int = 0
+    # Heading of the last section the prompt asks for; generation stops once it is complete
+    final_section: str = None
+
+    def generate_kwargs(self):
+        """Repetition controls for model.generate()"""
+        kwargs = {"max_new_tokens": self.max_new_tokens}
+        if self.repetition_penalty != 1.0:
+            kwargs["repetition_penalty"] = self.repetition_penalty
+        if self.no_repeat_ngram_size:
+            kwargs["no_repeat_ngram_size"] = self.no_repeat_ngram_size
+        return kwargs
+
+
+# Budgets sized to the templates in prompts.py. Nutrition is mostly one table of
+# numbers, which a repetition penalty would push off the correct values.
+PROFILES = {
+    "ingredients": GenerationProfile(
+        max_new_tokens=768, repetition_penalty=1.05, final_section=r"Cuisine Type"
+    ),
+    "recipe": GenerationProfile(
+        max_new_tokens=1024, repetition_penalty=1.05, final_section=r"Pro Tips"
+    ),
+    "nutrition": GenerationProfile(
+        max_new_tokens=640, final_section=r"Confidence Level"
+    ),
+    "general": GenerationProfile(
+        max_new_tokens=384, repetition_penalty=1.1
+    ),
+    "full report": GenerationProfile(
+        max_new_tokens=2048, repetition_penalty=1.05, final_section=r"===\s*NUTRITION\s*===(?:.|\n)*?Confidence Level"
+    ),
+    # Structured mode (structured.py): a JSON answer ends at its closing brace, and
+    # its keys repeat by design, so there is no section stopping or repetition penalty
+    "ingredients:json": GenerationProfile(max_new_tokens=512),
+    "recipe:json": GenerationProfile(max_new_tokens=768),
+    "nutrition:json": GenerationProfile(max_new_tokens=384),
+}
+DEFAULT_PROFILE = GenerationProfile()
+
+
+def _budget_overrides():
+    """GENERATION_BUDGETS, e.g. "ingredients=512,recipe=900", as {analysis type: tokens}"""
+    overrides = {}
+    for item in os.getenv("GENERATION_BUDGETS", "").split(","):
+        name, _, tokens = item.partition("=")
+        if name.strip() and tokens.strip():
+            overrides[name.strip()] = int(tokens)
+    return overrides
+
+
+_BUDGET_OVERRIDES = _budget_overrides()
+
+
+def profile_for(analysis_type, max_new_tokens=None):
+    """The profile for an analysis type; max_new_tokens, if given, replaces its budget"""
+    profile = PROFILES.get(analysis_type, DEFAULT_PROFILE)
+    budget = max_new_tokens or _BUDGET_OVERRIDES.get(analysis_type)
+    return replace(profile, max_new_tokens=budget) if budget else profile
+
+
+def final_section_end(text, final_section):
+    """Offset where the final section's content ends, or None while it is still being written.
+
+    The section ends at a horizontal rule or heading, or at the first line after
+    a blank line that is not a bullet, numbered item or table row. A final
+    section written as one "Label: value" line ends after that line. A line is
+    judged once it is complete or has three characters, so at most a token or
+    two of what follows is generated.
+    """
+    match = re.search(final_section, text, re.IGNORECASE)
+    if match is None:
+        return None
+    heading_end = text.find("\n", match.end())
+    if heading_end < 0:
+        return None
+
+    seen_content = bool(_INLINE_VALUE.search(text[match.end():heading_end]))
+    after_blank = False
+    position = heading_end + 1
+    while position < len(text):
+        line_end = text.find("\n", position)
+        complete = line_end >= 0
+        line = text[position:line_end if complete else len(text)]
+        stripped = line.strip()
+        if not complete and len(stripped) < 3:
+            return None
+        if not stripped:
+            after_blank = seen_content
+        elif seen_content and (_SECTION_BREAK.match(stripped) or (after_blank and not _CONTINUATION.match(stripped))):
+            return position
+        else:
+            seen_content = True
+            after_blank = False
+        if not complete:
+            return None
+        position = line_end + 1
+    return None
+
+
+def finish_text(text, profile):
+    """The answer cut at the first stop string or at the end of the final section"""
+    cut = len(text)
+    for stop in profile.stop_strings:
+        index = text.find(stop)
+        if index >= 0:
+            cut = min(cut, index)
+    if profile.final_section:
+        end = final_section_end(text[:cut], profile.final_section)
+        if end is not None:
+            cut = end
+    return text[:cut].rstrip() if cut < len(text) else text
+
+
+class SectionStoppingCriteria(StoppingCriteria):
+    """Stops each sequence of a generation at a stop string or once its final section is complete.
+
+    Tokens are decoded one at a time as they arrive, so each check only scans
+    the text generated so far rather than re-decoding the whole sequence. With
+    left-padded batches every row's prompt ends at prompt_length; finished rows
+    stay finished while the others go on. text and reason are the first row's.
+    """
+
+    def __init__(self, tokenizer, prompt_length, profile):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.profile = profile
+        self.decoded_length = prompt_length
+        self.texts = []
+        self.reasons = []
+
+    @property
+    def text(self):
+        return self.texts[0] if self.texts else ""
+
+    @property
+    def reason(self):
+        return self.reasons[0] if self.reasons else None
+
+    def _reason(self, text):
+        if any(stop in text for stop in self.profile.stop_strings):
+            return "stop_string"
+        if self.profile.final_section and final_section_end(text, self.profile.final_section) is not None:
+            return "final_section"
+        return None
+
+    def __call__(self, input_ids, scores=None, **kwargs):
+        if not self.texts:
+            self.texts = [""] * input_ids.shape[0]
+            self.reasons = [None] * input_ids.shape[0]
+        new_ids = input_ids[:, self.decoded_length:]
+        self.decoded_length = input_ids.shape[1]
+        for row, ids in enumerate(new_ids):
+            if self.reasons[row] is None:
+                self.texts[row] += self.tokenizer.decode(ids, skip_special_tokens=True)
+                self.reasons[row] = self._reason(self.texts[row])
+        done = [reason is not None for reason in self.reasons]
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
@@ -0,0 +1,145 @@
+# Background analysis jobs shared by the Streamlit apps
+#
+# Streamlit reruns the whole script on every widget interaction, so a generation
+# started inside a button handler is abandoned or repeated. Here analyses run on
+# a shared thread pool instead; a session keeps only job ids in st.session_state
+# and polls them (ui.render_jobs) until they finish. Submitting a key that is
+# already running returns the running job, so double clicks and other sessions
+# asking the same thing share one generation.
+
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import last_trace
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    """One submitted analysis; text grows as chunks arrive.
+
+    trace is the metrics trace the work finished on the job's thread, if any.
+    """
+
+    def __init__(self, job_id, key, label):
+        self.id = job_id
+        self.key = key
+        self.label = label
+        self.text = ""
+        self.error = None
+        self.trace = None
+        self.submitted = time.time()
+        self.finished = None
+        self.done = threading.Event()
+
+    @property
+    def status(self):
+        if not self.done.is_set():
+            return "running"
+        return "failed" if self.error is not None else "done"
+
+    def as_dict(self):
+        return {
+            "id": self.id,
+            "key": self.key,
+            "label": self.label,
+            "status": self.status,
+            "error": self.error,
+            "elapsed_s": (self.finished or time.time()) - self.submitted,
+        }
+
+
+class JobManager:
+    """Runs work() callables on a shared pool, one job per key at a time.
+
+    work returns the answer as a string or as an iterable of text chunks; a
+    chunked answer is visible on job.text while it is generated. Jobs in the
+    same group (e.g. one local model without a batching scheduler) run one at
+    a time, since concurrent generate() calls on one model are not safe.
+    Finished jobs are kept until max_finished newer ones have completed.
+    """
+
+    def __init__(self, max_workers=None, max_finished=256):
+        self.max_workers = max_workers or int(os.getenv("JOB_WORKERS", "4"))
+        self.max_finished = max_finished
+        self.submitted = 0
+        self.coalesced = 0
+        self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="analysis-job")
+        self._ids = itertools.count(1)
+        self._jobs = {}
+        self._running = {}
+        self._finished = OrderedDict()
+        self._groups = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, work, label="", group=None):
+        """Start work() in the background, or return the job already running for key"""
+        with self._lock:
+            running = self._running.get(key)
+            if running is not None:
+                self.coalesced += 1
+                return running
+            job = Job(f"job-{next(self._ids)}", key, label)
+            self._jobs[job.id] = job
+            self._running[key] = job
+            self.submitted += 1
+        group_lock = self.group_lock(group) if group is not None else None
+        self._executor.submit(self._run, job, work, group_lock)
+        return job
+
+    def group_lock(self, group):
+        """The lock jobs in group hold while they run, for work on the same model outside a job"""
+        with self._lock:
+            return self._groups.setdefault(group, threading.Lock())
+
+    def get(self, job_id):
+        """The job with this id, or None once it has been pruned"""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _run(self, job, work, group_lock):
+        # Pool threads are reused; a trace from an earlier job is not this one's
+        before = last_trace()
+        try:
+            if group_lock is not None:
+                group_lock.acquire()
+            try:
+                result = work()
+                if isinstance(result, str):
+                    job.text = result
+                else:
+                    for chunk in result:
+                        job.text += chunk
+            finally:
+                if group_lock is not None:
+                    group_lock.release()
+        except Exception as e:
+            logger.exception("job %s (%s) failed", job.id, job.key)
+            job.error = str(e)
+        finished_trace = last_trace()
+        job.trace = finished_trace if finished_trace is not before else None
+        job.finished = time.time()
+        with self._lock:
+            self._running.pop(job.key, None)
+            self._finished[job.id] = job
+            while len(self._finished) > self.max_finished:
+                expired, _ = self._finished.popitem(last=False)
+                self._jobs.pop(expired, None)
+        job.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "running": len(self._running),
+                "finished": len(self._finished),
+                "submitted": self.submitted,
+                "coalesced": self.coalesced,
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
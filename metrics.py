@@ -0,0 +1,208 @@
+# Request tracing and aggregate metrics for the inference paths
+#
+# A trace covers one request (a validation, an analysis, a Gemini call) and stage()
+# times the steps inside it. Finished traces feed process-wide counters and
+# histograms that export as Prometheus text or JSON.
+
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 384, 512, 768, 1024, 1536, 2048)
+
+TOKEN_KINDS = ("prompt_tokens", "visual_tokens", "generated_tokens")
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus sense"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "buckets": {str(bound): count for bound, count in zip(self.buckets, self.counts)},
+        }
+
+    def prometheus_lines(self, name, labels):
+        lines = []
+        for bound, count in zip(self.buckets, self.counts):
+            lines.append(f'{name}_bucket{{{labels}le="{bound}"}} {count}')
+        lines.append(f'{name}_bucket{{{labels}le="+Inf"}} {self.count}')
+        label_set = "{" + labels.rstrip(",") + "}" if labels else ""
+        lines.append(f"{name}_sum{label_set} {self.sum}")
+        lines.append(f"{name}_count{label_set} {self.count}")
+        return lines
+
+
+class Trace:
+    """Stage timings and token counts for one request"""
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.total_s = None
+        self.stages = {}
+        self.values = {}
+
+    def add_stage(self, stage_name, seconds):
+        self.stages[stage_name] = self.stages.get(stage_name, 0.0) + seconds
+
+    def finish(self):
+        self.total_s = time.perf_counter() - self.started
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "total_s": self.total_s,
+            "stages": dict(self.stages),
+            **self.values,
+        }
+
+
+class Metrics:
+    """Process-wide aggregates of finished traces"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = {}
+        self.tokens = dict.fromkeys(TOKEN_KINDS, 0)
+        self.request_seconds = {}
+        self.stage_seconds = {}
+        self.ttft_seconds = Histogram(STAGE_BUCKETS)
+        self.tokens_per_second = Histogram(RATE_BUCKETS)
+        # Per request name, to tune the per-analysis token budgets
+        self.generated_tokens = {}
+        self.stop_reasons = {}
+
+    def observe(self, trace):
+        with self._lock:
+            self.requests[trace.name] = self.requests.get(trace.name, 0) + 1
+            self.request_seconds.setdefault(trace.name, Histogram(STAGE_BUCKETS)).observe(trace.total_s)
+            for stage_name, seconds in trace.stages.items():
+                self.stage_seconds.setdefault(stage_name, Histogram(STAGE_BUCKETS)).observe(seconds)
+            for kind in TOKEN_KINDS:
+                self.tokens[kind] += int(trace.values.get(kind, 0))
+            if "ttft_s" in trace.values:
+                self.ttft_seconds.observe(trace.values["ttft_s"])
+            if trace.values.get("tokens_per_s"):
+                self.tokens_per_second.observe(trace.values["tokens_per_s"])
+            if "generated_tokens" in trace.values:
+                self.generated_tokens.setdefault(trace.name, Histogram(TOKEN_BUCKETS)).observe(
+                    trace.values["generated_tokens"]
+                )
+            if "stop_reason" in trace.values:
+                key = (trace.name, trace.values["stop_reason"])
+                self.stop_reasons[key] = self.stop_reasons.get(key, 0) + 1
+
+    def as_json(self):
+        with self._lock:
+            return {
+                "requests": dict(self.requests),
+                "tokens": dict(self.tokens),
+                "request_seconds": {name: h.as_dict() for name, h in self.request_seconds.items()},
+                "stage_seconds": {name: h.as_dict() for name, h in self.stage_seconds.items()},
+                "ttft_seconds": self.ttft_seconds.as_dict(),
+                "tokens_per_second": self.tokens_per_second.as_dict(),
+                "generated_tokens": {name: h.as_dict() for name, h in self.generated_tokens.items()},
+                "stop_reasons": {f"{name}.{reason}": count for (name, reason), count in self.stop_reasons.items()},
+            }
+
+    def prometheus_text(self):
+        with self._lock:
+            lines = ["# TYPE food_requests_total counter"]
+            for name, count in self.requests.items():
+                lines.append(f'food_requests_total{{request="{name}"}} {count}')
+            lines.append("# TYPE food_tokens_total counter")
+            for kind, count in self.tokens.items():
+                lines.append(f'food_tokens_total{{kind="{kind}"}} {count}')
+            lines.append("# TYPE food_request_seconds histogram")
+            for name, histogram in self.request_seconds.items():
+                lines += histogram.prometheus_lines("food_request_seconds", f'request="{name}",')
+            lines.append("# TYPE food_stage_seconds histogram")
+            for name, histogram in self.stage_seconds.items():
+                lines += histogram.prometheus_lines("food_stage_seconds", f'stage="{name}",')
+            lines.append("# TYPE food_ttft_seconds histogram")
+            lines += self.ttft_seconds.prometheus_lines("food_ttft_seconds", "")
+            lines.append("# TYPE food_decode_tokens_per_second histogram")
+            lines += self.tokens_per_second.prometheus_lines("food_decode_tokens_per_second", "")
+            lines.append("# TYPE food_generated_tokens histogram")
+            for name, histogram in self.generated_tokens.items():
+                lines += histogram.prometheus_lines("food_generated_tokens", f'request="{name}",')
+            lines.append("# TYPE food_stop_reason_total counter")
+            for (name, reason), count in self.stop_reasons.items():
+                lines.append(f'food_stop_reason_total{{request="{name}",reason="{reason}"}} {count}')
+            return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+_current = contextvars.ContextVar("current_trace", default=None)
+_last = threading.local()
+
+
+@contextmanager
+def trace(name):
+    """Trace one request; nested calls join the enclosing trace"""
+    current = _current.get()
+    if current is not None:
+        yield current
+        return
+
+    request_trace = Trace(name)
+    token = _current.set(request_trace)
+    try:
+        yield request_trace
+    finally:
+        try:
+            _current.reset(token)
+        except ValueError:
+            # A streaming generator closed from another context
+            _current.set(None)
+        request_trace.finish()
+        METRICS.observe(request_trace)
+        _last.trace = request_trace
+
+
+@contextmanager
+def stage(name):
+    """Add the time spent in the block to the current trace, if any"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        current = _current.get()
+        if current is not None:
+            current.add_stage(name, time.perf_counter() - start)
+
+
+def record(**values):
+    """Attach values (token counts, TTFT, ...) to the current trace, if any"""
+    current = _current.get()
+    if current is not None:
+        current.values.update(values)
+
+
+def current_trace():
+    return _current.get()
+
+
+def last_trace():
+    """The most recent trace finished on this thread; analyses run as jobs keep theirs on jobs.Job.trace"""
+    return getattr(_last, "trace", None)
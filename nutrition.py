@@ -0,0 +1,320 @@
+# Nutrition computed from a local nutrient table instead of generated by the model
+#
+# The ingredients analysis already lists every ingredient with an estimated
+# quantity. Each one is resolved to a row of data/nutrients.csv (per-100 g values)
+# through a character-trigram index that tolerates plurals, word order and
+# descriptors such as "thinly sliced", its quantity is converted to grams, and
+# per-item and total nutrients are one matrix product. That takes milliseconds,
+# gives the same numbers for the same ingredient list every time, and spares
+# the model the hundreds of tokens of a generated nutrition table.
+
+import csv
+import os
+import re
+import threading
+from dataclasses import dataclass, field
+
+import numpy as np
+
+NUTRIENT_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "nutrients.csv")
+NUTRIENTS = ("kcal", "protein_g", "carbs_g", "fat_g", "fiber_g", "sugar_g", "sodium_mg")
+
+# Minimum Dice similarity of trigram sets for an ingredient to count as matched
+MATCH_THRESHOLD = 0.45
+
+# Words that describe preparation rather than the ingredient
+_DESCRIPTORS = {
+    "fresh", "freshly", "chopped", "sliced", "diced", "minced", "grated", "crushed", "finely",
+    "thinly", "roughly", "boneless", "skinless", "raw", "organic", "optional", "large", "small",
+    "medium", "pieces", "piece", "marinated", "peeled", "soaked", "pre", "halved", "cubed",
+}
+
+# Grams or a reference unit per unit word; cup-based units scale with each food's g_per_cup
+_UNITS = {
+    "mg": ("g", 0.001), "g": ("g", 1), "gm": ("g", 1), "gms": ("g", 1), "gram": ("g", 1), "grams": ("g", 1),
+    "kg": ("g", 1000), "kilogram": ("g", 1000), "kilograms": ("g", 1000),
+    "oz": ("g", 28.35), "ounce": ("g", 28.35), "ounces": ("g", 28.35),
+    "lb": ("g", 453.6), "lbs": ("g", 453.6), "pound": ("g", 453.6), "pounds": ("g", 453.6),
+    "ml": ("ml", 1), "milliliter": ("ml", 1), "milliliters": ("ml", 1),
+    "l": ("ml", 1000), "liter": ("ml", 1000), "liters": ("ml", 1000), "litre": ("ml", 1000),
+    "tsp": ("cup", 1 / 48), "teaspoon": ("cup", 1 / 48), "teaspoons": ("cup", 1 / 48),
+    "tbsp": ("cup", 1 / 16), "tbs": ("cup", 1 / 16), "tablespoon": ("cup", 1 / 16), "tablespoons": ("cup", 1 / 16),
+    "cup": ("cup", 1), "cups": ("cup", 1),
+    "pinch": ("g", 0.35), "pinches": ("g", 0.35), "dash": ("g", 0.6), "handful": ("g", 30),
+    "sprig": ("g", 1), "sprigs": ("g", 1), "bunch": ("g", 100), "can": ("g", 400), "cans": ("g", 400),
+    "piece": ("piece", 1), "pieces": ("piece", 1), "pc": ("piece", 1), "pcs": ("piece", 1),
+    "whole": ("piece", 1), "clove": ("piece", 1), "cloves": ("piece", 1), "slice": ("piece", 1),
+    "slices": ("piece", 1), "leaf": ("piece", 1), "leaves": ("piece", 1), "pod": ("piece", 1),
+    "pods": ("piece", 1), "stalk": ("piece", 1), "stalks": ("piece", 1), "fillet": ("piece", 1),
+    "fillets": ("piece", 1), "breast": ("piece", 1), "breasts": ("piece", 1), "stick": ("piece", 1),
+    "small": ("piece", 0.7), "medium": ("piece", 1), "large": ("piece", 1.3),
+}
+_WORD_AMOUNTS = {"a": 1, "an": 1, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6,
+                 "half": 0.5, "few": 3, "couple": 2, "some": 1}
+_FRACTIONS = {"½": 0.5, "⅓": 1 / 3, "⅔": 2 / 3, "¼": 0.25, "¾": 0.75, "⅛": 0.125}
+_NUMBER = r"\d+(?:\.\d+)?(?:\s*/\s*\d+)?"
+_AMOUNT = re.compile(rf"^({_NUMBER}(?:\s+{_NUMBER})?)(?:\s*(?:-|–|to)\s*({_NUMBER}))?")
+
+
+def normalize_name(name):
+    """Lowercased ingredient name without parentheticals, notes after a comma or descriptors"""
+    name = re.sub(r"\(.*?\)", " ", name.lower())
+    name = name.split(",")[0]
+    words = re.findall(r"[a-z]+", name)
+    kept = [word for word in words if word not in _DESCRIPTORS]
+    return " ".join(kept or words)
+
+
+def _trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _number(text):
+    whole, _, fraction = text.strip().partition(" ")
+    if "/" in whole:
+        numerator, denominator = whole.split("/")
+        return float(numerator) / float(denominator)
+    return float(whole) + (_number(fraction) if fraction else 0)
+
+
+def parse_quantity(text):
+    """(amount, unit word or None) for a quantity such as "1 1/2 cups", "200g" or "2-3 cloves".
+
+    Ranges give their midpoint and spelled-out amounts ("a few sprigs") their
+    usual value. A package size in parentheses counts per package, so
+    "2 (14 oz) cans" is 28 oz; other parentheticals are ignored. Returns None
+    for "to taste" and anything without an amount.
+    """
+    text = text.lower().split(",")[0].strip()
+    for symbol, value in _FRACTIONS.items():
+        text = re.sub(rf"(\d)\s*{symbol}", lambda m: f"{m.group(1)} {value}", text).replace(symbol, str(value))
+    text = re.sub(r"(\d) (0\.\d+)", lambda m: str(float(m.group(1)) + float(m.group(2))), text)
+    if not text or "taste" in text:
+        return None
+
+    match = _AMOUNT.match(text)
+    if match:
+        amount = _number(re.sub(r"\s*/\s*", "/", match.group(1)))
+        if match.group(2):
+            amount = (amount + _number(re.sub(r"\s*/\s*", "/", match.group(2)))) / 2
+        rest = text[match.end():]
+    else:
+        words = text.split()
+        amounts = [_WORD_AMOUNTS[word] for word in words[:2] if word in _WORD_AMOUNTS]
+        if not amounts:
+            return None
+        amount = amounts[-1] if words[0] in ("a", "an") and len(amounts) > 1 else amounts[0]
+        rest = " ".join(words[len(amounts):])
+
+    package = re.match(r"\s*\((.*?)\)", rest)
+    if package:
+        size = parse_quantity(package.group(1))
+        if size is not None and size[1] is not None and _UNITS[size[1]][0] != "piece":
+            return amount * size[0], size[1]
+    units = [word for word in re.findall(r"[a-z]+", re.sub(r"\(.*?\)", " ", rest)) if word in _UNITS]
+    return amount, units[0] if units else None
+
+
+@dataclass
+class IngredientLine:
+    name: str
+    quantity: str
+    grams: float = None
+
+
+@dataclass
+class ItemNutrition:
+    name: str
+    quantity: str
+    food: str
+    grams: float
+    nutrients: dict
+
+
+@dataclass
+class NutritionResult:
+    items: list
+    totals: dict
+    # (ingredient name, why it was left out)
+    skipped: list = field(default_factory=list)
+
+    def markdown(self):
+        """The result as a nutrition table with a totals row, for the result panels"""
+        lines = [
+            "| Food Item | Quantity | Matched As | Weight (g) | Calories | Carbs (g) | Protein (g) | Fat (g) |",
+            "|-----------|----------|------------|------------|----------|-----------|-------------|---------|",
+        ]
+        for item in self.items:
+            n = item.nutrients
+            lines.append(
+                f"| {item.name} | {item.quantity} | {item.food} | {item.grams:.0f} | {n['kcal']:.0f} "
+                f"| {n['carbs_g']:.1f} | {n['protein_g']:.1f} | {n['fat_g']:.1f} |"
+            )
+        t = self.totals
+        lines.append(
+            f"| **Total** | | | **{sum(item.grams for item in self.items):.0f}** | **{t['kcal']:.0f}** "
+            f"| **{t['carbs_g']:.1f}** | **{t['protein_g']:.1f}** | **{t['fat_g']:.1f}** |"
+        )
+        lines += [
+            "",
+            f"**Also:** fiber {t['fiber_g']:.1f} g, sugar {t['sugar_g']:.1f} g, sodium {t['sodium_mg']:.0f} mg",
+            "",
+            "*Computed from the ingredient quantities in the ingredients analysis and a local nutrient "
+            "table (values per 100 g); totals are for the quantities listed.*",
+        ]
+        if self.skipped:
+            lines += ["", "**Not counted:** " + "; ".join(f"{name} ({reason})" for name, reason in self.skipped)]
+        return "\n".join(lines)
+
+
+class NutrientDB:
+    """Nutrient table held as arrays, with a trigram index over food names and aliases"""
+
+    def __init__(self, path=NUTRIENT_DB_PATH, threshold=MATCH_THRESHOLD):
+        self.threshold = threshold
+        with open(path, newline="") as f:
+            rows = list(csv.DictReader(f))
+        self.names = [row["name"] for row in rows]
+        self.values = np.array([[float(row[n] or 0) for n in NUTRIENTS] for row in rows], dtype=np.float32)
+        self.g_per_piece = np.array([float(row["g_per_piece"] or "nan") for row in rows])
+        self.g_per_cup = np.array([float(row["g_per_cup"] or "nan") for row in rows])
+
+        # One index entry per name or alias, pointing back at its food row
+        self._entry_food = []
+        self._entry_sizes = []
+        self._postings = {}
+        for food, row in enumerate(rows):
+            for alias in [row["name"]] + [a for a in row["aliases"].split(";") if a]:
+                entry = len(self._entry_food)
+                grams = _trigrams(normalize_name(alias))
+                self._entry_food.append(food)
+                self._entry_sizes.append(len(grams))
+                for gram in grams:
+                    self._postings.setdefault(gram, []).append(entry)
+        self._entry_food = np.array(self._entry_food)
+        self._entry_sizes = np.array(self._entry_sizes)
+        self._postings = {gram: np.array(entries) for gram, entries in self._postings.items()}
+
+    def match(self, name):
+        """(food row, similarity) for the closest food to an ingredient name, or (None, best similarity)"""
+        grams = _trigrams(normalize_name(name))
+        shared = np.zeros(len(self._entry_food))
+        for gram in grams:
+            entries = self._postings.get(gram)
+            if entries is not None:
+                shared[entries] += 1
+        scores = 2 * shared / (len(grams) + self._entry_sizes)
+        best = int(scores.argmax())
+        if scores[best] < self.threshold:
+            return None, float(scores[best])
+        return int(self._entry_food[best]), float(scores[best])
+
+    def grams(self, food, quantity):
+        """Weight in grams of a quantity of a food, or None if it cannot be converted"""
+        parsed = parse_quantity(quantity)
+        if parsed is None:
+            return None
+        amount, unit = parsed
+        kind, factor = _UNITS[unit] if unit else ("piece", 1)
+        if kind == "g":
+            return amount * factor
+        cup = self.g_per_cup[food]
+        if kind == "ml":
+            return amount * factor * (cup / 240 if not np.isnan(cup) else 1)
+        if kind == "cup":
+            return amount * factor * (cup if not np.isnan(cup) else 240)
+        piece = self.g_per_piece[food]
+        return None if np.isnan(piece) else amount * factor * piece
+
+    def compute(self, ingredients):
+        """NutritionResult for IngredientLines; unmatched or unweighable ones are listed as skipped"""
+        matched, skipped = [], []
+        for line in ingredients:
+            food, _ = self.match(line.name)
+            if food is None:
+                skipped.append((line.name, "not in the nutrient table"))
+                continue
+            grams = line.grams if line.grams is not None else self.grams(food, line.quantity)
+            if grams is None:
+                skipped.append((line.name, f"no weight for {line.quantity!r}"))
+                continue
+            matched.append((line, food, grams))
+
+        foods = np.array([food for _, food, _ in matched], dtype=int)
+        grams = np.array([g for _, _, g in matched], dtype=np.float32)
+        per_item = grams[:, None] / 100 * self.values[foods]
+        totals = per_item.sum(axis=0) if len(matched) else np.zeros(len(NUTRIENTS))
+        items = [
+            ItemNutrition(line.name, line.quantity, self.names[food], float(g), dict(zip(NUTRIENTS, map(float, row))))
+            for (line, food, g), row in zip(matched, per_item)
+        ]
+        return NutritionResult(items, dict(zip(NUTRIENTS, map(float, totals))), skipped)
+
+
+def _cells(line):
+    return [cell.strip().strip("*").strip() for cell in line.strip().strip("|").split("|")]
+
+
+def _column(header, *words):
+    for index, cell in enumerate(header):
+        if any(word in cell.lower() for word in words):
+            return index
+    return None
+
+
+def parse_ingredients(text):
+    """IngredientLines from the markdown tables of an ingredients analysis.
+
+    Reads every table with an ingredient name column and a quantity column
+    (the ingredients and spices tables); a weight column in grams, if present,
+    is used as is. Placeholder rows ("...") are ignored.
+    """
+    ingredients = []
+    name_col = quantity_col = grams_col = None
+    for line in text.splitlines():
+        if not line.strip().startswith("|"):
+            name_col = quantity_col = None
+            continue
+        cells = _cells(line)
+        if set("".join(cells)) <= set("-: "):
+            continue
+        if name_col is None:
+            name_col = _column(cells, "name", "ingredient", "item", "spice")
+            quantity_col = _column(cells, "quantity", "amount", "portion")
+            grams_col = _column(cells, "gram", "(g)", "weight")
+            if quantity_col is None:
+                name_col = None
+            continue
+        if max(name_col, quantity_col) >= len(cells):
+            continue
+        name, quantity = cells[name_col], cells[quantity_col]
+        if not name or name.strip(". …") == "":
+            continue
+        grams = None
+        if grams_col is not None and grams_col < len(cells):
+            found = re.search(r"\d+(?:\.\d+)?", cells[grams_col])
+            grams = float(found.group()) if found else None
+        ingredients.append(IngredientLine(name, quantity, grams))
+    return ingredients
+
+
+_default_db = None
+_default_db_lock = threading.Lock()
+
+
+def nutrient_db():
+    """The bundled table (or NUTRIENT_DB_CSV), loaded on first use"""
+    global _default_db
+    with _default_db_lock:
+        if _default_db is None:
+            _default_db = NutrientDB(os.getenv("NUTRIENT_DB_CSV", NUTRIENT_DB_PATH))
+        return _default_db
+
+
+def nutrition_report(ingredients_text):
+    """Markdown nutrition table computed from an ingredients analysis"""
+    ingredients = parse_ingredients(ingredients_text)
+    if not ingredients:
+        return "_No ingredient table with quantities was found in the ingredients analysis._"
+    return nutrient_db().compute(ingredients).markdown()
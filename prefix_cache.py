@@ -0,0 +1,169 @@
+# Prefix KV cache for the static system prompts in prompts.py
+# Every request starts with the same chat-template system turn, so its keys/values
+# are computed once per loaded model and only the image/user segment is prefilled.
+
+import copy
+import inspect
+import logging
+import threading
+
+import torch
+from transformers import DynamicCache
+
+logger = logging.getLogger(__name__)
+
+
+class PrefixStats:
+    """Counters for prefill tokens skipped thanks to the prefix cache"""
+
+    def __init__(self):
+        self.requests = 0
+        self.tokens_saved = 0
+        self.last_tokens_saved = 0
+        self._lock = threading.Lock()
+
+    def record(self, tokens_saved):
+        with self._lock:
+            self.requests += 1
+            self.tokens_saved += tokens_saved
+            self.last_tokens_saved = tokens_saved
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "tokens_saved": self.tokens_saved,
+                "last_tokens_saved": self.last_tokens_saved,
+            }
+
+
+PREFIX_STATS = PrefixStats()
+
+
+def _rope_index_fn(model):
+    """Qwen2-VL multimodal RoPE index function, wherever this transformers version keeps it"""
+    for holder in (model, getattr(model, "model", None)):
+        fn = getattr(holder, "get_rope_index", None)
+        if fn is not None:
+            return fn
+    return None
+
+
+_generation_locks_lock = threading.Lock()
+
+
+def generation_lock(model):
+    """Lock held from prefill to the last decode step of a generation on model.
+
+    Qwen2-VL keeps the request's rope_deltas on the model itself (newer
+    transformers read them from there instead of the generate kwargs), so two
+    generations interleaving on one model would decode with each other's
+    positions.
+    """
+    with _generation_locks_lock:
+        lock = getattr(model, "_generation_lock", None)
+        if lock is None:
+            lock = model._generation_lock = threading.RLock()
+        return lock
+
+
+def _set_rope_deltas(model, rope_deltas):
+    # Decode steps position tokens as cache_position + rope_deltas; the caller
+    # holds generation_lock(model) until generate() is done with them
+    for holder in (model, getattr(model, "model", None)):
+        if holder is not None and hasattr(holder, "rope_deltas"):
+            holder.rope_deltas = rope_deltas
+
+
+def _last_logit_only(model):
+    """Forward kwarg that skips computing logits for all but the last position"""
+    params = inspect.signature(model.forward).parameters
+    for name in ("logits_to_keep", "num_logits_to_keep"):
+        if name in params:
+            return {name: 1}
+    return {}
+
+
+def supports_prefix_cache(model):
+    """Prefix reuse needs explicit multimodal position ids (the Qwen2-VL layout)"""
+    return _rope_index_fn(model) is not None
+
+
+def warm_prefix_cache(model, processor, system_prompts):
+    """Precompute past_key_values for each system prompt and attach them to the model"""
+    if not supports_prefix_cache(model):
+        logger.info("prefix cache: %s has no rope index, skipping", type(model).__name__)
+        return
+
+    get_rope_index = _rope_index_fn(model)
+    entries = {}
+    for system_prompt in system_prompts:
+        messages = [{"role": "system", "content": [{"type": "text", "text": system_prompt}]}]
+        text = processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=False)
+        prefix = processor.tokenizer([text], return_tensors="pt").to(model.device)
+        position_ids, _ = get_rope_index(prefix.input_ids, None, None, prefix.attention_mask)
+
+        past_key_values = DynamicCache()
+        with torch.no_grad():
+            model(
+                input_ids=prefix.input_ids,
+                attention_mask=prefix.attention_mask,
+                position_ids=position_ids,
+                past_key_values=past_key_values,
+                use_cache=True,
+                **_last_logit_only(model)
+            )
+        entries[system_prompt] = (prefix.input_ids[0], past_key_values)
+
+    model._prefix_kv_cache = entries
+    logger.info(
+        "prefix cache: warmed %d prompts (%s tokens)",
+        len(entries), ", ".join(str(len(ids)) for ids, _ in entries.values())
+    )
+
+
+def prefill_with_prefix(model, inputs, system_prompt):
+    """Prefill inputs on top of the cached system-prompt KV.
+
+    Runs the forward pass for the image/user segment only, stopping one token
+    short so generate() still produces the first new token itself. Call it and
+    generate() under generation_lock(model). Returns
+    (generate_inputs, generate_kwargs) to pass to model.generate(), or None when
+    no prefix is cached for this prompt or the tokens do not line up.
+    """
+    entry = getattr(model, "_prefix_kv_cache", {}).get(system_prompt)
+    if entry is None:
+        return None
+    prefix_ids, prefix_past = entry
+
+    input_ids = inputs["input_ids"]
+    attention_mask = inputs["attention_mask"]
+    prefix_length = len(prefix_ids)
+    total_length = input_ids.shape[1]
+    if input_ids.shape[0] != 1 or total_length <= prefix_length + 1:
+        return None
+    if not torch.equal(input_ids[0, :prefix_length], prefix_ids.to(input_ids.device)):
+        return None
+
+    position_ids, rope_deltas = _rope_index_fn(model)(
+        input_ids, inputs.get("image_grid_thw"), None, attention_mask
+    )
+    past_key_values = copy.deepcopy(prefix_past)
+    with torch.no_grad():
+        model(
+            input_ids=input_ids[:, prefix_length:total_length - 1],
+            attention_mask=attention_mask[:, :total_length - 1],
+            pixel_values=inputs.get("pixel_values"),
+            image_grid_thw=inputs.get("image_grid_thw"),
+            position_ids=position_ids[:, :, prefix_length:total_length - 1],
+            past_key_values=past_key_values,
+            cache_position=torch.arange(prefix_length, total_length - 1, device=input_ids.device),
+            use_cache=True,
+            **_last_logit_only(model)
+        )
+    _set_rope_deltas(model, rope_deltas)
+    PREFIX_STATS.record(prefix_length)
+
+    # The image is already in the cache; generate() only sees the last prompt token
+    generate_inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+    return generate_inputs, {"past_key_values": past_key_values, "rope_deltas": rope_deltas}
@@ -0,0 +1,50 @@
+# Image preprocessing for the local VLMs
+# Uploaded photos are decoded once, already bounded in size, so the processor never
+# sees a 12 MP image and the visual-token count stays predictable.
+
+import io
+import math
+
+from PIL import Image, ImageOps
+
+# Pixel budgets per resolution tier; Qwen2-VL spends one visual token per 28x28 block
+RESOLUTION_TIERS = {
+    "low": 256 * 28 * 28,
+    "medium": 512 * 28 * 28,
+    "high": 1024 * 28 * 28,
+    "full": None,
+}
+
+
+def fit_size(width, height, min_pixels=None, max_pixels=None):
+    """Aspect-preserving size whose pixel count lies within [min_pixels, max_pixels]"""
+    pixels = width * height
+    scale = 1.0
+    if max_pixels and pixels > max_pixels:
+        scale = math.sqrt(max_pixels / pixels)
+    elif min_pixels and pixels < min_pixels:
+        scale = math.sqrt(min_pixels / pixels)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def preprocess_image(data, min_pixels=None, max_pixels=None):
+    """Decode image bytes to an upright RGB image within the pixel bounds.
+
+    JPEGs are decoded in draft mode, which lets libjpeg scale by 1/2, 1/4 or
+    1/8 during decoding instead of materializing the full-resolution bitmap;
+    the exact size is then reached with one resize. EXIF orientation and the
+    colour mode are normalized here so nothing downstream has to.
+    """
+    image = Image.open(io.BytesIO(data))
+    if max_pixels and image.format == "JPEG":
+        # draft() picks the smallest DCT scale that is still at least this size
+        image.draft("RGB", fit_size(*image.size, max_pixels=max_pixels))
+
+    image = ImageOps.exif_transpose(image)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+
+    size = fit_size(*image.size, min_pixels=min_pixels, max_pixels=max_pixels)
+    if size != image.size:
+        image = image.resize(size, Image.Resampling.BICUBIC)
+    return image
@@ -0,0 +1,140 @@
+# Precision modes for the local VLMs
+#
+# "auto" keeps the checkpoint dtype and device placement. The other modes target
+# CPU-only hosts: "bf16" halves fp32 memory, "int8" applies PyTorch dynamic
+# quantization to the language model's linear layers and "int4" stores those
+# weights as packed 4-bit groups that are dequantized on the fly. The vision tower,
+# projector and LM head stay in floating point in every mode.
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+PRECISION_MODES = ("auto", "bf16", "int8", "int4")
+
+# Peak memory while loading relative to the checkpoint's bf16 size; int8 has to
+# load in fp32 before dynamic quantization can convert it
+LOAD_PEAK_FACTOR = {"auto": 1.0, "bf16": 1.0, "int8": 2.0, "int4": 1.0}
+
+# Linear layers left alone: the vision side is run once per image and the LM head
+# is sensitive to quantization error. Matched as prefixes of each part of a
+# module's dotted name, so "vision" also covers Idefics3's "vision_model".
+_SKIPPED_MODULES = ("visual", "vision", "merger", "connector", "multi_modal_projector", "lm_head")
+
+INT4_GROUP_SIZE = 128
+
+
+def available_precisions():
+    """Modes that make sense on this host; the quantized modes are CPU-only"""
+    if torch.cuda.is_available():
+        return ("auto", "bf16")
+    return PRECISION_MODES
+
+
+def load_kwargs(precision):
+    """from_pretrained() keyword arguments for a precision mode"""
+    if precision == "auto":
+        return {"torch_dtype": "auto", "device_map": "auto"}
+    if precision == "bf16":
+        return {"torch_dtype": torch.bfloat16, "device_map": "auto"}
+    if precision == "int8":
+        return {"torch_dtype": torch.float32, "device_map": "cpu"}
+    if precision == "int4":
+        return {"torch_dtype": torch.bfloat16, "device_map": "cpu"}
+    raise ValueError(f"Unknown precision {precision!r}; expected one of {', '.join(PRECISION_MODES)}")
+
+
+def quantizable_linears(model):
+    """Qualified names of the language-model linear layers a quantized mode converts"""
+    return [
+        name for name, module in model.named_modules()
+        if isinstance(module, nn.Linear)
+        and not any(part.startswith(_SKIPPED_MODULES) for part in name.split("."))
+    ]
+
+
+class Int4Linear(nn.Module):
+    """Weight-only int4 linear layer.
+
+    Weights are quantized symmetrically per group of input features, stored two
+    per byte, and dequantized to the activation dtype on every call; the saving
+    is memory (about 4x over bf16), not arithmetic.
+    """
+
+    def __init__(self, packed, scales, bias, in_features, out_features, group_size):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.group_size = group_size
+        self.register_buffer("packed", packed)
+        self.register_buffer("scales", scales)
+        self.register_buffer("bias", bias)
+
+    @classmethod
+    def from_linear(cls, linear, group_size=INT4_GROUP_SIZE):
+        weight = linear.weight.detach().float()
+        out_features, in_features = weight.shape
+        if in_features % group_size:
+            group_size = in_features
+
+        grouped = weight.reshape(out_features, in_features // group_size, group_size)
+        scales = grouped.abs().amax(dim=-1, keepdim=True).clamp(min=1e-8) / 7
+        quantized = torch.clamp(torch.round(grouped / scales), -8, 7).reshape(out_features, in_features)
+        nibbles = (quantized + 8).to(torch.uint8)
+        packed = nibbles[:, 0::2] | (nibbles[:, 1::2] << 4)
+
+        bias = linear.bias.detach().to(torch.bfloat16) if linear.bias is not None else None
+        return cls(packed, scales.to(torch.bfloat16), bias, in_features, out_features, group_size)
+
+    def dequantized_weight(self, dtype):
+        nibbles = torch.stack((self.packed & 0x0F, self.packed >> 4), dim=-1)
+        quantized = nibbles.reshape(self.out_features, -1, self.group_size).to(dtype) - 8
+        return (quantized * self.scales.to(dtype)).reshape(self.out_features, self.in_features)
+
+    def forward(self, x):
+        bias = self.bias.to(x.dtype) if self.bias is not None else None
+        return F.linear(x, self.dequantized_weight(x.dtype), bias)
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, group_size={self.group_size}"
+
+
+def _replace_module(model, name, replacement):
+    parent_name, _, child_name = name.rpartition(".")
+    parent = model.get_submodule(parent_name) if parent_name else model
+    setattr(parent, child_name, replacement)
+
+
+def apply_precision(model, precision):
+    """Quantize a freshly loaded model in place for the int8/int4 modes.
+
+    The mode is kept on the model as _precision: dynamic int8 and int4 models
+    still report their floating-point dtype.
+    """
+    model._precision = precision
+    if precision == "int8":
+        # Dynamic quantization: int8 weights, activations quantized per batch at runtime
+        qconfig_spec = {name: torch.ao.quantization.default_dynamic_qconfig for name in quantizable_linears(model)}
+        torch.ao.quantization.quantize_dynamic(model, qconfig_spec, dtype=torch.qint8, inplace=True)
+    elif precision == "int4":
+        for name in quantizable_linears(model):
+            linear = model.get_submodule(name)
+            if linear.in_features % 2 == 0:
+                _replace_module(model, name, Int4Linear.from_linear(linear))
+    return model
+
+
+def footprint_bytes(model):
+    """Resident size of a model, counting dynamically quantized weights.
+
+    get_memory_footprint() only sees parameters and buffers, and dynamic int8
+    layers keep their weights in packed params instead.
+    """
+    total = model.get_memory_footprint()
+    for module in model.modules():
+        if isinstance(module, torch.ao.nn.quantized.dynamic.Linear):
+            weight, bias = module._packed_params._weight_bias()
+            total += weight.numel() * weight.element_size()
+            if bias is not None:
+                total += bias.numel() * bias.element_size()
+    return total
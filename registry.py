@@ -0,0 +1,184 @@
+# Registry of the local vision-language models
+# Maps each model offered in the apps to its model/processor classes, loads them on
+# first use and unloads the least-recently-used ones to stay within a memory budget.
+
+import gc
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional
+
+import torch
+import transformers
+
+from quantize import LOAD_PEAK_FACTOR, footprint_bytes
+from vlm import load_model
+
+logger = logging.getLogger(__name__)
+
+GB = 1024 ** 3
+
+
+@dataclass(frozen=True)
+class ModelSpec:
+    path: str
+    model_class: str
+    processor_class: str = "AutoProcessor"
+    # Rough resident size, used to make room before the real size is known
+    approx_gb: float = 1.0
+    # Default pixel bounds for uploaded images (see preprocess.RESOLUTION_TIERS)
+    min_pixels: int = 256 * 28 * 28
+    max_pixels: int = 1024 * 28 * 28
+    # Smaller registered model sharing the vocabulary, for speculative decoding
+    draft: Optional[str] = None
+
+
+# Class names are resolved on load so older transformers releases can still
+# serve the models they do support
+MODEL_SPECS = {
+    "Qwen2-VL-7B-Instruct": ModelSpec(
+        path="Qwen/Qwen2-VL-7B-Instruct",
+        model_class="Qwen2VLForConditionalGeneration",
+        approx_gb=16.5
+    ),
+    "SmolVLM-256M-Instruct": ModelSpec(
+        path="HuggingFaceTB/SmolVLM-256M-Instruct",
+        model_class="AutoModelForVision2Seq",
+        approx_gb=0.6,
+        # 512px tiles: a 1 MP image is four tiles plus the global view
+        min_pixels=224 * 224,
+        max_pixels=1024 * 1024
+    ),
+    "SmolVLM2-2.2B-Instruct": ModelSpec(
+        path="HuggingFaceTB/SmolVLM2-2.2B-Instruct",
+        model_class="AutoModelForImageTextToText",
+        approx_gb=4.6,
+        min_pixels=224 * 224,
+        max_pixels=1152 * 1152,
+        draft="SmolVLM-256M-Instruct"
+    ),
+}
+
+
+def default_budget_bytes():
+    """MODEL_MEMORY_BUDGET_GB if set, else 90% of GPU memory or 70% of system RAM"""
+    if os.getenv("MODEL_MEMORY_BUDGET_GB"):
+        return int(float(os.getenv("MODEL_MEMORY_BUDGET_GB")) * GB)
+    if torch.cuda.is_available():
+        return int(torch.cuda.get_device_properties(0).total_memory * 0.9)
+    return int(os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") * 0.7)
+
+
+@dataclass
+class LoadedModel:
+    name: str
+    precision: str
+    model: object
+    processor: object
+    load_s: float
+    size_bytes: int
+    # Objects built on top of the model (e.g. a scheduler); closed on unload
+    resources: dict = field(default_factory=dict)
+
+
+class ModelRegistry:
+    """Lazily loads registered models, keeping the resident ones within a memory budget"""
+
+    def __init__(self, specs=MODEL_SPECS, budget_bytes=None):
+        self.specs = specs
+        self.budget_bytes = budget_bytes if budget_bytes is not None else default_budget_bytes()
+        self._loaded = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, name, precision="auto"):
+        """Return the LoadedModel for name, loading it (and evicting others) if needed.
+
+        Each precision of a model is a separate resident entry.
+        """
+        key = (name, precision)
+        with self._lock:
+            entry = self._loaded.get(key)
+            if entry is not None:
+                self._loaded.move_to_end(key)
+                return entry
+
+            spec = self.specs[name]
+            self._evict_until(int(spec.approx_gb * LOAD_PEAK_FACTOR[precision] * GB))
+
+            start = time.perf_counter()
+            model, processor = load_model(
+                spec.path,
+                model_class=getattr(transformers, spec.model_class),
+                processor_class=getattr(transformers, spec.processor_class),
+                precision=precision
+            )
+            entry = LoadedModel(
+                name=name,
+                precision=precision,
+                model=model,
+                processor=processor,
+                load_s=time.perf_counter() - start,
+                size_bytes=footprint_bytes(model)
+            )
+            self._loaded[key] = entry
+            logger.info(
+                "loaded %s (%s) in %.1fs (%.2f GB)", name, precision, entry.load_s, entry.size_bytes / GB
+            )
+
+            # The estimate may have been low; the model just loaded is never evicted here
+            self._evict_until(0, keep=key)
+            return entry
+
+    def resource(self, name, key, factory, precision="auto"):
+        """Per-model object built once by factory(entry) and closed when the model unloads"""
+        entry = self.get(name, precision)
+        with self._lock:
+            if key not in entry.resources:
+                entry.resources[key] = factory(entry)
+            return entry.resources[key]
+
+    def unload(self, name, precision="auto"):
+        """Drop a model and release its accelerator memory"""
+        with self._lock:
+            self._unload((name, precision))
+
+    def info(self):
+        """Per-model precision, load time and resident size, most recently used last"""
+        with self._lock:
+            return [
+                {
+                    "name": entry.name,
+                    "precision": entry.precision,
+                    "load_s": entry.load_s,
+                    "size_gb": entry.size_bytes / GB,
+                }
+                for entry in self._loaded.values()
+            ]
+
+    def resident_bytes(self):
+        return sum(entry.size_bytes for entry in self._loaded.values())
+
+    def _evict_until(self, incoming_bytes, keep=None):
+        while self._loaded and self.resident_bytes() + incoming_bytes > self.budget_bytes:
+            victim = next((key for key in self._loaded if key != keep), None)
+            if victim is None:
+                logger.warning("%s (%s) alone exceeds the %.1f GB model budget", *keep, self.budget_bytes / GB)
+                return
+            self._unload(victim)
+
+    def _unload(self, key):
+        entry = self._loaded.pop(key, None)
+        if entry is None:
+            return
+        for resource in entry.resources.values():
+            close = getattr(resource, "close", None)
+            if close is not None:
+                close()
+        del entry
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        logger.info("unloaded %s (%s)", *key)
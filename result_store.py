@@ -0,0 +1,252 @@
+# Persistent store of analysis results for the apps and batch.py
+#
+# Every answer is kept in SQLite with the image it was about (content hash and
+# dimensions) and how it was produced (analysis type, model, prompt version,
+# latency, token counts). The apps and the batch pipeline read through it, so an
+# image analyzed once is answered from disk after a restart. The prompt version
+# is a hash of the prompt text, so editing a prompt in prompts.py makes the old
+# answers stop matching without deleting them.
+#
+#   python result_store.py results.sqlite     # per-model, per-analysis summary
+
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from metrics import last_trace
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS images ("
+    "sha256 TEXT PRIMARY KEY, width INTEGER, height INTEGER, size_bytes INTEGER, first_seen REAL NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS analyses ("
+    "id INTEGER PRIMARY KEY, image_sha256 TEXT NOT NULL REFERENCES images (sha256), "
+    "analysis_type TEXT NOT NULL, model TEXT NOT NULL, prompt_version TEXT NOT NULL, "
+    "request TEXT NOT NULL DEFAULT '', latency_s REAL, prompt_tokens INTEGER, generated_tokens INTEGER, "
+    "created REAL NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS outputs ("
+    "analysis_id INTEGER PRIMARY KEY REFERENCES analyses (id), format TEXT NOT NULL, output TEXT NOT NULL)",
+    # Read-through lookups, then history per model for analytics
+    "CREATE INDEX IF NOT EXISTS analyses_by_image "
+    "ON analyses (image_sha256, model, analysis_type, prompt_version, request, created)",
+    "CREATE INDEX IF NOT EXISTS analyses_by_model ON analyses (model, analysis_type, created)",
+)
+
+
+def model_id(model_path, precision, max_pixels):
+    """The model name answers are stored (and cached, see cache.image_key) under.
+
+    Every entry point builds it here, so an answer written by one is found by
+    the others. The pixel cap is part of it: a photo downscaled further gets a
+    different answer.
+    """
+    return f"{model_path}:{precision}@{max_pixels}"
+
+
+def prompt_version(prompt):
+    """Short hash identifying a prompt's exact text"""
+    return hashlib.sha256(prompt.encode()).hexdigest()[:12]
+
+
+class ResultStore:
+    """SQLite store of analysis results; without db_path every lookup misses and nothing is kept.
+
+    Outputs are written in one transaction every flush_every puts (and on
+    flush() or close()): at once by default, in batches for the batch
+    pipeline. Unflushed outputs are still found by get(). Outputs are text,
+    or anything JSON-serializable (structured records as dicts).
+    """
+
+    def __init__(self, db_path=None, flush_every=1):
+        self.db_path = db_path
+        self.flush_every = flush_every
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self._rows = []
+        # Outputs not yet flushed, by lookup key, so get() sees them too
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            # WAL lets the apps read while a batch run writes, and needs fewer fsyncs
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            for statement in SCHEMA:
+                self._db.execute(statement)
+            self._db.commit()
+
+    @classmethod
+    def from_env(cls, flush_every=1):
+        """Configured by RESULT_STORE_DB (unset: results are not kept)"""
+        return cls(db_path=os.getenv("RESULT_STORE_DB"), flush_every=flush_every)
+
+    @property
+    def enabled(self):
+        return self._db is not None
+
+    def get(self, image_sha256, analysis_type, model, version, request=""):
+        """The latest output for this exact request, or None"""
+        if not self.enabled:
+            return None
+        key = (image_sha256, analysis_type, model, version, request)
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is not None:
+                self.hits += 1
+                return pending[-1]
+            row = self._db.execute(
+                "SELECT o.format, o.output FROM analyses a JOIN outputs o ON o.analysis_id = a.id "
+                "WHERE a.image_sha256 = ? AND a.model = ? AND a.analysis_type = ? "
+                "AND a.prompt_version = ? AND a.request = ? ORDER BY a.created DESC LIMIT 1",
+                (image_sha256, model, analysis_type, version, request)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            output_format, output = row
+            return json.loads(output) if output_format == "json" else output
+
+    def put(self, image_sha256, analysis_type, model, version, output, request="", image=None,
+            size_bytes=None, latency_s=None, prompt_tokens=None, generated_tokens=None):
+        """Store one output; image (PIL) and size_bytes describe the upload"""
+        if not self.enabled:
+            return
+        width, height = image.size if image is not None else (None, None)
+        row = (
+            (image_sha256, width, height, size_bytes),
+            (image_sha256, analysis_type, model, version, request, latency_s, prompt_tokens, generated_tokens),
+            output,
+        )
+        with self._lock:
+            self._pending.setdefault((image_sha256, analysis_type, model, version, request), []).append(output)
+            self._rows.append(row)
+            full = len(self._rows) >= self.flush_every
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Write buffered outputs in one transaction"""
+        if not self.enabled:
+            return
+        with self._lock:
+            rows, self._rows = self._rows, []
+            if not rows:
+                return
+            now = time.time()
+            with self._db:
+                self._db.executemany(
+                    "INSERT OR IGNORE INTO images (sha256, width, height, size_bytes, first_seen) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    [(*image, now) for image, _, _ in rows]
+                )
+                for _, analysis, output in rows:
+                    cursor = self._db.execute(
+                        "INSERT INTO analyses (image_sha256, analysis_type, model, prompt_version, request, "
+                        "latency_s, prompt_tokens, generated_tokens, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (*analysis, now)
+                    )
+                    is_text = isinstance(output, str)
+                    self._db.execute(
+                        "INSERT INTO outputs (analysis_id, format, output) VALUES (?, ?, ?)",
+                        (cursor.lastrowid, "text" if is_text else "json", output if is_text else json.dumps(output))
+                    )
+            self._pending.clear()
+            self.writes += len(rows)
+
+    def through(self, work, image_sha256, analysis_type, model, prompt, request="", image=None, size_bytes=None):
+        """work wrapped to answer from the store, and to store what it computes on a miss.
+
+        work returns text or an iterable of text chunks (jobs.JobManager work);
+        a stream is passed through as it arrives and stored once complete.
+        Latency and token counts come from the trace the work records. Work
+        that raises stores nothing.
+        """
+        if not self.enabled:
+            return work
+        version = prompt_version(prompt)
+
+        def store(output, started, before):
+            request_trace = last_trace()
+            values = request_trace.values if request_trace is not None and request_trace is not before else {}
+            self.put(
+                image_sha256, analysis_type, model, version, output, request, image, size_bytes,
+                latency_s=time.perf_counter() - started,
+                prompt_tokens=values.get("prompt_tokens"),
+                generated_tokens=values.get("generated_tokens")
+            )
+
+        def stream(chunks, started, before):
+            pieces = []
+            for chunk in chunks:
+                pieces.append(chunk)
+                yield chunk
+            store("".join(pieces), started, before)
+
+        def read_through():
+            output = self.get(image_sha256, analysis_type, model, version, request)
+            if output is not None:
+                return output
+            started, before = time.perf_counter(), last_trace()
+            output = work()
+            if isinstance(output, (str, dict, list)):
+                store(output, started, before)
+                return output
+            return stream(output, started, before)
+
+        return read_through
+
+    def history(self, image_sha256, limit=50):
+        """Past analyses of an image, newest first"""
+        if not self.enabled:
+            return []
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT analysis_type, model, prompt_version, request, latency_s, generated_tokens, created "
+                "FROM analyses WHERE image_sha256 = ? ORDER BY created DESC LIMIT ?",
+                (image_sha256, limit)
+            ).fetchall()
+        keys = ("analysis_type", "model", "prompt_version", "request", "latency_s", "generated_tokens", "created")
+        return [dict(zip(keys, row)) for row in rows]
+
+    def summary(self):
+        """Per model and analysis type: count, mean latency and mean generated tokens"""
+        if not self.enabled:
+            return []
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT model, analysis_type, COUNT(*), AVG(latency_s), AVG(generated_tokens) "
+                "FROM analyses GROUP BY model, analysis_type ORDER BY model, analysis_type"
+            ).fetchall()
+        keys = ("model", "analysis_type", "count", "mean_latency_s", "mean_generated_tokens")
+        return [dict(zip(keys, row)) for row in rows]
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "writes": self.writes}
+
+    def close(self):
+        self.flush()
+        if self._db is not None:
+            self._db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize a result store")
+    parser.add_argument("db_path")
+    args = parser.parse_args()
+    store = ResultStore(args.db_path)
+    for row in store.summary():
+        latency = f"{row['mean_latency_s']:.2f}s" if row["mean_latency_s"] is not None else "-"
+        tokens = f"{row['mean_generated_tokens']:.0f}" if row["mean_generated_tokens"] is not None else "-"
+        print(f"{row['model']:<50} {row['analysis_type']:<20} {row['count']:>6} {latency:>8} {tokens:>6} tokens")
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+# Cascade routing between a small and a large local VLM
+# The small model answers the cheap requests (food validation, short follow-up
+# questions) and hands over to the large one for recipes, nutrition and anything
+# it is unsure about.
+
+import os
+import threading
+from dataclasses import dataclass
+
+from vlm import (
+    FOOD_THRESHOLD,
+    score_food_image,
+    validate_food_image,
+    analyze_food,
+    stream_analyze_food
+)
+
+
+@dataclass(frozen=True)
+class RoutingPolicy:
+    small: str = "SmolVLM-256M-Instruct"
+    # Analysis types the small model may answer; everything else goes to the large model
+    small_analyses: tuple = ("general",)
+    # Questions longer than this go to the large model even for small_analyses
+    max_question_words: int = 30
+    # Small-model validations less sure than this, as max(p, 1 - p), are re-checked
+    min_confidence: float = 0.85
+
+    @classmethod
+    def from_env(cls):
+        """Policy overridden by ROUTER_SMALL_MODEL, ROUTER_SMALL_ANALYSES,
+        ROUTER_MAX_QUESTION_WORDS and ROUTER_MIN_CONFIDENCE"""
+        defaults = cls()
+        analyses = os.getenv("ROUTER_SMALL_ANALYSES")
+        return cls(
+            small=os.getenv("ROUTER_SMALL_MODEL", defaults.small),
+            small_analyses=(
+                tuple(name.strip() for name in analyses.split(",") if name.strip())
+                if analyses is not None else defaults.small_analyses
+            ),
+            max_question_words=int(os.getenv("ROUTER_MAX_QUESTION_WORDS", defaults.max_question_words)),
+            min_confidence=float(os.getenv("ROUTER_MIN_CONFIDENCE", defaults.min_confidence))
+        )
+
+
+class CascadeRouter:
+    """Routes validate/analyze calls between policy.small and a large registry model.
+
+    Counters are kept per (request kind, route), where route is "small",
+    "large" or "escalated" (the small model answered but was not confident).
+    """
+
+    def __init__(self, registry, large, policy=None, precision="auto", threshold=FOOD_THRESHOLD):
+        self.registry = registry
+        self.large = large
+        self.policy = policy or RoutingPolicy.from_env()
+        self.precision = precision
+        self.threshold = threshold
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def _count(self, kind, route):
+        with self._lock:
+            self.counts[(kind, route)] = self.counts.get((kind, route), 0) + 1
+
+    def _entry(self, name):
+        return self.registry.get(name, self.precision)
+
+    @staticmethod
+    def _image_id(image_id, name):
+        # Vision caches are per model
+        return f"{name}|{image_id}" if image_id is not None else None
+
+    def validate(self, image, image_id=None):
+        """Food verdict from the small model, re-checked by the large one when unsure"""
+        small = self._entry(self.policy.small)
+        probability = score_food_image(
+            image, small.model, small.processor, image_id=self._image_id(image_id, self.policy.small)
+        )
+        if probability is not None and max(probability, 1 - probability) >= self.policy.min_confidence:
+            self._count("validate", "small")
+            return probability >= self.threshold
+
+        self._count("validate", "escalated")
+        large = self._entry(self.large)
+        return validate_food_image(
+            image, large.model, large.processor, threshold=self.threshold,
+            image_id=self._image_id(image_id, self.large)
+        )
+
+    def route(self, analysis_type, user_question=""):
+        """Name of the model that should answer this analysis"""
+        if (analysis_type in self.policy.small_analyses
+                and len(user_question.split()) <= self.policy.max_question_words):
+            return self.policy.small
+        return self.large
+
+    def _route_call(self, analysis_type, user_question, image_id, kwargs):
+        name = self.route(analysis_type, user_question)
+        self._count(analysis_type, "small" if name == self.policy.small else "large")
+        if name != self.large:
+            # Drafts are for the large model only
+            kwargs.pop("draft", None)
+            kwargs.pop("draft_tokens", None)
+        return self._entry(name), self._image_id(image_id, name)
+
+    def analyze(self, image, system_prompt, analysis_type, user_question="", image_id=None, **kwargs):
+        """analyze_food() on the routed model"""
+        entry, routed_id = self._route_call(analysis_type, user_question, image_id, kwargs)
+        return analyze_food(
+            image, system_prompt, analysis_type, entry.model, entry.processor, user_question,
+            image_id=routed_id, **kwargs
+        )
+
+    def stream_analyze(self, image, system_prompt, analysis_type, user_question="", image_id=None, **kwargs):
+        """stream_analyze_food() on the routed model"""
+        entry, routed_id = self._route_call(analysis_type, user_question, image_id, kwargs)
+        return stream_analyze_food(
+            image, system_prompt, analysis_type, entry.model, entry.processor, user_question,
+            image_id=routed_id, **kwargs
+        )
+
+    def stats(self):
+        """Per-route counts and the share of requests the small model absorbed"""
+        with self._lock:
+            counts = dict(self.counts)
+        total = sum(counts.values())
+        small = sum(count for (_, route), count in counts.items() if route == "small")
+        return {
+            "routes": {f"{kind}.{route}": count for (kind, route), count in sorted(counts.items())},
+            "total": total,
+            "small_share": small / total if total else 0.0,
+        }
@@ -0,0 +1,232 @@
+# Dynamic request batching for one loaded model shared by concurrent sessions
+# Requests queue up for a short window and run as one left-padded generate() call.
+
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+from qwen_vl_utils import process_vision_info
+from transformers import StoppingCriteriaList
+
+from generation import GenerationProfile, SectionStoppingCriteria, finish_text, profile_for
+from prefix_cache import generation_lock
+from prompts import FOOD_VALIDATION_PROMPT
+from structured import json_constraint
+from vlm import (
+    DEVICE,
+    FOOD_TEMPERATURE,
+    FOOD_THRESHOLD,
+    VALID_LABEL,
+    build_messages,
+    label_token_ids,
+    analysis_user_text
+)
+
+logger = logging.getLogger(__name__)
+
+
+class _Request:
+    def __init__(self, kind, messages, profile):
+        self.kind = kind
+        self.messages = messages
+        self.profile = profile
+        self.future = Future()
+
+
+class InferenceScheduler:
+    """Owns a model and batches validate/analyze requests from concurrent callers.
+
+    A single worker thread takes the first queued request, keeps collecting for
+    up to max_wait_ms or until max_batch_size requests are waiting, then runs
+    each group of compatible requests as one batch and scatters the results
+    back through futures. Batched requests skip the per-image embedding and
+    prefix caches in vlm.py, which only apply to batch size 1. Analyses are
+    batched per generation profile (generation.py), so a batched answer gets
+    the same budget, repetition controls and stopping as an unbatched one.
+    Structured requests are batched per analysis type and constrained to its
+    schema.
+    """
+
+    def __init__(self, model, processor, max_batch_size=4, max_wait_ms=20, threshold=FOOD_THRESHOLD,
+                 temperature=FOOD_TEMPERATURE):
+        self.model = model
+        self.processor = processor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.threshold = threshold
+        self.temperature = temperature
+        self.label_ids = label_token_ids(processor)
+
+        self.started = time.monotonic()
+        self.images = 0
+        self.batches = 0
+        self._stats_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="inference-scheduler", daemon=True)
+        self._worker.start()
+
+    def submit_validate(self, image):
+        """Queue a food-validation request; the future resolves to a bool"""
+        messages = build_messages(image, FOOD_VALIDATION_PROMPT, "Is this image a food item?")
+        return self._submit(_Request("validate", messages, GenerationProfile(max_new_tokens=10)))
+
+    def submit_analyze(self, image, system_prompt, analysis_type, user_question="", max_new_tokens=None,
+                       structured=False):
+        """Queue an analysis request; the future resolves to the answer text.
+
+        The analysis type's profile sets the budget, repetition controls and
+        stopping, as in vlm.analyze_food(); max_new_tokens overrides the budget.
+        With structured=True the answer is JSON decoded under the analysis
+        type's schema (structured.json_constraint).
+        """
+        messages = build_messages(image, system_prompt, analysis_user_text(analysis_type, user_question))
+        kind = f"json:{analysis_type}" if structured else "analyze"
+        profile = profile_for(f"{analysis_type}:json" if structured else analysis_type, max_new_tokens)
+        return self._submit(_Request(kind, messages, profile))
+
+    def validate(self, image, timeout=None):
+        """Blocking counterpart of submit_validate()"""
+        return self.submit_validate(image).result(timeout)
+
+    def analyze(self, image, system_prompt, analysis_type, user_question="", max_new_tokens=None, structured=False,
+                timeout=None):
+        """Blocking counterpart of submit_analyze()"""
+        return self.submit_analyze(
+            image, system_prompt, analysis_type, user_question, max_new_tokens=max_new_tokens, structured=structured
+        ).result(timeout)
+
+    def stats(self):
+        """Throughput counters since the scheduler started"""
+        with self._stats_lock:
+            elapsed = time.monotonic() - self.started
+            return {
+                "images": self.images,
+                "batches": self.batches,
+                "mean_batch_size": self.images / self.batches if self.batches else 0.0,
+                "images_per_min": 60 * self.images / elapsed if elapsed else 0.0,
+                "queued": self._queue.qsize(),
+            }
+
+    def close(self):
+        """Stop the worker after the requests already queued"""
+        self._queue.put(None)
+        self._worker.join()
+
+    def _submit(self, request):
+        self._queue.put(request)
+        return request.future
+
+    def _collect(self):
+        """Block for one request, then gather more until the window or batch fills"""
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                # Finish this batch, then let the next _collect() see the sentinel
+                self._queue.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            groups = {}
+            for request in batch:
+                groups.setdefault((request.kind, request.profile), []).append(request)
+            for requests in groups.values():
+                self._run_group(requests)
+
+    def _run_group(self, requests):
+        try:
+            kind = requests[0].kind
+            if kind == "validate":
+                results = self._validate_batch(requests)
+            elif kind.startswith("json:"):
+                constraint = json_constraint(self.processor.tokenizer, kind.partition(":")[2])
+                results = self._generate_batch(requests, requests[0].profile, constraint)
+            else:
+                results = self._generate_batch(requests, requests[0].profile)
+        except Exception as e:
+            logger.exception("batch of %d %s requests failed", len(requests), requests[0].kind)
+            for request in requests:
+                request.future.set_exception(e)
+            return
+
+        with self._stats_lock:
+            self.images += len(requests)
+            self.batches += 1
+        for request, result in zip(requests, results):
+            request.future.set_result(result)
+
+    def _batch_inputs(self, requests):
+        texts = [
+            self.processor.apply_chat_template(request.messages, tokenize=False, add_generation_prompt=True)
+            for request in requests
+        ]
+        image_inputs, video_inputs = process_vision_info([request.messages for request in requests])
+        # Batched generation needs the prompts right-aligned. The processor is shared
+        # with the single-request paths, so left padding is asked for per call
+        # rather than set on the tokenizer.
+        inputs = self.processor(
+            text=texts,
+            images=image_inputs,
+            videos=video_inputs,
+            padding=True,
+            padding_side="left",
+            return_tensors="pt"
+        )
+        return inputs.to(DEVICE)
+
+    def _validate_batch(self, requests):
+        if self.label_ids is None:
+            texts = self._generate_batch(requests, requests[0].profile)
+            return [VALID_LABEL in text for text in texts]
+
+        valid_id, invalid_id = self.label_ids
+        inputs = self._batch_inputs(requests)
+        # The model may also serve single requests (e.g. through a router)
+        with generation_lock(self.model), torch.no_grad():
+            outputs = self.model.generate(
+                **inputs,
+                max_new_tokens=1,
+                do_sample=False,
+                output_logits=True,
+                return_dict_in_generate=True
+            )
+        logits = outputs.logits[0].float()
+        # Same calibration as vlm.score_food_image(), so batched verdicts match single ones
+        probabilities = torch.sigmoid((logits[:, valid_id] - logits[:, invalid_id]) / self.temperature)
+        return [probability >= self.threshold for probability in probabilities.tolist()]
+
+    def _generate_batch(self, requests, profile, constraint=None):
+        inputs = self._batch_inputs(requests)
+        # Left padding puts every prompt's end at the same column
+        prompt_length = inputs.input_ids.shape[1]
+        stopping = SectionStoppingCriteria(self.processor.tokenizer, prompt_length, profile)
+        kwargs = {**profile.generate_kwargs(), "stopping_criteria": StoppingCriteriaList([stopping])}
+        if constraint is not None:
+            kwargs["prefix_allowed_tokens_fn"] = constraint
+        with generation_lock(self.model), torch.no_grad():
+            generated_ids = self.model.generate(**inputs, **kwargs)
+        texts = self.processor.batch_decode(
+            generated_ids[:, prompt_length:],
+            skip_special_tokens=True,
+            clean_up_tokenization_spaces=False
+        )
+        return [finish_text(text, profile) for text in texts]
@@ -0,0 +1,449 @@
+# Local HTTP API in front of the local VLMs
+#
+#   python server.py --model Qwen2-VL-7B-Instruct --port 8000 --workers 2
+#   curl -F image=@dish.jpg localhost:8000/validate
+#   curl -F image=@dish.jpg 'localhost:8000/analyze/recipe?stream=true'
+#   curl -F image=@dish.jpg -F question='Is it vegan?' localhost:8000/ask
+#   curl -F images=@a.jpg -F images=@b.jpg -F analyses=validate,ingredients localhost:8000/batch
+#
+# Each worker process loads the model once and owns it. Requests wait in a
+# bounded asyncio queue and run one at a time in a thread (several at once when
+# BATCH_MAX_SIZE > 1, so the batching scheduler can group them); a full queue
+# answers 503 so callers back off instead of piling up. Answers stream as plain
+# text with ?stream=true, /batch streams one JSON line per image, and /health and
+# /metrics (Prometheus text) report on the queue and the traces in metrics.py.
+# The Streamlit apps become thin clients of a server with INFERENCE_SERVER_URL.
+# On a CPU-only host, --cpu-workers N runs the model in a worker_pool.WorkerPool
+# of N core-pinned processes instead, with N requests in flight.
+
+import argparse
+import asyncio
+import json
+import os
+from contextlib import asynccontextmanager
+from dataclasses import asdict
+
+import uvicorn
+from fastapi import FastAPI, File, Form, HTTPException, UploadFile
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from PIL import UnidentifiedImageError
+
+from cache import VerdictCache, image_digest, image_key
+from metrics import METRICS
+from nutrition import nutrition_report
+from preprocess import preprocess_image
+from prompts import (
+    GENERAL_FOOD_PROMPT,
+    FULL_REPORT_SYSTEM_PROMPT,
+    LOCAL_ANALYSES,
+    LOCAL_BATCH_ANALYSES,
+    STRUCTURED_PROMPTS
+)
+from registry import ModelRegistry, MODEL_SPECS
+from result_store import ResultStore, model_id
+from scheduler import InferenceScheduler
+from structured import parse_record, RECORD_TYPES
+from worker_pool import WorkerPool, DISPATCH_MODES
+from vlm import (
+    validate_food_image,
+    analyze_food,
+    stream_analyze_food,
+    analyze_structured,
+    full_report,
+    split_full_report,
+    FULL_REPORT_MAX_NEW_TOKENS
+)
+
+# Analyses served by /analyze/{analysis_type}
+SERVED_ANALYSES = set(LOCAL_ANALYSES) | {"full_report", "computed_nutrition"}
+
+_END = object()
+
+
+class QueueFull(Exception):
+    """The request queue is at capacity"""
+
+
+class InferenceQueue:
+    """Bounded async queue in front of one model.
+
+    concurrency consumer tasks take requests in arrival order and run each
+    one's work in a thread, so the event loop keeps accepting and streaming
+    while a generation runs. Must be started from the server's event loop.
+    """
+
+    def __init__(self, max_queued=64, concurrency=1):
+        self.max_queued = max_queued
+        self.concurrency = concurrency
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self._queue = None
+        self._consumers = []
+
+    async def start(self):
+        self._queue = asyncio.Queue(self.max_queued)
+        self._consumers = [asyncio.create_task(self._consume()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for consumer in self._consumers:
+            consumer.cancel()
+        await asyncio.gather(*self._consumers, return_exceptions=True)
+
+    @property
+    def queued(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def _enqueue(self, work, chunks=None):
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((work, future, chunks))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise QueueFull(f"{self.max_queued} requests already queued") from None
+        return future
+
+    async def run(self, work):
+        """work()'s result, once it has had its turn"""
+        return await self._enqueue(work)
+
+    def stream(self, work):
+        """Async iterator over work()'s text, or iterable of text, as the model produces it.
+
+        Queued at once, so a full queue raises here rather than from the first chunk.
+        """
+        chunks = asyncio.Queue()
+        return self._chunks(chunks, self._enqueue(work, chunks))
+
+    @staticmethod
+    async def _chunks(chunks, future):
+        while True:
+            chunk = await chunks.get()
+            if chunk is _END:
+                break
+            yield chunk
+        # Raises what work raised, after the chunks it did produce
+        await future
+
+    async def _consume(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            work, future, chunks = await self._queue.get()
+            self.running += 1
+            try:
+                result = await asyncio.to_thread(self._execute, loop, work, chunks)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                self.running -= 1
+                self.completed += 1
+                if chunks is not None:
+                    chunks.put_nowait(_END)
+
+    @staticmethod
+    def _execute(loop, work, chunks):
+        output = work()
+        if chunks is None:
+            return output
+        for chunk in [output] if isinstance(output, str) else output:
+            loop.call_soon_threadsafe(chunks.put_nowait, chunk)
+
+    def stats(self):
+        return {
+            "queued": self.queued,
+            "running": self.running,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+
+class FoodService:
+    """One resident model, or a pool of CPU worker processes, and the analyses the endpoints run on it"""
+
+    def __init__(self, model_name, precision="auto", max_queued=64, cpu_workers=0, threads_per_worker=None,
+                 dispatch="queue_depth"):
+        self.model_name = model_name
+        self.precision = precision
+        self.spec = MODEL_SPECS[model_name]
+        self.model_id = model_id(self.spec.path, precision, self.spec.max_pixels)
+        self.model = self.processor = self.scheduler = self.pool = None
+
+        if cpu_workers:
+            self.pool = WorkerPool(model_name, cpu_workers, threads_per_worker, precision, dispatch)
+            concurrency = cpu_workers
+        else:
+            registry = ModelRegistry()
+            entry = registry.get(model_name, precision)
+            self.model, self.processor = entry.model, entry.processor
+            max_batch_size = int(os.getenv("BATCH_MAX_SIZE", "1"))
+            self.scheduler = registry.resource(
+                model_name,
+                "scheduler",
+                lambda entry: InferenceScheduler(
+                    entry.model, entry.processor, max_batch_size=max_batch_size,
+                    max_wait_ms=float(os.getenv("BATCH_WAIT_MS", "20"))
+                ),
+                precision
+            ) if max_batch_size > 1 else None
+            # With the scheduler, let a batch worth of requests reach it at once
+            concurrency = max_batch_size if self.scheduler else 1
+        self.verdicts = VerdictCache(max_entries=1024, db_path=os.getenv("VERDICT_CACHE_DB"))
+        self.store = ResultStore.from_env()
+        self.queue = InferenceQueue(max_queued, concurrency=concurrency)
+
+    @classmethod
+    def from_env(cls):
+        """Configured by SERVER_MODEL, SERVER_PRECISION, SERVER_MAX_QUEUE, and SERVER_CPU_WORKERS,
+        SERVER_THREADS_PER_WORKER and SERVER_DISPATCH for a worker pool"""
+        return cls(
+            os.getenv("SERVER_MODEL", "Qwen2-VL-7B-Instruct"),
+            os.getenv("SERVER_PRECISION", "auto"),
+            int(os.getenv("SERVER_MAX_QUEUE", "64")),
+            int(os.getenv("SERVER_CPU_WORKERS", "0")),
+            int(os.getenv("SERVER_THREADS_PER_WORKER", "0")) or None,
+            os.getenv("SERVER_DISPATCH", "queue_depth")
+        )
+
+    def decode(self, data):
+        """(image, image id) for uploaded bytes, within the model's pixel bounds"""
+        image = preprocess_image(data, self.spec.min_pixels, self.spec.max_pixels)
+        return image, image_key(data, self.model_id)
+
+    def validate(self, image, image_id):
+        return self.verdicts.get_or_compute(
+            image_id,
+            lambda: self.pool.validate(image, image_id) if self.pool is not None
+            else self.scheduler.validate(image) if self.scheduler is not None
+            else validate_food_image(image, self.model, self.processor, image_id=image_id)
+        )
+
+    def analysis(self, data, image, image_id, analysis_type, user_question="", structured=False, stream=False):
+        """work() for one analysis, read through the result store.
+
+        Returns text (a stream of text chunks with stream=True), the typed
+        record as a dict in structured mode, or the full report's sections.
+        """
+        if analysis_type == "computed_nutrition":
+            ingredients = self.analysis(data, image, image_id, "ingredients", structured=structured)
+            if structured:
+                return lambda: nutrition_report(RECORD_TYPES["ingredients"].from_dict(ingredients()).markdown())
+            return lambda: nutrition_report(ingredients())
+
+        if analysis_type == "full_report":
+            prompt, store_type = FULL_REPORT_SYSTEM_PROMPT, "full report"
+            if self.pool is not None:
+                work = lambda: self.pool.full_report(image, image_id)
+            elif self.scheduler is not None:
+                work = lambda: split_full_report(self.scheduler.analyze(
+                    image, prompt, "full report", max_new_tokens=FULL_REPORT_MAX_NEW_TOKENS
+                ))
+            else:
+                work = lambda: full_report(image, self.model, self.processor, image_id=image_id)
+        elif structured and analysis_type in STRUCTURED_PROMPTS:
+            prompt, store_type = STRUCTURED_PROMPTS[analysis_type], f"{analysis_type}:json"
+            if self.pool is not None:
+                work = lambda: asdict(self.pool.analyze_structured(image, analysis_type, image_id))
+            elif self.scheduler is not None:
+                work = lambda: asdict(parse_record(analysis_type, self.scheduler.analyze(
+                    image, prompt, analysis_type, structured=True
+                )))
+            else:
+                work = lambda: asdict(analyze_structured(
+                    image, analysis_type, self.model, self.processor, image_id=image_id
+                ))
+        else:
+            prompt = GENERAL_FOOD_PROMPT if analysis_type == "general" else LOCAL_ANALYSES[analysis_type]
+            store_type = analysis_type
+            if self.pool is not None:
+                work = lambda: self.pool.analyze(image, prompt, analysis_type, user_question, image_id)
+            elif self.scheduler is not None:
+                work = lambda: self.scheduler.analyze(image, prompt, analysis_type, user_question)
+            else:
+                generate = stream_analyze_food if stream else analyze_food
+                work = lambda: generate(
+                    image, prompt, analysis_type, self.model, self.processor, user_question, image_id=image_id
+                )
+        return self.store.through(
+            work, image_digest(data), store_type, self.model_id, prompt, user_question,
+            image=image, size_bytes=len(data)
+        )
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+        self.store.close()
+
+
+service = None
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global service
+    # Loading takes a while; keep the event loop free meanwhile
+    service = await asyncio.to_thread(FoodService.from_env)
+    await service.queue.start()
+    yield
+    await service.queue.stop()
+    service.close()
+
+
+app = FastAPI(title="Food analyzer", lifespan=lifespan)
+
+
+async def read_image(upload):
+    """(bytes, image, image id) for an uploaded image; 400 if it does not decode"""
+    data = await upload.read()
+    try:
+        image, image_id = await asyncio.to_thread(service.decode, data)
+    except (UnidentifiedImageError, OSError) as e:
+        raise HTTPException(400, f"{upload.filename or 'upload'} is not a readable image: {e}") from e
+    return data, image, image_id
+
+
+async def queued(work):
+    try:
+        return await service.queue.run(work)
+    except QueueFull as e:
+        raise HTTPException(503, str(e), headers={"Retry-After": "5"}) from e
+
+
+def streamed(work):
+    try:
+        chunks = service.queue.stream(work)
+    except QueueFull as e:
+        raise HTTPException(503, str(e), headers={"Retry-After": "5"}) from e
+    return StreamingResponse(chunks, media_type="text/plain; charset=utf-8")
+
+
+@app.post("/validate")
+async def validate(image: UploadFile = File(...)):
+    _, decoded, image_id = await read_image(image)
+    is_food = await queued(lambda: service.validate(decoded, image_id))
+    return {"model": service.model_name, "is_food": bool(is_food)}
+
+
+@app.post("/analyze/{analysis_type}")
+async def analyze(analysis_type: str, image: UploadFile = File(...), structured: bool = False, stream: bool = False):
+    if analysis_type not in SERVED_ANALYSES:
+        raise HTTPException(404, f"unknown analysis {analysis_type!r}; one of {', '.join(sorted(SERVED_ANALYSES))}")
+    if stream and (structured or analysis_type not in LOCAL_ANALYSES):
+        raise HTTPException(400, "only markdown ingredients, recipe and nutrition answers stream")
+    data, decoded, image_id = await read_image(image)
+    work = service.analysis(data, decoded, image_id, analysis_type, structured=structured, stream=stream)
+    if stream:
+        return streamed(work)
+    result = await queued(work)
+    return {"model": service.model_name, "analysis_type": analysis_type, "result": result}
+
+
+@app.post("/ask")
+async def ask(image: UploadFile = File(...), question: str = Form(...), stream: bool = False):
+    if not question.strip():
+        raise HTTPException(400, "question is empty")
+    data, decoded, image_id = await read_image(image)
+    work = service.analysis(data, decoded, image_id, "general", question, stream=stream)
+    if stream:
+        return streamed(work)
+    return {"model": service.model_name, "answer": await queued(work)}
+
+
+@app.post("/batch")
+async def batch(
+    images: list[UploadFile] = File(...), analyses: str = Form("validate,ingredients"), structured: bool = Form(False)
+):
+    """One JSON line per image as it finishes, in upload order; analyses as in batch.py"""
+    names = [name.strip() for name in analyses.split(",") if name.strip()]
+    unknown = [name for name in names if name not in LOCAL_BATCH_ANALYSES]
+    if unknown:
+        raise HTTPException(400, f"unknown analyses: {', '.join(unknown)}")
+
+    def analyze_image(data, image, image_id):
+        record = {}
+        if "validate" in names:
+            record["is_food"] = bool(service.validate(image, image_id))
+            if not record["is_food"]:
+                return record
+        record["results"] = {
+            name: service.analysis(data, image, image_id, name, structured=structured)()
+            for name in names if name != "validate"
+        }
+        return record
+
+    async def records():
+        for upload in images:
+            record = {"filename": upload.filename}
+            try:
+                data, decoded, image_id = await read_image(upload)
+                record["sha256"] = image_digest(data)
+                record.update(await service.queue.run(lambda: analyze_image(data, decoded, image_id)))
+            except HTTPException as e:
+                record["error"] = e.detail
+            except Exception as e:
+                record["error"] = str(e)
+            yield json.dumps(record) + "\n"
+
+    return StreamingResponse(records(), media_type="application/x-ndjson")
+
+
+@app.get("/health")
+async def health():
+    return {
+        "status": "ok",
+        "model": service.model_name,
+        "precision": service.precision,
+        "batching": service.scheduler is not None,
+        **service.queue.stats(),
+        **({"worker_pool": service.pool.stats()} if service.pool is not None else {}),
+    }
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    stats = service.queue.stats()
+    lines = [
+        "# TYPE food_server_queued gauge",
+        f"food_server_queued {stats['queued']}",
+        "# TYPE food_server_running gauge",
+        f"food_server_running {stats['running']}",
+        "# TYPE food_server_completed_total counter",
+        f"food_server_completed_total {stats['completed']}",
+        "# TYPE food_server_rejected_total counter",
+        f"food_server_rejected_total {stats['rejected']}",
+    ]
+    return METRICS.prometheus_text() + "\n".join(lines) + "\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the local food analyzers over HTTP")
+    parser.add_argument("--model", default=os.getenv("SERVER_MODEL", "Qwen2-VL-7B-Instruct"), choices=list(MODEL_SPECS))
+    parser.add_argument(
+        "--precision", default=os.getenv("SERVER_PRECISION", "auto"), choices=["auto", "bf16", "int8", "int4"]
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=1, help="server processes, each with its own copy of the model")
+    parser.add_argument("--max-queue", type=int, default=int(os.getenv("SERVER_MAX_QUEUE", "64")),
+                        help="requests waiting per worker before new ones get 503")
+    parser.add_argument("--cpu-workers", type=int, default=int(os.getenv("SERVER_CPU_WORKERS", "0")),
+                        help="run the model in this many core-pinned processes (CPU hosts; use with --workers 1)")
+    parser.add_argument("--threads-per-worker", type=int, default=int(os.getenv("SERVER_THREADS_PER_WORKER", "0")),
+                        help="intra-op threads and cores per CPU worker (default: the cores split evenly)")
+    parser.add_argument("--dispatch", default=os.getenv("SERVER_DISPATCH", "queue_depth"), choices=DISPATCH_MODES)
+    args = parser.parse_args()
+
+    # Worker processes import this module afresh and configure themselves from the environment
+    os.environ.update(
+        SERVER_MODEL=args.model, SERVER_PRECISION=args.precision, SERVER_MAX_QUEUE=str(args.max_queue),
+        SERVER_CPU_WORKERS=str(args.cpu_workers), SERVER_THREADS_PER_WORKER=str(args.threads_per_worker),
+        SERVER_DISPATCH=args.dispatch
+    )
+    uvicorn.run("server:app", host=args.host, port=args.port, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
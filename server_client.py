@@ -0,0 +1,83 @@
+# Client for server.py, used by the Streamlit apps in thin-client mode
+#
+# With INFERENCE_SERVER_URL set the apps load no model; validation and analyses
+# are requests to the server, and answers stream back chunk by chunk.
+
+import io
+import os
+
+import requests
+
+# Uploads are sent already preprocessed, so a high JPEG quality costs little
+UPLOAD_QUALITY = 95
+
+
+def encode_upload(image):
+    """Bytes to upload for a PIL image, or the bytes themselves"""
+    if isinstance(image, (bytes, bytearray)):
+        return bytes(image)
+    buffer = io.BytesIO()
+    image.convert("RGB").save(buffer, format="JPEG", quality=UPLOAD_QUALITY)
+    return buffer.getvalue()
+
+
+class InferenceClient:
+    """validate / analyze / stream_analyze against a running server.py"""
+
+    def __init__(self, base_url, timeout_s=600):
+        self.base_url = base_url.rstrip("/")
+        self.timeout_s = timeout_s
+        self.session = requests.Session()
+
+    @classmethod
+    def from_env(cls):
+        """A client for INFERENCE_SERVER_URL, or None when the apps should run the model themselves"""
+        url = os.getenv("INFERENCE_SERVER_URL")
+        if not url:
+            return None
+        return cls(url, timeout_s=float(os.getenv("INFERENCE_SERVER_TIMEOUT_S", "600")))
+
+    def _post(self, path, image, data=None, params=None, stream=False):
+        response = self.session.post(
+            f"{self.base_url}{path}",
+            files={"image": ("image.jpg", encode_upload(image), "image/jpeg")},
+            data=data,
+            params=params,
+            stream=stream,
+            timeout=(5, self.timeout_s)
+        )
+        if not response.ok:
+            try:
+                detail = response.json().get("detail", response.text)
+            except ValueError:
+                detail = response.text
+            raise RuntimeError(f"inference server answered {response.status_code}: {detail}")
+        return response
+
+    def health(self):
+        response = self.session.get(f"{self.base_url}/health", timeout=5)
+        response.raise_for_status()
+        return response.json()
+
+    def validate(self, image):
+        return self._post("/validate", image).json()["is_food"]
+
+    def analyze(self, image, analysis_type, user_question="", structured=False):
+        """The whole answer: text, a structured record as a dict, or full-report sections"""
+        if analysis_type == "general":
+            return self._post("/ask", image, data={"question": user_question}).json()["answer"]
+        params = {"structured": "true"} if structured else None
+        return self._post(f"/analyze/{analysis_type.replace(' ', '_')}", image, params=params).json()["result"]
+
+    def stream_analyze(self, image, analysis_type, user_question=""):
+        """Yield the answer's text chunks as the server generates them"""
+        if analysis_type == "general":
+            response = self._post(
+                "/ask", image, data={"question": user_question}, params={"stream": "true"}, stream=True
+            )
+        else:
+            response = self._post(f"/analyze/{analysis_type}", image, params={"stream": "true"}, stream=True)
+        with response:
+            for chunk in response.iter_content(chunk_size=None, decode_unicode=True):
+                if chunk:
+                    yield chunk
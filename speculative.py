@@ -0,0 +1,177 @@
+# Speculative decoding with a small draft VLM
+#
+# The draft model proposes a few tokens greedily; the target model scores them all
+# in one forward pass and keeps the longest prefix that matches its own greedy
+# choice, plus its own next token. The answer is token-for-token the target's
+# greedy answer; only the number of target forward passes changes.
+#
+# Unlike transformers' assistant_model, each model gets inputs from its own
+# processor, so the pair may tile and expand images differently as long as their
+# text vocabularies agree.
+
+import threading
+
+import torch
+from transformers import DynamicCache
+
+from prefix_cache import _last_logit_only
+
+DEFAULT_DRAFT_TOKENS = 4
+
+
+class SpeculativeStats:
+    """Draft acceptance counters across requests"""
+
+    def __init__(self):
+        self.requests = 0
+        self.proposed = 0
+        self.accepted = 0
+        self.generated = 0
+        self.target_forwards = 0
+        self._lock = threading.Lock()
+
+    def record(self, proposed, accepted, generated, target_forwards):
+        with self._lock:
+            self.requests += 1
+            self.proposed += proposed
+            self.accepted += accepted
+            self.generated += generated
+            self.target_forwards += target_forwards
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "acceptance_rate": self.accepted / self.proposed if self.proposed else 0.0,
+                # 1.0 is plain decoding; draft_tokens + 1 is the ceiling
+                "tokens_per_target_forward": (
+                    self.generated / self.target_forwards if self.target_forwards else 0.0
+                ),
+            }
+
+
+SPECULATIVE_STATS = SpeculativeStats()
+
+
+def tokenizers_compatible(processor, draft_processor):
+    """True when every token the draft can emit means the same thing to the target"""
+    target_vocab = processor.tokenizer.get_vocab()
+    draft_vocab = draft_processor.tokenizer.get_vocab()
+    if processor.tokenizer.eos_token_id != draft_processor.tokenizer.eos_token_id:
+        return False
+    return all(target_vocab.get(token) == token_id for token, token_id in draft_vocab.items())
+
+
+def _forward(model, cache, input_ids, extra_inputs=None, last_only=False):
+    """Run input_ids on top of cache; returns logits for the new positions"""
+    past_length = cache.get_seq_length()
+    new_length = input_ids.shape[1]
+    positions = torch.arange(past_length, past_length + new_length, device=input_ids.device)
+    attention_mask = torch.ones((1, past_length + new_length), dtype=torch.long, device=input_ids.device)
+    kwargs = dict(extra_inputs or {})
+    if last_only:
+        kwargs.update(_last_logit_only(model))
+    outputs = model(
+        input_ids=input_ids,
+        attention_mask=attention_mask,
+        past_key_values=cache,
+        cache_position=positions,
+        use_cache=True,
+        **kwargs
+    )
+    return outputs.logits[0]
+
+
+def _prefill(model, inputs):
+    """Prompt (with image) forward pass into a fresh cache; returns (cache, greedy next token)"""
+    cache = DynamicCache()
+    extra = {key: value for key, value in inputs.items() if key not in ("input_ids", "attention_mask")}
+    logits = _forward(model, cache, inputs["input_ids"], extra, last_only=True)
+    return cache, int(logits[-1].argmax())
+
+
+@torch.no_grad()
+def speculative_generate(model, inputs, draft_model, draft_inputs, max_new_tokens,
+                         draft_tokens=DEFAULT_DRAFT_TOKENS, streamer=None, stopping_criteria=None):
+    """Greedy decoding of model, drafted by draft_model.
+
+    inputs and draft_inputs are the same prompt prepared by each model's own
+    processor. Returns the prompt followed by the generated ids, shaped like
+    model.generate() output; streamer gets the same put()/end() calls generate()
+    would make, and stopping_criteria (a StoppingCriteriaList) is checked after
+    every accepted run of tokens.
+    """
+    input_ids = inputs["input_ids"]
+    eos_token_id = model.generation_config.eos_token_id
+    eos_ids = set(eos_token_id if isinstance(eos_token_id, list) else [eos_token_id])
+    if streamer is not None:
+        streamer.put(input_ids.cpu())
+
+    target_cache, first_token = _prefill(model, inputs)
+    draft_cache, _ = _prefill(draft_model, draft_inputs)
+    draft_prompt_length = draft_cache.get_seq_length()
+
+    generated = [first_token]
+    if streamer is not None:
+        streamer.put(torch.tensor([first_token]))
+    # Generated tokens whose keys/values are valid in the draft cache
+    draft_valid = 0
+    proposed = accepted = 0
+    target_forwards = 1
+
+    def should_stop():
+        if stopping_criteria is None:
+            return False
+        so_far = torch.tensor([generated], device=input_ids.device, dtype=input_ids.dtype)
+        return bool(stopping_criteria(torch.cat([input_ids, so_far], dim=1), None).all())
+
+    stopped = should_stop()
+    while not stopped and len(generated) < max_new_tokens and generated[-1] not in eos_ids:
+        budget = min(draft_tokens, max_new_tokens - len(generated))
+
+        # Draft: catch up on tokens it has not seen, then propose greedily
+        draft_cache.crop(draft_prompt_length + draft_valid)
+        pending = torch.tensor([generated[draft_valid:]], device=draft_model.device)
+        token = int(_forward(draft_model, draft_cache, pending, last_only=True)[-1].argmax())
+        proposal = [token]
+        while len(proposal) < budget and token not in eos_ids:
+            step = torch.tensor([[token]], device=draft_model.device)
+            token = int(_forward(draft_model, draft_cache, step)[-1].argmax())
+            proposal.append(token)
+
+        # Target: score the last accepted token and the whole proposal at once;
+        # its cache holds everything before the last accepted token
+        target_cache.crop(input_ids.shape[1] + len(generated) - 1)
+        verify = torch.tensor([[generated[-1]] + proposal], device=input_ids.device)
+        choices = _forward(model, target_cache, verify).argmax(-1).tolist()
+        target_forwards += 1
+
+        matched = 0
+        while matched < len(proposal) and proposal[matched] == choices[matched]:
+            matched += 1
+        new_tokens = proposal[:matched] + [choices[matched]]
+        proposed += len(proposal)
+        accepted += matched
+
+        # The draft fed all but its last proposal into its cache
+        draft_valid = len(generated) + min(matched, len(proposal) - 1)
+        for index, token in enumerate(new_tokens):
+            if token in eos_ids:
+                new_tokens = new_tokens[:index + 1]
+                break
+        new_tokens = new_tokens[:max_new_tokens - len(generated)]
+        generated.extend(new_tokens)
+        if streamer is not None:
+            streamer.put(torch.tensor(new_tokens))
+        stopped = should_stop()
+
+    if streamer is not None:
+        streamer.end()
+    SPECULATIVE_STATS.record(proposed, accepted, len(generated), target_forwards)
+
+    output = torch.tensor([generated], device=input_ids.device, dtype=input_ids.dtype)
+    return torch.cat([input_ids, output], dim=1), {
+        "proposed": proposed,
+        "accepted": accepted,
+        "target_forwards": target_forwards,
+    }
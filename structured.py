@@ -0,0 +1,315 @@
+# Structured (JSON) analysis results
+#
+# In structured mode the model answers with one JSON object per analysis type
+# instead of the markdown templates in prompts.py: no tables, headers or emojis
+# to generate, and nothing to scrape with regexes downstream. Answers are parsed
+# into the typed records below, and the UI renders markdown from the records.
+# Local decoding is constrained to the schema with lm-format-enforcer, single or
+# batched; Gemini gets the schema as its responseSchema.
+
+import json
+import re
+import threading
+import weakref
+from dataclasses import dataclass, field
+
+try:
+    from lmformatenforcer import JsonSchemaParser
+    from lmformatenforcer.integrations.transformers import (
+        build_token_enforcer_tokenizer_data,
+        build_transformers_prefix_allowed_tokens_fn
+    )
+except ImportError:
+    JsonSchemaParser = None
+
+
+class StructuredOutputError(ValueError):
+    """An answer that is not valid JSON for its analysis type's schema"""
+
+
+_STRING = {"type": "string"}
+_STRINGS = {"type": "array", "items": _STRING}
+_NUMBER = {"type": "number"}
+_INGREDIENT = {
+    "type": "object",
+    "properties": {"name": _STRING, "quantity": _STRING, "notes": _STRING},
+    "required": ["name", "quantity"],
+}
+
+# JSON schema per analysis type. Array lengths are capped so a model cannot
+# loop on list items until it runs out of tokens.
+SCHEMAS = {
+    "ingredients": {
+        "type": "object",
+        "properties": {
+            "dish": _STRING,
+            "ingredients": {"type": "array", "items": _INGREDIENT, "maxItems": 25},
+            "seasonings": {"type": "array", "items": _INGREDIENT, "maxItems": 20},
+            "cooking_methods": {**_STRINGS, "maxItems": 5},
+            "cuisine": _STRING,
+        },
+        "required": ["dish", "ingredients", "seasonings", "cooking_methods", "cuisine"],
+    },
+    "recipe": {
+        "type": "object",
+        "properties": {
+            "dish": _STRING,
+            "servings": {"type": "integer"},
+            "prep_minutes": {"type": "integer"},
+            "cook_minutes": {"type": "integer"},
+            "difficulty": {"type": "string", "enum": ["Easy", "Medium", "Hard"]},
+            "ingredients": {"type": "array", "items": _INGREDIENT, "maxItems": 30},
+            "steps": {**_STRINGS, "maxItems": 20},
+            "tips": {**_STRINGS, "maxItems": 5},
+        },
+        "required": ["dish", "servings", "prep_minutes", "cook_minutes", "difficulty", "ingredients", "steps", "tips"],
+    },
+    "nutrition": {
+        "type": "object",
+        "properties": {
+            "items": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "name": _STRING, "portion": _STRING, "calories": _NUMBER,
+                        "carbs_g": _NUMBER, "protein_g": _NUMBER, "fat_g": _NUMBER,
+                    },
+                    "required": ["name", "portion", "calories", "carbs_g", "protein_g", "fat_g"],
+                },
+                "maxItems": 15,
+            },
+            "allergens": {**_STRINGS, "maxItems": 10},
+            "confidence": {"type": "string", "enum": ["High", "Medium", "Low"]},
+        },
+        "required": ["items", "allergens", "confidence"],
+    },
+}
+
+
+def _require(data, key, kind):
+    value = data.get(key)
+    if not isinstance(value, kind):
+        raise StructuredOutputError(f"{key!r} is missing or not a {kind.__name__}")
+    return value
+
+
+def _number(value):
+    """A number, also from answers such as "320 kcal" that slip past an unconstrained decode"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    found = re.search(r"-?\d+(?:\.\d+)?", str(value))
+    if found is None:
+        raise StructuredOutputError(f"expected a number, got {value!r}")
+    return float(found.group())
+
+
+@dataclass
+class Ingredient:
+    name: str
+    quantity: str
+    notes: str = ""
+
+    @classmethod
+    def from_dict(cls, data):
+        if not isinstance(data, dict):
+            raise StructuredOutputError(f"expected an ingredient object, got {data!r}")
+        return cls(_require(data, "name", str), str(data.get("quantity", "")), str(data.get("notes") or ""))
+
+
+def _ingredient_table(title, ingredients):
+    # Same columns as the markdown template, so nutrition.parse_ingredients() reads both
+    lines = [f"**{title}**", "", "| S.No | Ingredient Name | Estimated Quantity | Notes |", "|---|---|---|---|"]
+    lines += [f"| {i} | {item.name} | {item.quantity} | {item.notes} |" for i, item in enumerate(ingredients, 1)]
+    return "\n".join(lines)
+
+
+@dataclass
+class IngredientsRecord:
+    dish: str
+    ingredients: list
+    seasonings: list
+    cooking_methods: list = field(default_factory=list)
+    cuisine: str = ""
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            dish=_require(data, "dish", str),
+            ingredients=[Ingredient.from_dict(item) for item in _require(data, "ingredients", list)],
+            seasonings=[Ingredient.from_dict(item) for item in data.get("seasonings") or []],
+            cooking_methods=[str(method) for method in data.get("cooking_methods") or []],
+            cuisine=str(data.get("cuisine") or ""),
+        )
+
+    def markdown(self):
+        parts = [f"**Ingredients to cook: {self.dish}**", _ingredient_table("Ingredients", self.ingredients)]
+        if self.seasonings:
+            parts.append(_ingredient_table("Spices, Seasonings & Garnishes", self.seasonings))
+        if self.cooking_methods:
+            parts.append("**Cooking Method(s):** " + ", ".join(self.cooking_methods))
+        if self.cuisine:
+            parts.append(f"**Cuisine Type:** {self.cuisine}")
+        return "\n\n".join(parts)
+
+
+@dataclass
+class RecipeRecord:
+    dish: str
+    servings: int
+    prep_minutes: int
+    cook_minutes: int
+    difficulty: str
+    ingredients: list
+    steps: list
+    tips: list = field(default_factory=list)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            dish=_require(data, "dish", str),
+            servings=int(_number(data.get("servings"))),
+            prep_minutes=int(_number(data.get("prep_minutes"))),
+            cook_minutes=int(_number(data.get("cook_minutes"))),
+            difficulty=str(data.get("difficulty") or ""),
+            ingredients=[Ingredient.from_dict(item) for item in _require(data, "ingredients", list)],
+            steps=[str(step) for step in _require(data, "steps", list)],
+            tips=[str(tip) for tip in data.get("tips") or []],
+        )
+
+    def markdown(self):
+        parts = [
+            f"**{self.dish}**",
+            f"Serves {self.servings} · Prep {self.prep_minutes} min · Cook {self.cook_minutes} min · "
+            f"Total {self.prep_minutes + self.cook_minutes} min · {self.difficulty}",
+            "**Ingredients**\n\n" + "\n".join(f"- {item.quantity} {item.name}".rstrip() for item in self.ingredients),
+            "**Step-by-Step Instructions**\n\n" + "\n".join(f"{i}. {step}" for i, step in enumerate(self.steps, 1)),
+        ]
+        if self.tips:
+            parts.append("**Pro Tips**\n\n" + "\n".join(f"- {tip}" for tip in self.tips))
+        return "\n\n".join(parts)
+
+
+@dataclass
+class FoodFacts:
+    name: str
+    portion: str
+    calories: float
+    carbs_g: float
+    protein_g: float
+    fat_g: float
+
+    @classmethod
+    def from_dict(cls, data):
+        if not isinstance(data, dict):
+            raise StructuredOutputError(f"expected a food item object, got {data!r}")
+        return cls(
+            name=_require(data, "name", str),
+            portion=str(data.get("portion", "")),
+            **{key: _number(data.get(key)) for key in ("calories", "carbs_g", "protein_g", "fat_g")}
+        )
+
+
+@dataclass
+class NutritionRecord:
+    items: list
+    allergens: list = field(default_factory=list)
+    confidence: str = ""
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            items=[FoodFacts.from_dict(item) for item in _require(data, "items", list)],
+            allergens=[str(allergen) for allergen in data.get("allergens") or []],
+            confidence=str(data.get("confidence") or ""),
+        )
+
+    @property
+    def totals(self):
+        """Summed over the items here rather than generated, so they always add up"""
+        return {key: sum(getattr(item, key) for item in self.items)
+                for key in ("calories", "carbs_g", "protein_g", "fat_g")}
+
+    def markdown(self):
+        lines = [
+            "| Food Item | Portion | Calories | Carbs (g) | Protein (g) | Fat (g) |",
+            "|-----------|---------|----------|-----------|-------------|---------|",
+        ]
+        lines += [
+            f"| {item.name} | {item.portion} | {item.calories:.0f} kcal | {item.carbs_g:.1f} "
+            f"| {item.protein_g:.1f} | {item.fat_g:.1f} |"
+            for item in self.items
+        ]
+        t = self.totals
+        lines.append(
+            f"| **Total** | | **{t['calories']:.0f} kcal** | **{t['carbs_g']:.1f}** "
+            f"| **{t['protein_g']:.1f}** | **{t['fat_g']:.1f}** |"
+        )
+        lines.append("")
+        lines.append(f"**Allergen Information:** {', '.join(self.allergens) or 'none identified'}")
+        if self.confidence:
+            lines.append(f"\n**Confidence Level:** {self.confidence}")
+        return "\n".join(lines)
+
+
+RECORD_TYPES = {
+    "ingredients": IngredientsRecord,
+    "recipe": RecipeRecord,
+    "nutrition": NutritionRecord,
+}
+
+
+def parse_record(analysis_type, text):
+    """The typed record for a JSON answer; raises StructuredOutputError if it does not fit the schema"""
+    # Unconstrained decodes sometimes wrap the object in a code fence or a sentence
+    start, end = text.find("{"), text.rfind("}")
+    if start < 0 or end < start:
+        raise StructuredOutputError(f"no JSON object in the {analysis_type} answer")
+    try:
+        data = json.loads(text[start:end + 1])
+    except json.JSONDecodeError as e:
+        raise StructuredOutputError(f"invalid JSON in the {analysis_type} answer: {e}") from e
+    if not isinstance(data, dict):
+        raise StructuredOutputError(f"the {analysis_type} answer is not a JSON object")
+    return RECORD_TYPES[analysis_type].from_dict(data)
+
+
+def gemini_schema(schema):
+    """A JSON schema in the OpenAPI subset Gemini's responseSchema accepts"""
+    converted = {"type": schema["type"].upper()}
+    for key in ("enum", "required", "maxItems"):
+        if key in schema:
+            converted[key] = schema[key]
+    if "items" in schema:
+        converted["items"] = gemini_schema(schema["items"])
+    if "properties" in schema:
+        converted["properties"] = {name: gemini_schema(value) for name, value in schema["properties"].items()}
+        # Keep the field order of the schema, which is the order the prompts show
+        converted["propertyOrdering"] = list(schema["properties"])
+    return converted
+
+
+def gemini_generation_config(analysis_type):
+    """generationConfig asking Gemini for JSON in the analysis type's schema"""
+    return {"responseMimeType": "application/json", "responseSchema": gemini_schema(SCHEMAS[analysis_type])}
+
+
+# Dropped with the tokenizer when its model is unloaded
+_tokenizer_data = weakref.WeakKeyDictionary()
+_tokenizer_data_lock = threading.Lock()
+
+
+def json_constraint(tokenizer, analysis_type):
+    """prefix_allowed_tokens_fn restricting generate() to the analysis type's schema.
+
+    Raises ImportError without lm-format-enforcer rather than decoding
+    unconstrained answers that may not parse.
+    """
+    if JsonSchemaParser is None:
+        raise ImportError("structured mode needs lm-format-enforcer (pip install -r requirements.txt)")
+    # Building the tokenizer's character trie takes seconds; do it once per tokenizer
+    with _tokenizer_data_lock:
+        data = _tokenizer_data.get(tokenizer)
+        if data is None:
+            data = _tokenizer_data[tokenizer] = build_token_enforcer_tokenizer_data(tokenizer)
+    return build_transformers_prefix_allowed_tokens_fn(data, JsonSchemaParser(SCHEMAS[analysis_type]))
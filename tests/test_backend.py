@@ -0,0 +1,94 @@
+import io
+import types
+
+import pytest
+from PIL import Image
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("qwen_vl_utils")
+
+import backend  # noqa: E402
+import registry  # noqa: E402
+import vlm  # noqa: E402
+from batch import local_analyzer  # noqa: E402
+from cache import image_key  # noqa: E402
+from jobs import JobManager  # noqa: E402
+from prompts import INGREDIENTS_SYSTEM_PROMPT  # noqa: E402
+from result_store import ResultStore, model_id  # noqa: E402
+from structured import IngredientsRecord  # noqa: E402
+
+MODEL = "SmolVLM-256M-Instruct"
+RECORD = {
+    "dish": "Chana masala",
+    "ingredients": [{"name": "chickpeas", "quantity": "200 g", "notes": ""}],
+    "seasonings": [],
+    "cooking_methods": ["simmering"],
+    "cuisine": "Indian",
+}
+
+
+@pytest.fixture
+def upload():
+    buffer = io.BytesIO()
+    Image.new("RGB", (32, 32), "orange").save(buffer, format="PNG")
+    data = buffer.getvalue()
+    return data, Image.open(io.BytesIO(data)).convert("RGB")
+
+
+@pytest.fixture
+def offline_model(monkeypatch):
+    """batch.local_analyzer() on a registry that loads nothing"""
+    loaded = types.SimpleNamespace(model=None, processor=None)
+    monkeypatch.setattr(registry.ModelRegistry, "get", lambda self, name, precision="auto": loaded)
+
+
+def must_not_run(*args, **kwargs):
+    raise AssertionError("answered by the model instead of the result store")
+
+
+def test_app_reads_structured_answers_written_by_batch(tmp_path, upload, offline_model, monkeypatch):
+    data, image = upload
+    store = ResultStore(str(tmp_path / "results.sqlite"))
+    monkeypatch.setattr(vlm, "analyze_structured", lambda *args, **kwargs: IngredientsRecord.from_dict(RECORD))
+    analyze = local_analyzer(MODEL, ["ingredients"], precision="bf16", structured=True, store=store)
+    assert analyze(data, image)["results"]["ingredients"] == RECORD
+
+    monkeypatch.setattr(backend, "analyze_structured", must_not_run)
+    spec = registry.MODEL_SPECS[MODEL]
+    image_id = image_key(data, model_id(spec.path, "bf16", spec.max_pixels))
+    app = backend.AnalysisBackend(JobManager(), store, "model", structured=True)
+    work, _, _ = app.panel_work(image, image_id, INGREDIENTS_SYSTEM_PROMPT, "ingredients")
+    assert work() == IngredientsRecord.from_dict(RECORD).markdown()
+
+
+def test_app_reads_full_reports_written_by_batch(tmp_path, upload, offline_model, monkeypatch):
+    data, image = upload
+    store = ResultStore(str(tmp_path / "results.sqlite"))
+    sections = {"ingredients": "Chickpeas", "recipe": "Simmer", "nutrition": ""}
+    monkeypatch.setattr(vlm, "full_report", lambda *args, **kwargs: sections)
+    analyze = local_analyzer(MODEL, ["full_report"], precision="bf16", store=store)
+    assert analyze(data, image)["results"] == sections
+
+    monkeypatch.setattr(backend, "full_report", must_not_run)
+    spec = registry.MODEL_SPECS[MODEL]
+    image_id = image_key(data, model_id(spec.path, "bf16", spec.max_pixels))
+    app = backend.AnalysisBackend(JobManager(), store, "model")
+    work, _, _ = app.full_report_work(image, image_id)
+    assert work() == backend.render_full_report(sections)
+
+
+def test_batch_runs_ingredients_once_for_computed_nutrition(upload, offline_model, monkeypatch):
+    data, image = upload
+    calls = []
+
+    def analyze_food(image, system_prompt, analysis_type, *args, **kwargs):
+        calls.append(analysis_type)
+        return "| 1 | chickpeas | 200 g | |"
+
+    monkeypatch.setattr(vlm, "analyze_food", analyze_food)
+    # No result store: the answer is still shared within the image
+    analyze = local_analyzer(MODEL, ["computed_nutrition", "ingredients"], precision="bf16")
+    results = analyze(data, image)["results"]
+    assert calls == ["ingredients"]
+    assert results["ingredients"] == "| 1 | chickpeas | 200 g | |"
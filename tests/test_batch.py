@@ -0,0 +1,64 @@
+import json
+
+from PIL import Image
+
+from batch import completed_paths, iter_image_paths, prefetch, shard, shard_output_path
+
+
+def write_lines(path, lines):
+    path.write_text("".join(line + "\n" for line in lines))
+
+
+def test_completed_paths_missing_file(tmp_path):
+    assert completed_paths(str(tmp_path / "out.jsonl")) == set()
+
+
+def test_completed_paths_retries_errors_and_ignores_torn_lines(tmp_path):
+    output = tmp_path / "out.jsonl"
+    write_lines(output, [
+        json.dumps({"path": "a.jpg", "ingredients": "rice"}),
+        json.dumps({"path": "b.jpg", "error": "HTTP 503"}),
+        json.dumps({"path": "c.jpg", "error": "timeout"}),
+        json.dumps({"path": "c.jpg", "ingredients": "beans"}),
+        json.dumps({"summary": True}),
+        json.dumps(["not", "a", "record"]),
+    ])
+    # A run killed mid-write leaves a partial last line
+    with open(output, "a") as f:
+        f.write('{"path": "d.jpg", "ingred')
+    assert completed_paths(str(output)) == {"a.jpg", "c.jpg"}
+
+
+def test_iter_image_paths_walks_directories_in_order(tmp_path):
+    (tmp_path / "b").mkdir()
+    for name in ("b/2.png", "b/1.JPG", "a.jpeg"):
+        Image.new("RGB", (4, 4)).save(tmp_path / name, format="PNG")
+    (tmp_path / "notes.txt").write_text("")
+    paths = [path[len(str(tmp_path)) + 1:] for path in iter_image_paths(str(tmp_path))]
+    assert paths == ["a.jpeg", "b/1.JPG", "b/2.png"]
+
+
+def test_iter_image_paths_reads_manifests(tmp_path):
+    manifest = tmp_path / "manifest.jsonl"
+    write_lines(manifest, ["a.jpg", "", json.dumps({"path": "b.jpg", "label": "food"})])
+    assert list(iter_image_paths(str(manifest))) == ["a.jpg", "b.jpg"]
+
+
+def test_shards_cover_every_path_once():
+    paths = [f"{i}.jpg" for i in range(10)]
+    shards = [list(shard(paths, 3, index)) for index in range(3)]
+    assert sorted(sum(shards, [])) == sorted(paths)
+    assert shards[1] == ["1.jpg", "4.jpg", "7.jpg"]
+    assert shard_output_path("out.jsonl", 1, 0) == "out.jsonl"
+    assert shard_output_path("out.jsonl", 3, 1) == "out.shard-1-of-3.jsonl"
+
+
+def test_prefetch_keeps_input_order(tmp_path):
+    paths = []
+    for i in range(5):
+        path = tmp_path / f"{i}.png"
+        Image.new("RGB", (10 + i, 10)).save(path)
+        paths.append(str(path))
+    loaded = [(path, future.result()) for path, future in prefetch(paths, workers=3, lookahead=2)]
+    assert [path for path, _ in loaded] == paths
+    assert [image.size[0] for _, (_, image) in loaded] == [10, 11, 12, 13, 14]
@@ -0,0 +1,139 @@
+import io
+import random
+import time
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from cache import BKTree, NearDuplicateCache, dhash, hamming_distance
+
+
+def photo(seed):
+    """A smooth random image, so hashes come from structure rather than pixel noise"""
+    rng = np.random.default_rng(seed)
+    small = rng.integers(0, 256, (6, 6, 3), dtype=np.uint8)
+    return Image.fromarray(small).resize((320, 240), Image.Resampling.BICUBIC)
+
+
+def reencoded(image, quality=60):
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality)
+    return Image.open(io.BytesIO(buffer.getvalue()))
+
+
+def test_dhash_is_64_bits_and_stable():
+    image = photo(0)
+    value = dhash(image)
+    assert 0 <= value < 2 ** 64
+    assert dhash(image.copy()) == value
+
+
+def test_dhash_near_duplicates_are_close():
+    image = photo(1)
+    value = dhash(image)
+    assert hamming_distance(value, dhash(reencoded(image))) <= 6
+    assert hamming_distance(value, dhash(image.resize((200, 150)))) <= 6
+    assert hamming_distance(value, dhash(photo(2))) > 6
+
+
+@pytest.mark.parametrize("hash_size", [4, 8, 16])
+def test_dhash_size(hash_size):
+    assert dhash(photo(13), hash_size) < 2 ** (hash_size * hash_size)
+
+
+def test_bktree_search_matches_brute_force():
+    rng = random.Random(0)
+    values = [rng.getrandbits(16) for _ in range(300)]
+    tree = BKTree()
+    for i, value in enumerate(values):
+        tree.add(value, i)
+
+    query = rng.getrandbits(16)
+    expected = sorted(
+        (hamming_distance(query, value), i) for i, value in enumerate(values)
+        if hamming_distance(query, value) <= 3
+    )
+    matches = tree.search(query, 3)
+    assert sorted(matches) == expected
+    assert [distance for distance, _ in matches] == sorted(distance for distance, _ in matches)
+
+
+def test_bktree_remove_keeps_routing():
+    tree = BKTree()
+    tree.add(0b0000, "root")
+    tree.add(0b0001, "child")
+    tree.add(0b0011, "grandchild")
+    tree.remove(0b0000, "root")
+    assert tree.search(0b0000, 0) == []
+    assert tree.search(0b0011, 0) == [(0, "grandchild")]
+    assert tree.search(0b0000, 2) == [(1, "child"), (2, "grandchild")]
+
+
+def test_bktree_empty():
+    assert BKTree().search(5, 10) == []
+
+
+def test_near_duplicate_hit_per_namespace():
+    cache = NearDuplicateCache()
+    image = photo(3)
+    cache.put(image, "ingredients", {"answer": "rice"})
+    assert cache.get(reencoded(image), "ingredients") == {"answer": "rice"}
+    assert cache.get(image, "recipe") is None
+    assert cache.get(photo(4), "ingredients") is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 2
+
+
+def test_near_duplicate_get_or_compute_runs_once():
+    cache = NearDuplicateCache()
+    image = photo(5)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return "answer"
+
+    assert cache.get_or_compute(image, "ns", compute) == "answer"
+    assert cache.get_or_compute(reencoded(image), "ns", compute) == "answer"
+    assert len(calls) == 1
+
+
+def test_near_duplicate_evicts_least_recently_used():
+    cache = NearDuplicateCache(max_entries=2)
+    first, second, third = photo(6), photo(7), photo(8)
+    cache.put(first, "ns", 1)
+    cache.put(second, "ns", 2)
+    assert cache.get(first, "ns") == 1
+    cache.put(third, "ns", 3)
+    assert cache.get(second, "ns") is None
+    assert cache.get(first, "ns") == 1
+    assert cache.get(third, "ns") == 3
+
+
+def test_near_duplicate_expires(monkeypatch):
+    cache = NearDuplicateCache(ttl_s=60)
+    image = photo(9)
+    cache.put(image, "ns", "old")
+    now = time.time()
+    monkeypatch.setattr("cache.time.time", lambda: now + 120)
+    assert cache.get(image, "ns") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_near_duplicate_disabled():
+    cache = NearDuplicateCache(max_distance=-1)
+    image = photo(10)
+    cache.put(image, "ns", "answer")
+    assert cache.get(image, "ns") is None
+
+
+def test_near_duplicate_reloads_from_sqlite(tmp_path):
+    db_path = str(tmp_path / "near.db")
+    image = photo(11)
+    NearDuplicateCache(db_path=db_path).put(image, "ns", {"calories": 320})
+
+    reopened = NearDuplicateCache(db_path=db_path)
+    assert reopened.get(reencoded(image), "ns") == {"calories": 320}
+    reopened.put(photo(12), "ns", "new")
+    assert reopened.stats()["entries"] == 2
@@ -0,0 +1,139 @@
+import time
+
+import pytest
+from PIL import Image
+
+from fake_gemini import DEFAULT_REPLY, start_fake_gemini
+from gemini_client import (
+    GeminiClient,
+    GeminiError,
+    ImagePayloadCache,
+    backoff_delay,
+    build_request,
+    response_text
+)
+
+
+@pytest.fixture
+def fake():
+    servers = []
+
+    def start(**options):
+        server = start_fake_gemini(**{"latency_ms": 0, "chunk_ms": 0, **options})
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def client():
+    clients = []
+
+    def make(endpoint, **options):
+        options = {"api_key": "test", "requests_per_minute": 6000, "base_delay_s": 0.01, "max_delay_s": 0.05,
+                   **options}
+        gemini = GeminiClient(endpoint=endpoint, **options)
+        clients.append(gemini)
+        return gemini
+
+    yield make
+    for gemini in clients:
+        gemini.close()
+
+
+def body():
+    part, _ = ImagePayloadCache().part(Image.new("RGB", (32, 32), "orange"))
+    return build_request("What is this dish?", part)
+
+
+@pytest.mark.parametrize("attempt, expected", [(0, 1.0), (1, 2.0), (2, 4.0), (10, 8.0)])
+def test_backoff_delay_jitters_around_exponential(attempt, expected):
+    for _ in range(50):
+        assert 0.5 * expected <= backoff_delay(attempt, 1.0, 8.0) <= 1.5 * expected
+
+
+def test_backoff_delay_prefers_retry_after():
+    assert backoff_delay(3, 1.0, 8.0, retry_after="2") == 2.0
+    assert backoff_delay(0, 1.0, 8.0, retry_after="0.25") == 0.25
+    # An HTTP-date Retry-After falls back to the exponential delay
+    assert 0.5 <= backoff_delay(0, 1.0, 8.0, retry_after="Wed, 21 Oct 2026 07:28:00 GMT") <= 1.5
+
+
+def test_generate(fake, client):
+    server = fake()
+    gemini = client(server.url)
+    assert response_text(gemini.generate(body())) == DEFAULT_REPLY
+    assert gemini.stats() == {"requests": 1, "retries": 0, "failures": 0}
+
+
+def test_retries_rate_limited_requests(fake, client):
+    server = fake(fail_first=2)
+    gemini = client(server.url)
+    assert response_text(gemini.generate(body())) == DEFAULT_REPLY
+    assert server.requests == 3
+    assert gemini.stats() == {"requests": 3, "retries": 2, "failures": 0}
+
+
+def test_honours_retry_after(fake, client):
+    server = fake(fail_first=1, retry_after_s=0.3)
+    # Without the header the first retry would wait only ~base_delay_s
+    gemini = client(server.url)
+    started = time.perf_counter()
+    gemini.generate(body())
+    assert time.perf_counter() - started >= 0.3
+
+    # ... and the header wins over a long exponential delay
+    server = fake(fail_first=1, retry_after_s=0.01)
+    gemini = client(server.url, base_delay_s=30, max_delay_s=30)
+    started = time.perf_counter()
+    gemini.generate(body())
+    assert time.perf_counter() - started < 5
+
+
+def test_gives_up_after_max_retries(fake, client):
+    server = fake(fail_first=10)
+    gemini = client(server.url, max_retries=2)
+    with pytest.raises(GeminiError) as raised:
+        gemini.generate(body())
+    assert raised.value.status == 429
+    assert server.requests == 3
+    assert gemini.stats() == {"requests": 3, "retries": 2, "failures": 1}
+
+
+def test_does_not_retry_client_errors(fake, client):
+    server = fake()
+    gemini = client(server.url + "/wrong-prefix")
+    with pytest.raises(GeminiError) as raised:
+        gemini.generate(body())
+    assert raised.value.status == 404
+    assert gemini.stats() == {"requests": 1, "retries": 0, "failures": 1}
+
+
+def test_retries_dropped_connections(client):
+    # Nothing listens on this port
+    gemini = client("http://127.0.0.1:9", max_retries=1)
+    with pytest.raises(GeminiError) as raised:
+        gemini.generate(body())
+    assert raised.value.status is None
+    assert gemini.stats()["retries"] == 1
+
+
+def test_stream_after_rate_limit(fake, client):
+    server = fake(fail_first=1, chunks=4)
+    gemini = client(server.url)
+    chunks = list(gemini.stream(body()))
+    assert len(chunks) == 4
+    assert "".join(response_text(chunk) for chunk in chunks) == DEFAULT_REPLY
+    assert gemini.stats()["retries"] == 1
+
+
+def test_concurrent_requests_share_the_client(fake, client):
+    server = fake(latency_ms=50, error_rate=0.3, seed=1)
+    gemini = client(server.url, max_concurrency=4)
+    futures = [gemini.submit(body()) for _ in range(8)]
+    assert all(response_text(future.result(10)) == DEFAULT_REPLY for future in futures)
+    assert gemini.stats()["requests"] == server.requests
@@ -0,0 +1,120 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from generation import (  # noqa: E402
+    GenerationProfile,
+    SectionStoppingCriteria,
+    final_section_end,
+    finish_text,
+    profile_for
+)
+
+
+class CharTokenizer:
+    """One token per character"""
+
+    def encode(self, text):
+        return [ord(char) for char in text]
+
+    def decode(self, ids, skip_special_tokens=False):
+        return "".join(chr(i) for i in ids.tolist())
+
+
+@pytest.mark.parametrize("text, expected", [
+    # Still being written
+    ("**Pro Tips**\n- Use fresh basil\n- Rest", None),
+    ("**Pro Tips**\n- Use fresh basil\n\nTh", None),
+    ("**Pro Tips**", None),
+    ("**Cuisine Type:** Italian\n", None),
+    ("No such heading\n\nThanks", None),
+    # Ended by a line after a blank line that is not a bullet
+    ("**Pro Tips**\n- Use fresh basil\n\nEnjoy your meal!", len("**Pro Tips**\n- Use fresh basil\n\n")),
+    # Bullets after a blank line still belong to the section
+    ("**Pro Tips**\n- a\n\n- b\n\nThanks for", len("**Pro Tips**\n- a\n\n- b\n\n")),
+    # Ended by a rule or a heading
+    ("**Pro Tips**\n- a\n---", len("**Pro Tips**\n- a\n")),
+    ("**Pro Tips**\n- a\n# Next", len("**Pro Tips**\n- a\n")),
+    # A "Label: value" line is the whole section
+    ("**Cuisine Type:** Italian\n\nThat's all", len("**Cuisine Type:** Italian\n\n")),
+    ("**Cuisine Type:** Italian\n---", len("**Cuisine Type:** Italian\n")),
+])
+def test_final_section_end(text, expected):
+    pattern = r"Cuisine Type" if "Cuisine" in text else r"Pro Tips"
+    assert final_section_end(text, pattern) == expected
+
+
+def test_final_section_end_needs_content_before_a_break():
+    # A blank line straight after the heading does not end an empty section
+    text = "**Pro Tips**\n\n- a\n\nDone here"
+    assert final_section_end(text, r"Pro Tips") == len("**Pro Tips**\n\n- a\n\n")
+
+
+def test_finish_text_cuts_at_stop_string_and_section():
+    profile = GenerationProfile(final_section=r"Pro Tips")
+    assert finish_text("Answer\nUser: next question", profile) == "Answer"
+    assert finish_text("**Pro Tips**\n- a\n\nHope this helps!", profile) == "**Pro Tips**\n- a"
+    assert finish_text("**Pro Tips**\n- a", profile) == "**Pro Tips**\n- a"
+
+
+def test_profile_for_budget():
+    assert profile_for("recipe").max_new_tokens == 1024
+    assert profile_for("recipe", max_new_tokens=100).max_new_tokens == 100
+    assert profile_for("unknown").final_section is None
+    assert profile_for("recipe").generate_kwargs() == {"max_new_tokens": 1024, "repetition_penalty": 1.05}
+
+
+def run_criteria(profile, answer, prompt="PROMPT"):
+    """Feed answer one token at a time; returns (characters generated at stop, criteria)"""
+    tokenizer = CharTokenizer()
+    ids = tokenizer.encode(prompt)
+    criteria = SectionStoppingCriteria(tokenizer, len(ids), profile)
+    for char in answer:
+        ids.append(ord(char))
+        done = criteria(torch.tensor([ids]))
+        assert done.shape == (1,)
+        if bool(done[0]):
+            return len(ids) - len(prompt), criteria
+    return None, criteria
+
+
+def test_stopping_criteria_final_section():
+    answer = "**Pro Tips**\n- Use fresh basil\n\nEnjoy your meal, and let me know!"
+    stopped_at, criteria = run_criteria(GenerationProfile(final_section=r"Pro Tips"), answer)
+    # Judged once the next line has three characters
+    assert stopped_at == len("**Pro Tips**\n- Use fresh basil\n\nEnj")
+    assert criteria.reason == "final_section"
+    assert criteria.text == answer[:stopped_at]
+
+
+def test_stopping_criteria_stop_string():
+    stopped_at, criteria = run_criteria(GenerationProfile(), "Rice and beans.\nUser: thanks")
+    assert stopped_at == len("Rice and beans.\nUser:")
+    assert criteria.reason == "stop_string"
+
+
+def test_stopping_criteria_runs_to_the_end_without_a_match():
+    stopped_at, criteria = run_criteria(GenerationProfile(final_section=r"Pro Tips"), "**Pro Tips**\n- a\n- b")
+    assert stopped_at is None
+    assert criteria.reason is None
+
+
+def test_stopping_criteria_stops_batch_rows_independently():
+    tokenizer = CharTokenizer()
+    answers = ["Rice.\nUser: more", "Beans and rice, slowly cooked"]
+    criteria = SectionStoppingCriteria(tokenizer, 2, GenerationProfile())
+    rows = [tokenizer.encode("P:") for _ in answers]
+    finished = [None, None]
+    for step in range(max(map(len, answers))):
+        for row, answer in enumerate(answers):
+            # Finished rows are padded, as generate() does
+            rows[row].append(ord(answer[step]) if step < len(answer) and finished[row] is None else 0)
+        done = criteria(torch.tensor(rows))
+        assert done.shape == (2,)
+        for row in range(2):
+            if bool(done[row]) and finished[row] is None:
+                finished[row] = step + 1
+    assert finished == [len("Rice.\nUser:"), None]
+    assert criteria.reasons == ["stop_string", None]
+    assert criteria.texts[1] == answers[1]
@@ -0,0 +1,104 @@
+import pytest
+
+from nutrition import NutrientDB, IngredientLine, nutrition_report, parse_ingredients, parse_quantity
+
+
+@pytest.fixture(scope="module")
+def db():
+    return NutrientDB()
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("200g", (200, "g")),
+    ("1 1/2 cups", (1.5, "cups")),
+    ("½ cup", (0.5, "cup")),
+    ("1½ tbsp", (1.5, "tbsp")),
+    ("2-3 cloves", (2.5, "cloves")),
+    ("2 to 4 slices", (3, "slices")),
+    ("a few sprigs", (3, "sprigs")),
+    ("an onion", (1, None)),
+    ("3 cloves (minced)", (3, "cloves")),
+    ("200 g (about 1 cup)", (200, "g")),
+    ("1 (14 oz) can", (14, "oz")),
+    ("2 (400 g) cans", (800, "g")),
+])
+def test_parse_quantity(text, expected):
+    amount, unit = parse_quantity(text)
+    assert (amount, unit) == (pytest.approx(expected[0]), expected[1])
+
+
+@pytest.mark.parametrize("text", ["to taste", "", "as needed"])
+def test_parse_quantity_without_amount(text):
+    assert parse_quantity(text) is None
+
+
+def test_match_tolerates_plurals_and_descriptors(db):
+    food, score = db.match("Fresh tomatoes, diced")
+    assert db.names[food] == "tomato"
+    assert score >= db.threshold
+
+
+def test_match_by_alias(db):
+    food, _ = db.match("garbanzo beans")
+    assert db.names[food] == "chickpeas"
+
+
+def test_unknown_ingredient_is_not_matched(db):
+    food, _ = db.match("unobtainium shavings")
+    assert food is None
+
+
+def test_grams_of_a_can_use_the_package_size(db):
+    food, _ = db.match("chickpeas")
+    assert db.grams(food, "1 (14 oz) can") == pytest.approx(14 * 28.35)
+
+
+def test_grams_by_unit_kind(db):
+    onion, _ = db.match("onion")
+    butter, _ = db.match("butter")
+    assert db.grams(onion, "2") == pytest.approx(220)
+    assert db.grams(onion, "1 large") == pytest.approx(143)
+    assert db.grams(butter, "2 tbsp") == pytest.approx(227 / 8)
+    assert db.grams(butter, "1 pinch") == pytest.approx(0.35)
+
+
+def test_compute_totals_and_skips(db):
+    result = db.compute([
+        IngredientLine("olive oil", "1 tbsp"),
+        IngredientLine("garlic", "2 cloves"),
+        IngredientLine("unobtainium", "1 cup"),
+        IngredientLine("salt", "to taste"),
+    ])
+    assert [item.food for item in result.items] == ["olive oil", "garlic"]
+    assert result.totals["kcal"] == pytest.approx(sum(item.nutrients["kcal"] for item in result.items))
+    assert [name for name, _ in result.skipped][0] == "unobtainium"
+
+
+INGREDIENTS_ANSWER = """**Ingredients to cook: Chana masala**
+
+| S.No | Ingredient Name | Estimated Quantity | Notes |
+|---|---|---|---|
+| 1 | Chickpeas | 1 (14 oz) can | drained |
+| 2 | Onion | 1 medium | finely chopped |
+| 3 | ... | ... | ... |
+
+**Spices, Seasonings & Garnishes**
+
+| S.No | Spice Name | Quantity | Notes |
+|---|---|---|---|
+| 1 | Garlic | 3 cloves | minced |
+"""
+
+
+def test_parse_ingredients_reads_every_table():
+    lines = parse_ingredients(INGREDIENTS_ANSWER)
+    assert [(line.name, line.quantity) for line in lines] == [
+        ("Chickpeas", "1 (14 oz) can"), ("Onion", "1 medium"), ("Garlic", "3 cloves")
+    ]
+
+
+def test_nutrition_report_counts_the_whole_can():
+    report = nutrition_report(INGREDIENTS_ANSWER)
+    chickpeas = next(line for line in report.splitlines() if line.startswith("| Chickpeas"))
+    assert "| 397 |" in chickpeas
+    assert "**Total**" in report
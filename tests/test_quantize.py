@@ -0,0 +1,35 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+from torch import nn  # noqa: E402
+
+from quantize import quantizable_linears  # noqa: E402
+
+
+def tree(**children):
+    """nn.ModuleDict from keyword children; lists become nn.ModuleList"""
+    return nn.ModuleDict({
+        name: nn.ModuleList(child) if isinstance(child, list) else child for name, child in children.items()
+    })
+
+
+def linear():
+    return nn.Linear(4, 4)
+
+
+def test_qwen2_vl_names():
+    model = tree(
+        visual=tree(blocks=[tree(attn=tree(qkv=linear()))], merger=tree(mlp=[linear()])),
+        model=tree(layers=[tree(self_attn=tree(q_proj=linear()), mlp=tree(up_proj=linear()))]),
+        lm_head=linear(),
+    )
+    assert quantizable_linears(model) == ["model.layers.0.self_attn.q_proj", "model.layers.0.mlp.up_proj"]
+
+
+def test_smolvlm_names():
+    model = tree(model=tree(
+        vision_model=tree(encoder=tree(layers=[tree(mlp=tree(fc1=linear()))])),
+        connector=tree(modality_projection=tree(proj=linear())),
+        text_model=tree(layers=[tree(mlp=tree(down_proj=linear()))]),
+    ), lm_head=linear())
+    assert quantizable_linears(model) == ["model.text_model.layers.0.mlp.down_proj"]
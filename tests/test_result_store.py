@@ -0,0 +1,140 @@
+import pytest
+from PIL import Image
+
+from metrics import record, trace
+from result_store import ResultStore, prompt_version
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "results.sqlite")
+
+
+def counting(output):
+    """work() returning output, with its call count on .calls"""
+    def work():
+        work.calls += 1
+        return output
+    work.calls = 0
+    return work
+
+
+def test_disabled_store_passes_work_through():
+    store = ResultStore()
+    work = counting("answer")
+    assert store.through(work, "sha", "recipe", "model", "prompt") is work
+    assert store.get("sha", "recipe", "model", prompt_version("prompt")) is None
+
+
+def test_through_computes_once_and_persists(db_path):
+    store = ResultStore(db_path)
+    work = counting("A recipe")
+    wrapped = store.through(work, "sha", "recipe", "model", "prompt", image=Image.new("RGB", (4, 3)), size_bytes=99)
+    assert wrapped() == "A recipe"
+    assert wrapped() == "A recipe"
+    assert work.calls == 1
+    store.close()
+
+    # Resumed from disk by a fresh store
+    reopened = ResultStore(db_path)
+    work = counting("recomputed")
+    assert reopened.through(work, "sha", "recipe", "model", "prompt")() == "A recipe"
+    assert work.calls == 0
+    assert reopened.history("sha")[0]["analysis_type"] == "recipe"
+    reopened.close()
+
+
+def test_through_keys_on_model_prompt_and_request(db_path):
+    store = ResultStore(db_path)
+    store.through(counting("first"), "sha", "recipe", "model", "prompt")()
+    for args in (
+        ("sha", "recipe", "other model", "prompt"),
+        ("sha", "recipe", "model", "edited prompt"),
+        ("sha", "nutrition", "model", "prompt"),
+        ("other sha", "recipe", "model", "prompt"),
+    ):
+        assert store.through(counting("second"), *args)() == "second"
+    assert store.through(counting("second"), "sha", "recipe", "model", "prompt", request="vegan?")() == "second"
+    assert store.through(counting("third"), "sha", "recipe", "model", "prompt")() == "first"
+
+
+def test_through_streams_and_stores_the_joined_text(db_path):
+    store = ResultStore(db_path)
+    work = counting(iter(["Rice ", "and ", "beans"]))
+    chunks = store.through(work, "sha", "ingredients", "model", "prompt")()
+    assert not isinstance(chunks, str)
+    assert store.get("sha", "ingredients", "model", prompt_version("prompt")) is None
+    assert list(chunks) == ["Rice ", "and ", "beans"]
+    assert store.get("sha", "ingredients", "model", prompt_version("prompt")) == "Rice and beans"
+
+
+def test_through_stores_json_records(db_path):
+    store = ResultStore(db_path)
+    record_dict = {"dish": "Omelette", "steps": ["Whisk", "Cook"]}
+    store.through(counting(record_dict), "sha", "recipe:json", "model", "prompt")()
+    store.close()
+    assert ResultStore(db_path).get("sha", "recipe:json", "model", prompt_version("prompt")) == record_dict
+
+
+def test_through_stores_nothing_when_work_raises(db_path):
+    store = ResultStore(db_path)
+
+    def work():
+        raise RuntimeError("model crashed")
+
+    with pytest.raises(RuntimeError):
+        store.through(work, "sha", "recipe", "model", "prompt")()
+    assert store.get("sha", "recipe", "model", prompt_version("prompt")) is None
+    assert store.stats()["writes"] == 0
+
+
+def test_through_records_trace_token_counts(db_path):
+    store = ResultStore(db_path)
+
+    def work():
+        with trace("recipe"):
+            record(prompt_tokens=120, generated_tokens=30)
+        return "A recipe"
+
+    store.through(work, "sha", "recipe", "model", "prompt")()
+    row = store.history("sha")[0]
+    assert row["generated_tokens"] == 30
+    assert row["latency_s"] >= 0
+
+    # A trace left on the thread by earlier work is not this work's
+    store.through(counting("Nutrition"), "sha", "nutrition", "model", "prompt")()
+    assert store.history("sha")[0]["generated_tokens"] is None
+
+
+def test_buffered_puts_are_visible_before_flush(db_path):
+    store = ResultStore(db_path, flush_every=3)
+    version = prompt_version("prompt")
+    store.put("a", "recipe", "model", version, "one")
+    store.put("b", "recipe", "model", version, "two")
+    assert store.stats()["writes"] == 0
+    assert store.get("b", "recipe", "model", version) == "two"
+
+    # Not on disk yet: another connection does not see them
+    assert ResultStore(db_path).get("a", "recipe", "model", version) is None
+    store.put("c", "recipe", "model", version, "three")
+    assert store.stats()["writes"] == 3
+    assert ResultStore(db_path).get("a", "recipe", "model", version) == "one"
+
+
+def test_close_flushes_for_resume(db_path):
+    store = ResultStore(db_path, flush_every=64)
+    version = prompt_version("prompt")
+    store.put("a", "recipe", "model", version, "one")
+    store.close()
+    assert ResultStore(db_path).get("a", "recipe", "model", version) == "one"
+
+
+def test_summary(db_path):
+    store = ResultStore(db_path)
+    version = prompt_version("prompt")
+    store.put("a", "recipe", "model", version, "one", latency_s=1.0, generated_tokens=10)
+    store.put("b", "recipe", "model", version, "two", latency_s=3.0, generated_tokens=30)
+    assert store.summary() == [{
+        "model": "model", "analysis_type": "recipe", "count": 2,
+        "mean_latency_s": 2.0, "mean_generated_tokens": 20.0,
+    }]
@@ -0,0 +1,104 @@
+import json
+
+import pytest
+
+from nutrition import parse_ingredients
+from structured import (
+    IngredientsRecord,
+    NutritionRecord,
+    RecipeRecord,
+    SCHEMAS,
+    StructuredOutputError,
+    gemini_schema,
+    parse_record
+)
+
+INGREDIENTS = {
+    "dish": "Chana Masala",
+    "ingredients": [{"name": "Chickpeas", "quantity": "1 (14 oz) can"}, {"name": "Onion", "quantity": "1"}],
+    "seasonings": [{"name": "Garam masala", "quantity": "1 tsp", "notes": "toasted"}],
+    "cooking_methods": ["Sautéing", "Simmering"],
+    "cuisine": "North Indian",
+}
+RECIPE = {
+    "dish": "Omelette", "servings": 1, "prep_minutes": 5, "cook_minutes": 5, "difficulty": "Easy",
+    "ingredients": [{"name": "eggs", "quantity": "2"}], "steps": ["Whisk", "Cook"], "tips": ["Low heat"],
+}
+NUTRITION = {
+    "items": [
+        {"name": "Rice", "portion": "1 cup", "calories": 200, "carbs_g": 44, "protein_g": 4, "fat_g": 0.5},
+        {"name": "Dal", "portion": "1 bowl", "calories": 180, "carbs_g": 30, "protein_g": 12, "fat_g": 2},
+    ],
+    "allergens": [],
+    "confidence": "Medium",
+}
+
+
+def test_parse_ingredients_record():
+    record = parse_record("ingredients", json.dumps(INGREDIENTS))
+    assert isinstance(record, IngredientsRecord)
+    assert record.dish == "Chana Masala"
+    assert [item.name for item in record.ingredients] == ["Chickpeas", "Onion"]
+    assert record.seasonings[0].notes == "toasted"
+    assert record.cooking_methods == ["Sautéing", "Simmering"]
+
+
+def test_ingredients_markdown_reads_back_as_a_table():
+    markdown = parse_record("ingredients", json.dumps(INGREDIENTS)).markdown()
+    names = [line.name for line in parse_ingredients(markdown)]
+    assert names == ["Chickpeas", "Onion", "Garam masala"]
+    assert "**Cuisine Type:** North Indian" in markdown
+
+
+def test_parse_recipe_record():
+    record = parse_record("recipe", json.dumps(RECIPE))
+    assert isinstance(record, RecipeRecord)
+    assert (record.servings, record.prep_minutes, record.cook_minutes) == (1, 5, 5)
+    assert "Total 10 min" in record.markdown()
+    assert "1. Whisk\n2. Cook" in record.markdown()
+
+
+def test_parse_nutrition_record_totals():
+    record = parse_record("nutrition", json.dumps(NUTRITION))
+    assert isinstance(record, NutritionRecord)
+    assert record.totals == {"calories": 380, "carbs_g": 74, "protein_g": 16, "fat_g": 2.5}
+    markdown = record.markdown()
+    assert "**380 kcal**" in markdown
+    assert "none identified" in markdown
+
+
+def test_parse_record_unwraps_code_fence_and_prose():
+    text = "Here is the analysis:\n```json\n" + json.dumps(RECIPE) + "\n```\nEnjoy!"
+    assert parse_record("recipe", text).dish == "Omelette"
+
+
+def test_parse_record_reads_numbers_with_units():
+    item = dict(NUTRITION["items"][0], calories="320 kcal", fat_g="1.5g")
+    record = parse_record("nutrition", json.dumps(dict(NUTRITION, items=[item])))
+    assert record.items[0].calories == 320
+    assert record.items[0].fat_g == 1.5
+
+
+@pytest.mark.parametrize("analysis_type, text", [
+    ("recipe", "I cannot tell what this dish is."),
+    ("recipe", '{"dish": "Omelette", "servings": '),
+    ("ingredients", json.dumps({"ingredients": []})),
+    ("ingredients", json.dumps(dict(INGREDIENTS, ingredients="chickpeas"))),
+    ("ingredients", json.dumps(dict(INGREDIENTS, ingredients=["chickpeas"]))),
+    ("nutrition", json.dumps(dict(NUTRITION, items=[dict(NUTRITION["items"][0], calories="unknown")]))),
+])
+def test_parse_record_rejects(analysis_type, text):
+    with pytest.raises(StructuredOutputError):
+        parse_record(analysis_type, text)
+
+
+def test_structured_output_error_is_a_value_error():
+    assert issubclass(StructuredOutputError, ValueError)
+
+
+def test_gemini_schema_keeps_property_order():
+    schema = gemini_schema(SCHEMAS["nutrition"])
+    assert schema["type"] == "OBJECT"
+    assert schema["propertyOrdering"] == ["items", "allergens", "confidence"]
+    assert schema["properties"]["items"]["items"]["properties"]["calories"] == {"type": "NUMBER"}
+    assert schema["properties"]["confidence"]["enum"] == ["High", "Medium", "Low"]
@@ -0,0 +1,126 @@
+# A tiny, randomly initialized Qwen2-VL for offline benchmarks
+#
+# Everything is built in memory: a byte-level BPE tokenizer trained on the prompts,
+# the real Qwen2-VL image processor and a two-layer model with the real
+# architecture. The answers are gibberish, but every code path (image processor,
+# vision tower, mrope, prefix cache, generate) runs without downloading weights.
+
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import (
+    PreTrainedTokenizerFast,
+    Qwen2VLConfig,
+    Qwen2VLForConditionalGeneration,
+    Qwen2VLImageProcessor,
+    Qwen2VLProcessor
+)
+
+from prefix_cache import warm_prefix_cache
+from prompts import SYSTEM_PROMPTS
+from vlm import VALID_LABEL, INVALID_LABEL
+
+SPECIAL_TOKENS = [
+    "<|endoftext|>",
+    "<|im_start|>",
+    "<|im_end|>",
+    "<|vision_start|>",
+    "<|vision_end|>",
+    "<|image_pad|>",
+    "<|video_pad|>",
+]
+
+# The Qwen2-VL chat layout, without tool calls and video
+CHAT_TEMPLATE = (
+    "{% for message in messages %}"
+    "<|im_start|>{{ message['role'] }}\n"
+    "{% if message['content'] is string %}{{ message['content'] }}"
+    "{% else %}{% for content in message['content'] %}"
+    "{% if content['type'] == 'image' %}<|vision_start|><|image_pad|><|vision_end|>"
+    "{% elif content['type'] == 'text' %}{{ content['text'] }}{% endif %}"
+    "{% endfor %}{% endif %}<|im_end|>\n"
+    "{% endfor %}"
+    "{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}"
+)
+
+
+def build_tokenizer(vocab_size=2048):
+    """Byte-level BPE over the app's prompts, with the Qwen2-VL special tokens"""
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=SPECIAL_TOKENS,
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet()
+    )
+    corpus = list(SYSTEM_PROMPTS) + [VALID_LABEL, INVALID_LABEL, "system user assistant"]
+    tokenizer.train_from_iterator(corpus, trainer)
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        eos_token="<|im_end|>",
+        pad_token="<|endoftext|>",
+        additional_special_tokens=SPECIAL_TOKENS[1:]
+    )
+
+
+def build_tiny_qwen2_vl(seed=0, hidden_size=64, num_layers=2, min_pixels=4 * 28 * 28, max_pixels=1024 * 28 * 28):
+    """(model, processor) shaped like load_model()'s, with random weights.
+
+    The seed fixes the weights, so two runs of the same commit generate the
+    same tokens and their timings are comparable.
+    """
+    torch.manual_seed(seed)
+    tokenizer = build_tokenizer()
+    token_ids = {token: tokenizer.convert_tokens_to_ids(token) for token in SPECIAL_TOKENS}
+
+    num_heads = 4
+    head_dim = hidden_size // num_heads
+    # mrope splits the rotary half of each head over (temporal, height, width)
+    rotary_pairs = head_dim // 2
+    mrope_section = [rotary_pairs - 2 * (rotary_pairs * 3 // 8), rotary_pairs * 3 // 8, rotary_pairs * 3 // 8]
+
+    config = Qwen2VLConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=hidden_size,
+        intermediate_size=hidden_size * 2,
+        num_hidden_layers=num_layers,
+        num_attention_heads=num_heads,
+        num_key_value_heads=2,
+        max_position_embeddings=8192,
+        rope_scaling={"type": "mrope", "mrope_section": mrope_section},
+        vision_config={
+            "depth": num_layers,
+            "embed_dim": 32,
+            "num_heads": 2,
+            "mlp_ratio": 2,
+            "hidden_size": hidden_size,
+            "patch_size": 14,
+            "spatial_merge_size": 2,
+            "temporal_patch_size": 2,
+        },
+        image_token_id=token_ids["<|image_pad|>"],
+        video_token_id=token_ids["<|video_pad|>"],
+        vision_start_token_id=token_ids["<|vision_start|>"],
+        vision_end_token_id=token_ids["<|vision_end|>"],
+        bos_token_id=token_ids["<|endoftext|>"],
+        eos_token_id=token_ids["<|im_end|>"],
+        pad_token_id=token_ids["<|endoftext|>"],
+        tie_word_embeddings=True
+    )
+    model = Qwen2VLForConditionalGeneration(config).eval()
+    model.generation_config.do_sample = False
+
+    processor = Qwen2VLProcessor(
+        image_processor=Qwen2VLImageProcessor(min_pixels=min_pixels, max_pixels=max_pixels),
+        tokenizer=tokenizer,
+        chat_template=CHAT_TEMPLATE
+    )
+    # Same warm-up load_model() does for real checkpoints
+    warm_prefix_cache(model, processor, SYSTEM_PROMPTS)
+    return model, processor
+
+
+def load_tiny_qwen2_vl(model_name=None, precision="auto", share_weights=False):
+    """(model, processor, no shared weights) for worker_pool.WorkerPool(loader=...)"""
+    model, processor = build_tiny_qwen2_vl()
+    return model, processor, 0
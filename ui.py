@@ -0,0 +1,97 @@
+# Streamlit helpers shared by the three apps
+
+import json
+
+import streamlit as st
+
+from metrics import METRICS, last_trace
+
+
+def render_stream(chunks):
+    """Render text chunks into a placeholder as they arrive and return the full text"""
+    placeholder = st.empty()
+    text = ""
+    for chunk in chunks:
+        text += chunk
+        placeholder.markdown(text + "▌")
+    placeholder.markdown(text)
+    return text
+
+
+def track_job(scope, slot, header, job):
+    """Show job under header in this session's slot for scope (e.g. the current image)"""
+    st.session_state.setdefault("jobs", {})[(scope, slot)] = (header, job.id)
+
+
+def submit_job(jobs, scope, slot, header, work_spec):
+    """Run a (work, job key, group) work spec as a background job and track it in scope's slot"""
+    work, key, group = work_spec
+    job = jobs.submit(key, work, label=slot, group=group)
+    track_job(scope, slot, header, job)
+
+
+def render_jobs(jobs, scope, poll_s=0.5):
+    """Render this session's jobs for scope, polling from a fragment while any is running"""
+    entries = [
+        (header, job_id)
+        for (entry_scope, _), (header, job_id) in st.session_state.get("jobs", {}).items()
+        if entry_scope == scope
+    ]
+    if not entries:
+        return
+    polling = any(
+        job is not None and not job.done.is_set() for job in (jobs.get(job_id) for _, job_id in entries)
+    )
+
+    @st.fragment(run_every=poll_s if polling else None)
+    def panels():
+        running = False
+        for header, job_id in entries:
+            job = jobs.get(job_id)
+            if header:
+                st.markdown(header)
+            if job is None:
+                st.caption("This result has expired; run the analysis again.")
+            elif job.error is not None:
+                st.error(f"Analysis failed: {job.error}")
+            elif not job.done.is_set():
+                running = True
+                st.markdown(job.text + "▌" if job.text else "_Working on it..._")
+            else:
+                st.markdown(job.text)
+            st.markdown("---")
+        if polling and not running:
+            # Everything finished: one full rerun to stop polling
+            st.rerun()
+
+    panels()
+
+
+def session_last_trace(jobs):
+    """Latest trace of this session: its jobs' traces, or what the script thread ran itself"""
+    traces = [last_trace()]
+    for _, job_id in st.session_state.get("jobs", {}).values():
+        job = jobs.get(job_id)
+        if job is not None:
+            traces.append(job.trace)
+    traces = [request_trace for request_trace in traces if request_trace is not None]
+    return max(traces, key=lambda t: t.started + t.total_s, default=None)
+
+
+def render_debug_panel(jobs):
+    """Opt-in sidebar panel with the last request's stage timings and the metrics export"""
+    if not st.sidebar.checkbox("🔍 Debug panel", value=False):
+        return
+    last = session_last_trace(jobs)
+    if last is not None:
+        st.sidebar.markdown(f"**Last request:** `{last.name}` in {last.total_s:.2f}s")
+        st.sidebar.json(last.as_dict())
+    else:
+        st.sidebar.caption("No request traced in this session yet.")
+    st.sidebar.download_button(
+        "Metrics (Prometheus)", METRICS.prometheus_text(), file_name="metrics.prom", mime="text/plain"
+    )
+    st.sidebar.download_button(
+        "Metrics (JSON)", json.dumps(METRICS.as_json(), indent=2), file_name="metrics.json",
+        mime="application/json"
+    )
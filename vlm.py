@@ -0,0 +1,579 @@
+# Shared inference helpers for the local vision-language apps (Smol.py and Qwen-VLM.py)
+
+import contextvars
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+import torch
+from transformers import (
+    Qwen2VLForConditionalGeneration,
+    AutoProcessor,
+    BatchFeature,
+    StoppingCriteriaList,
+    TextIteratorStreamer
+)
+from transformers.generation.streamers import BaseStreamer
+from qwen_vl_utils import process_vision_info
+from cache import EmbeddingCache, ResultCache, NearDuplicateCache
+from metrics import trace, stage, record, current_trace
+from prefix_cache import generation_lock, prefill_with_prefix, warm_prefix_cache
+from quantize import apply_precision, load_kwargs
+from speculative import speculative_generate, DEFAULT_DRAFT_TOKENS
+from generation import PROFILES, SectionStoppingCriteria, finish_text, profile_for
+from prompts import FOOD_VALIDATION_PROMPT, FULL_REPORT_SYSTEM_PROMPT, STRUCTURED_PROMPTS, SYSTEM_PROMPTS
+from structured import json_constraint, parse_record
+
+logger = logging.getLogger(__name__)
+
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+
+# Labels the validation prompt asks the model to answer with
+VALID_LABEL = "VALID_FOOD"
+INVALID_LABEL = "NOT_FOOD"
+
+# Probability above which an image counts as food in logit scoring mode
+FOOD_THRESHOLD = 0.5
+
+# Calibrated scale of the label logit margin before the sigmoid (FOOD_TEMPERATURE)
+FOOD_TEMPERATURE = float(os.getenv("FOOD_TEMPERATURE", "1.0"))
+
+# Qwen2-VL placeholder the processor expands into one token per visual patch group
+IMAGE_PAD_TOKEN = "<|image_pad|>"
+
+# Vision-encoder outputs reused across the analyses of one image
+EMBEDDING_CACHE = EmbeddingCache(max_mb=float(os.getenv("EMBEDDING_CACHE_MB", "512")))
+
+# Visual tokens the patched vision tower should return for the current thread
+_visual_override = threading.local()
+
+# The full report writes three sections, so it gets the three budgets' worth of room
+FULL_REPORT_MAX_NEW_TOKENS = PROFILES["full report"].max_new_tokens
+REPORT_SECTIONS = ("ingredients", "recipe", "nutrition")
+_SECTION_MARKER = re.compile(r"^\s*=+\s*(INGREDIENTS|RECIPE|NUTRITION)\s*=+\s*$", re.IGNORECASE | re.MULTILINE)
+
+# Split full reports per image id, shared by every session
+REPORT_CACHE = ResultCache(max_entries=256)
+
+# Answers for re-encoded, rescaled or lightly cropped re-uploads of an image
+NEAR_DUPLICATE_CACHE = NearDuplicateCache.from_env()
+
+
+def load_model(model_path, model_class=Qwen2VLForConditionalGeneration, processor_class=AutoProcessor,
+               precision="auto"):
+    """Load a model and processor and warm the system-prompt prefix cache.
+
+    precision is one of quantize.PRECISION_MODES; "auto" keeps the checkpoint
+    dtype and device placement.
+    """
+    model = model_class.from_pretrained(
+        model_path,
+        **load_kwargs(precision)
+    )
+    model = apply_precision(model, precision)
+    processor = processor_class.from_pretrained(
+        model_path
+    )
+    # Precompute the system-prompt KV once per loaded model
+    warm_prefix_cache(model, processor, SYSTEM_PROMPTS)
+    return model, processor
+
+
+def build_messages(image, system_prompt, user_text):
+    """Chat messages with a system prompt and one image + text user turn"""
+    return [
+        {"role": "system", "content": [{"type": "text", "text": system_prompt}]},
+        {"role": "user", "content": [
+            {"type": "image", "image": image},
+            {"type": "text", "text": user_text},
+        ]}
+    ]
+
+
+def prepare_inputs(messages, processor):
+    """Apply the chat template and run the processor over the messages"""
+    with stage("chat_template"):
+        text = processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    with stage("process_vision_info"):
+        image_inputs, video_inputs = process_vision_info(messages)
+    with stage("processor"):
+        inputs = processor(
+            text=[text],
+            images=image_inputs,
+            videos=video_inputs,
+            padding=True,
+            return_tensors="pt"
+        )
+    with stage("to_device"):
+        return inputs.to(DEVICE)
+
+
+def supports_embedding_cache(model, processor):
+    """Only the Qwen2-VL layout (model.visual + merge_size) can reuse visual tokens"""
+    image_processor = getattr(processor, "image_processor", None)
+    return hasattr(model, "visual") and hasattr(image_processor, "merge_size")
+
+
+def _install_visual_cache(model):
+    """Let the vision tower return precomputed visual tokens when the thread asks for it"""
+    visual = model.visual
+    if getattr(visual, "_embedding_cache_installed", False):
+        return
+    original_forward = visual.forward
+
+    def forward(*args, **kwargs):
+        image_embeds = getattr(_visual_override, "image_embeds", None)
+        if image_embeds is not None:
+            return image_embeds
+        return original_forward(*args, **kwargs)
+
+    visual.forward = forward
+    visual._embedding_cache_installed = True
+
+
+def encode_image(image, model, processor, image_id):
+    """Pixel values, grid and projected visual tokens for an image, cached by image_id"""
+    entry = EMBEDDING_CACHE.get(image_id)
+    if entry is not None:
+        return entry
+
+    _install_visual_cache(model)
+    image_inputs, _ = process_vision_info([
+        {"role": "user", "content": [{"type": "image", "image": image}]}
+    ])
+    vision = processor.image_processor(images=image_inputs, return_tensors="pt")
+    visual_param = next(model.visual.parameters())
+    pixel_values = vision["pixel_values"].to(visual_param.device)
+    image_grid_thw = vision["image_grid_thw"].to(visual_param.device)
+    with torch.no_grad():
+        image_embeds = model.visual(pixel_values.type(visual_param.dtype), grid_thw=image_grid_thw)
+
+    entry = {
+        "pixel_values": pixel_values,
+        "image_grid_thw": image_grid_thw,
+        "image_embeds": image_embeds,
+    }
+    EMBEDDING_CACHE.put(image_id, entry)
+    return entry
+
+
+def prepare_image_inputs(image, system_prompt, user_text, model, processor, image_id=None):
+    """Model inputs for one image + prompt, plus cached visual tokens when available.
+
+    With an image_id on the Qwen2-VL path the image processor and vision tower
+    run once per image; the text is tokenized with the image placeholder
+    expanded to the cached grid, the same way the processor would expand it.
+    Returns (inputs, image_embeds); image_embeds is None on the uncached path.
+    """
+    messages = build_messages(image, system_prompt, user_text)
+    if image_id is None or not supports_embedding_cache(model, processor):
+        inputs = prepare_inputs(messages, processor)
+        record_prompt_tokens(inputs, processor)
+        return inputs, None
+
+    with stage("vision_encode"):
+        entry = encode_image(image, model, processor, image_id)
+    merge_length = processor.image_processor.merge_size ** 2
+    num_image_tokens = int(entry["image_grid_thw"][0].prod()) // merge_length
+
+    with stage("chat_template"):
+        text = processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        text = text.replace(IMAGE_PAD_TOKEN, IMAGE_PAD_TOKEN * num_image_tokens, 1)
+    with stage("processor"):
+        text_inputs = processor.tokenizer([text], padding=True, return_tensors="pt")
+    with stage("to_device"):
+        inputs = BatchFeature(data={
+            **text_inputs,
+            "pixel_values": entry["pixel_values"],
+            "image_grid_thw": entry["image_grid_thw"],
+        }).to(DEVICE)
+    record_prompt_tokens(inputs, processor)
+    return inputs, entry["image_embeds"]
+
+
+def record_prompt_tokens(inputs, processor):
+    """Attach prompt and visual token counts to the current trace"""
+    if current_trace() is not None:
+        record(
+            prompt_tokens=int(inputs["input_ids"].shape[1]),
+            visual_tokens=count_visual_tokens(inputs, processor)
+        )
+
+
+@contextmanager
+def cached_visual_tokens(image_embeds):
+    """Serve image_embeds from the vision tower for generate() calls in this thread"""
+    _visual_override.image_embeds = image_embeds
+    try:
+        yield
+    finally:
+        _visual_override.image_embeds = None
+
+
+class TimingStreamer(BaseStreamer):
+    """Notes when generate() emits its first new token, forwarding to an optional inner streamer"""
+
+    def __init__(self, inner=None):
+        self.inner = inner
+        self.first_token_at = None
+        self.generated_tokens = 0
+        self._prompt_seen = False
+
+    def put(self, value):
+        # generate() first puts the prompt, then each step's new token(s)
+        if self._prompt_seen:
+            if self.first_token_at is None:
+                self.first_token_at = time.perf_counter()
+            self.generated_tokens += value.numel()
+        else:
+            self._prompt_seen = True
+        if self.inner is not None:
+            self.inner.put(value)
+
+    def end(self):
+        if self.inner is not None:
+            self.inner.end()
+
+
+def run_generate(model, inputs, image_embeds, system_prompt, draft=None, **generate_kwargs):
+    """model.generate() with cached visual tokens and the cached system-prompt prefix.
+
+    With draft=(draft_model, draft_inputs, draft_tokens) the answer is decoded
+    speculatively instead (see speculative.py), which keeps the target's greedy
+    answer and so ignores repetition controls. Prefill (up to the first new
+    token) and decode are timed separately into the current trace, along with
+    time to first token and decode tokens/sec. Generations on one model run
+    one at a time (prefix_cache.generation_lock).
+    """
+    timing = TimingStreamer(generate_kwargs.pop("streamer", None))
+    with generation_lock(model), cached_visual_tokens(image_embeds):
+        start = time.perf_counter()
+        if draft is not None:
+            draft_model, draft_inputs, draft_tokens = draft
+            output, draft_stats = speculative_generate(
+                model, inputs, draft_model, draft_inputs,
+                max_new_tokens=generate_kwargs.get("max_new_tokens", 1024),
+                draft_tokens=draft_tokens,
+                streamer=timing,
+                stopping_criteria=generate_kwargs.get("stopping_criteria")
+            )
+            if draft_stats["proposed"]:
+                record(draft_acceptance=draft_stats["accepted"] / draft_stats["proposed"])
+        else:
+            prefixed = prefill_with_prefix(model, inputs, system_prompt)
+            if prefixed is not None:
+                inputs, cache_kwargs = prefixed
+                generate_kwargs.update(cache_kwargs)
+            output = model.generate(**inputs, streamer=timing, **generate_kwargs)
+        end = time.perf_counter()
+
+    request_trace = current_trace()
+    if request_trace is not None:
+        first_token_at = timing.first_token_at or end
+        decode_s = end - first_token_at
+        request_trace.add_stage("prefill", first_token_at - start)
+        request_trace.add_stage("decode", decode_s)
+        # The first token comes out of the prefill, the rest are decode steps
+        decode_tokens = max(timing.generated_tokens - 1, 0)
+        record(
+            ttft_s=first_token_at - request_trace.started,
+            generated_tokens=timing.generated_tokens,
+            tokens_per_s=decode_tokens / decode_s if decode_tokens and decode_s > 0 else None
+        )
+    return output
+
+
+def count_visual_tokens(inputs, processor):
+    """Number of image placeholder tokens the processor expanded into the prompt"""
+    token = str(getattr(processor, "image_token", None) or IMAGE_PAD_TOKEN)
+    token_id = processor.tokenizer.convert_tokens_to_ids(token)
+    return int((inputs["input_ids"] == token_id).sum())
+
+
+def label_token_ids(processor):
+    """First token ids of the two validation labels, or None if they collide"""
+    tokenizer = getattr(processor, "tokenizer", processor)
+    valid_ids = tokenizer.encode(VALID_LABEL, add_special_tokens=False)
+    invalid_ids = tokenizer.encode(INVALID_LABEL, add_special_tokens=False)
+    if not valid_ids or not invalid_ids or valid_ids[0] == invalid_ids[0]:
+        return None
+    return valid_ids[0], invalid_ids[0]
+
+
+def score_food_image(image, model, processor, temperature=FOOD_TEMPERATURE, image_id=None):
+    """Probability that the image is food, from a single prefill forward pass.
+
+    Compares the next-token logits of the first token of each label and squashes
+    the margin through a sigmoid; temperature calibrates the scale. Returns None
+    when the tokenizer cannot tell the labels apart from their first token.
+    """
+    label_ids = label_token_ids(processor)
+    if label_ids is None:
+        return None
+    valid_id, invalid_id = label_ids
+
+    inputs, image_embeds = prepare_image_inputs(
+        image, FOOD_VALIDATION_PROMPT, "Is this image a food item?", model, processor, image_id
+    )
+
+    # max_new_tokens=1 is the prefill only; output_logits gives the raw,
+    # unprocessed scores (no repetition penalty from the generation config)
+    with torch.no_grad():
+        outputs = run_generate(
+            model, inputs, image_embeds, FOOD_VALIDATION_PROMPT,
+            max_new_tokens=1,
+            do_sample=False,
+            output_logits=True,
+            return_dict_in_generate=True
+        )
+    logits = outputs.logits[0][0].float()
+    margin = (logits[valid_id] - logits[invalid_id]) / temperature
+    return torch.sigmoid(margin).item()
+
+
+def generate_food_verdict(image, model, processor, image_id=None):
+    """Original validation path: decode a short answer and look for the label"""
+    inputs, image_embeds = prepare_image_inputs(
+        image, FOOD_VALIDATION_PROMPT, "Is this image a food item?", model, processor, image_id
+    )
+
+    generated_ids = run_generate(model, inputs, image_embeds, FOOD_VALIDATION_PROMPT, max_new_tokens=10)
+    generated_ids_trimmed = [
+        out_ids[len(in_ids):] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
+    ]
+    output_text = processor.batch_decode(
+        generated_ids_trimmed,
+        skip_special_tokens=True,
+        clean_up_tokenization_spaces=False
+    )[0].strip()
+
+    return VALID_LABEL in output_text
+
+
+def validate_food_image(image, model, processor, mode="logits", threshold=FOOD_THRESHOLD,
+                        temperature=FOOD_TEMPERATURE, image_id=None):
+    """Check if image contains food items.
+
+    mode="logits" scores both labels in one forward pass and falls back to
+    mode="generate" when the tokenizer splits the labels ambiguously.
+    """
+    with trace("local.validate"):
+        if mode == "logits":
+            probability = score_food_image(
+                image, model, processor, temperature=temperature, image_id=image_id
+            )
+            if probability is not None:
+                logger.info("food validation: p(food)=%.3f threshold=%.2f", probability, threshold)
+                record(p_food=probability)
+                return probability >= threshold
+            logger.info("food validation: labels share a first token, falling back to generate")
+
+        return generate_food_verdict(image, model, processor, image_id=image_id)
+
+
+def analysis_user_text(analysis_type, user_question=""):
+    """User turn for an analysis: the follow-up question if given, else a generic request"""
+    if user_question.strip():
+        return user_question.strip()
+    return f"Please provide a detailed {analysis_type} analysis of this food image."
+
+
+def result_namespace(model, system_prompt, analysis_type, user_question=""):
+    """Near-duplicate cache namespace: which model, at which precision, was asked what"""
+    asked = hashlib.sha256(f"{system_prompt}\0{user_question.strip()}".encode()).hexdigest()[:16]
+    precision = getattr(model, "_precision", None) or model.dtype
+    return f"{getattr(model, 'name_or_path', type(model).__name__)}:{precision}:{analysis_type}:{asked}"
+
+
+def prepare_draft(image, system_prompt, user_text, draft, draft_tokens):
+    """run_generate()'s draft argument for a (draft_model, draft_processor) pair, or None"""
+    if draft is None:
+        return None
+    draft_model, draft_processor = draft
+    with stage("draft_inputs"):
+        draft_inputs, _ = prepare_image_inputs(image, system_prompt, user_text, draft_model, draft_processor)
+    return draft_model, draft_inputs, draft_tokens
+
+
+def generation_kwargs(profile, inputs, processor):
+    """generate() arguments for a profile: budget, repetition controls and section-aware stopping"""
+    stopping = SectionStoppingCriteria(processor.tokenizer, inputs["input_ids"].shape[1], profile)
+    return stopping, {**profile.generate_kwargs(), "stopping_criteria": StoppingCriteriaList([stopping])}
+
+
+def record_stop(stopping, generated_tokens, profile):
+    """Why generation ended, for tuning the per-analysis budgets"""
+    if stopping.reason is not None:
+        reason = stopping.reason
+    elif generated_tokens >= profile.max_new_tokens:
+        reason = "max_new_tokens"
+    else:
+        reason = "eos"
+    record(stop_reason=reason, token_budget=profile.max_new_tokens)
+
+
+def analyze_food(image, system_prompt, analysis_type, model, processor, user_question="", image_id=None,
+                 max_new_tokens=None, draft=None, draft_tokens=DEFAULT_DRAFT_TOKENS, near_duplicates=True,
+                 structured=False):
+    """Analyze food image with specific system prompt.
+
+    Pass image_id (see cache.image_key) to reuse the vision-encoder outputs
+    across analyses of the same image. Pass draft=(draft_model, draft_processor)
+    to decode speculatively with draft_tokens proposed per step; the draft must
+    share the target's vocabulary (speculative.tokenizers_compatible).
+    Answers for near-duplicate images come from NEAR_DUPLICATE_CACHE unless
+    near_duplicates is False. The token budget, repetition controls and early
+    stopping come from the analysis type's profile (generation.py);
+    max_new_tokens overrides the budget. With structured=True the answer is
+    JSON for the analysis type's schema (see analyze_structured()); decoding
+    is constrained to it, so the draft model is not used.
+    """
+    with trace(f"local.{analysis_type}" + (".json" if structured else "")):
+        namespace = result_namespace(model, system_prompt, analysis_type, user_question)
+        if near_duplicates:
+            cached = NEAR_DUPLICATE_CACHE.get(image, namespace)
+            if cached is not None:
+                record(near_duplicate_hit=True)
+                return cached
+
+        user_text = analysis_user_text(analysis_type, user_question)
+        # Speculative decoding cannot apply a token constraint
+        constraint = json_constraint(processor.tokenizer, analysis_type) if structured else None
+        if constraint is not None:
+            draft = None
+        # Draft first, so the trace keeps the target's prompt token counts
+        draft_args = prepare_draft(image, system_prompt, user_text, draft, draft_tokens)
+        inputs, image_embeds = prepare_image_inputs(
+            image, system_prompt, user_text, model, processor, image_id
+        )
+
+        profile = profile_for(f"{analysis_type}:json" if structured else analysis_type, max_new_tokens)
+        stopping, generate_kwargs = generation_kwargs(profile, inputs, processor)
+        if constraint is not None:
+            generate_kwargs["prefix_allowed_tokens_fn"] = constraint
+        generated_ids = run_generate(
+            model, inputs, image_embeds, system_prompt, draft=draft_args, **generate_kwargs
+        )
+        generated_ids_trimmed = [
+            out_ids[len(in_ids):] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
+        ]
+        record_stop(stopping, len(generated_ids_trimmed[0]), profile)
+        with stage("batch_decode"):
+            output_text = finish_text(processor.batch_decode(
+                generated_ids_trimmed,
+                skip_special_tokens=True,
+                clean_up_tokenization_spaces=False
+            )[0], profile)
+
+        if near_duplicates:
+            NEAR_DUPLICATE_CACHE.put(image, namespace, output_text)
+        return output_text
+
+
+def stream_analyze_food(image, system_prompt, analysis_type, model, processor, user_question="", image_id=None,
+                        max_new_tokens=None, draft=None, draft_tokens=DEFAULT_DRAFT_TOKENS, near_duplicates=True):
+    """Like analyze_food(), but yields the answer text as tokens are decoded.
+
+    generate() runs in a background thread feeding a TextIteratorStreamer;
+    an exception in that thread is re-raised here once the stream ends.
+    A near-duplicate cache hit is yielded in one piece. Text streamed past a
+    stop point (a token or two) is trimmed from what gets cached.
+    """
+    with trace(f"local.{analysis_type}"):
+        namespace = result_namespace(model, system_prompt, analysis_type, user_question)
+        if near_duplicates:
+            cached = NEAR_DUPLICATE_CACHE.get(image, namespace)
+            if cached is not None:
+                record(near_duplicate_hit=True)
+                yield cached
+                return
+
+        user_text = analysis_user_text(analysis_type, user_question)
+        # Draft first, so the trace keeps the target's prompt token counts
+        draft_args = prepare_draft(image, system_prompt, user_text, draft, draft_tokens)
+        inputs, image_embeds = prepare_image_inputs(
+            image, system_prompt, user_text, model, processor, image_id
+        )
+        streamer = TextIteratorStreamer(
+            processor.tokenizer,
+            skip_prompt=True,
+            skip_special_tokens=True,
+            clean_up_tokenization_spaces=False
+        )
+        profile = profile_for(analysis_type, max_new_tokens)
+        stopping, generate_kwargs = generation_kwargs(profile, inputs, processor)
+        errors = []
+        outputs = []
+
+        def generate_in_background():
+            try:
+                outputs.append(run_generate(
+                    model, inputs, image_embeds, system_prompt, draft=draft_args,
+                    streamer=streamer, **generate_kwargs
+                ))
+            except Exception as e:
+                errors.append(e)
+                streamer.end()
+
+        # The copied context carries the trace into the generation thread
+        context = contextvars.copy_context()
+        thread = threading.Thread(target=context.run, args=(generate_in_background,), daemon=True)
+        thread.start()
+        pieces = []
+        for text in streamer:
+            if text:
+                pieces.append(text)
+                yield text
+        thread.join()
+        if errors:
+            raise errors[0]
+        record_stop(stopping, outputs[0].shape[1] - inputs["input_ids"].shape[1], profile)
+        if near_duplicates:
+            NEAR_DUPLICATE_CACHE.put(image, namespace, finish_text("".join(pieces), profile))
+
+
+def analyze_structured(image, analysis_type, model, processor, image_id=None, **kwargs):
+    """Ingredients, recipe or nutrition as a typed record (structured.py) from a JSON answer.
+
+    Decoding is constrained to the schema, so StructuredOutputError only
+    comes from an answer cut off by the token budget.
+    """
+    text = analyze_food(
+        image, STRUCTURED_PROMPTS[analysis_type], analysis_type, model, processor,
+        image_id=image_id, structured=True, **kwargs
+    )
+    return parse_record(analysis_type, text)
+
+
+def split_full_report(text):
+    """Split a full-report answer into its ingredients, recipe and nutrition sections.
+
+    Sections the model did not emit come back as empty strings.
+    """
+    sections = dict.fromkeys(REPORT_SECTIONS, "")
+    markers = list(_SECTION_MARKER.finditer(text))
+    for index, marker in enumerate(markers):
+        end = markers[index + 1].start() if index + 1 < len(markers) else len(text)
+        sections[marker.group(1).lower()] = text[marker.end():end].strip()
+    return sections
+
+
+def full_report(image, model, processor, image_id=None, near_duplicates=True):
+    """Ingredients, recipe and nutrition from one generation, cached per image id"""
+    if image_id is not None:
+        sections = REPORT_CACHE.get(image_id)
+        if sections is not None:
+            return sections
+
+    text = analyze_food(
+        image, FULL_REPORT_SYSTEM_PROMPT, "full report", model, processor,
+        image_id=image_id, max_new_tokens=FULL_REPORT_MAX_NEW_TOKENS, near_duplicates=near_duplicates
+    )
+    sections = split_full_report(text)
+    if image_id is not None:
+        REPORT_CACHE.put(image_id, sections)
+    return sections
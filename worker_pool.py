@@ -0,0 +1,498 @@
+# Multi-process CPU worker pool for the local VLMs
+#
+# One generate() process stops scaling at about 8 cores: decoding is a chain of
+# small matrix-vector products, and the synchronisation between torch's
+# intra-op threads grows with the thread count. On a CPU-only host it is faster
+# to run N replicas of the model, each in its own process pinned to a disjoint
+# set of cores with torch's intra-op threads sized to that set, and to send
+# every request to one of them. Each replica is built with empty parameters that
+# are then pointed at the memory-mapped safetensors files, so weights the
+# checkpoint holds in the loaded dtype are never copied: the replicas share one
+# copy in the page cache instead of holding N, also while they start up.
+#
+#   pool = WorkerPool("SmolVLM2-2.2B-Instruct", workers=4, threads_per_worker=8)
+#   text = pool.analyze(image, RECIPE_SYSTEM_PROMPT, "recipe")
+#
+# spawn re-imports the parent's main module in each worker (server.py, and torch
+# with it) before the worker function runs, so the OpenMP/MKL thread counts are
+# put in the environment each worker is started with rather than set inside it.
+
+import gc
+import glob
+import itertools
+import json
+import logging
+import mmap
+import multiprocessing
+import os
+import pickle
+import queue
+import re
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+DISPATCH_MODES = ("queue_depth", "round_robin")
+
+# Read by OpenMP and MKL when torch first loads them, i.e. at import in a worker
+_THREAD_ENV = ("OMP_NUM_THREADS", "MKL_NUM_THREADS")
+
+# Requests a worker handles, and the vlm.py function behind each
+_HANDLERS = {
+    "validate": "validate_food_image",
+    "analyze": "analyze_food",
+    "structured": "analyze_structured",
+    "full_report": "full_report",
+}
+
+
+def available_cores():
+    """CPU ids this process may run on (respects taskset and cgroup cpusets)"""
+    return sorted(os.sched_getaffinity(0))
+
+
+def partition_cores(workers, threads_per_worker=None, cores=None):
+    """Disjoint, contiguous core lists, one per worker.
+
+    Without threads_per_worker the available cores are split evenly and any
+    remainder is left idle.
+    """
+    cores = cores if cores is not None else available_cores()
+    threads_per_worker = threads_per_worker or len(cores) // workers
+    if threads_per_worker < 1 or workers * threads_per_worker > len(cores):
+        raise ValueError(
+            f"{workers} workers x {threads_per_worker} threads need more than the {len(cores)} available cores"
+        )
+    return [cores[index * threads_per_worker:(index + 1) * threads_per_worker] for index in range(workers)]
+
+
+def memory_usage_mb():
+    """This process's resident memory, split into shared and private pages (Linux)"""
+    usage = {}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if value.strip().endswith("kB"):
+                usage[key] = int(value.split()[0]) / 1024
+    return {
+        "rss_mb": usage.get("Rss", 0.0),
+        "shared_mb": usage.get("Shared_Clean", 0.0) + usage.get("Shared_Dirty", 0.0),
+        "private_mb": usage.get("Private_Clean", 0.0) + usage.get("Private_Dirty", 0.0),
+    }
+
+
+def read_safetensors(path):
+    """{name: tensor} viewing a safetensors file through a copy-on-write memory map.
+
+    Nothing is read until a tensor is used, and pages that are never written
+    stay shared with every other process mapping the same file.
+    """
+    import torch
+
+    dtypes = {
+        "F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+        "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8,
+        "U8": torch.uint8, "BOOL": torch.bool,
+    }
+    with open(path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    data_start = 8 + header_size
+    tensors = {}
+    for name, info in header.items():
+        dtype = dtypes.get(info["dtype"]) if name != "__metadata__" else None
+        start, end = info["data_offsets"] if dtype is not None else (0, 0)
+        if dtype is None or end == start:
+            continue
+        count = (end - start) // torch.empty((), dtype=dtype).element_size()
+        tensors[name] = torch.frombuffer(mapped, dtype=dtype, count=count, offset=data_start + start).view(
+            info["shape"]
+        )
+    return tensors
+
+
+def checkpoint_dir(model_path):
+    """Local directory holding model_path's safetensors files, or None if they are not on disk"""
+    if os.path.isdir(model_path):
+        return model_path
+    try:
+        from huggingface_hub import snapshot_download
+        return snapshot_download(model_path, allow_patterns=["*.safetensors"], local_files_only=True)
+    except Exception as e:
+        logger.info("no local safetensors for %s (%s); weights stay private", model_path, e)
+        return None
+
+
+def assign_checkpoint_weights(model, directory):
+    """Point parameters and buffers at the memory-mapped tensors of the safetensors files in directory.
+
+    A CPU or meta tensor whose checkpoint counterpart has the same dtype and
+    shape becomes a view of the mapping and stays shared; a meta tensor stored
+    in another dtype is cast, which makes that one private. Returns the number
+    of bytes backed by the checkpoint.
+    """
+    from torch import nn
+
+    # Checkpoint names a newer transformers release maps onto its module layout
+    renames = [(re.compile(pattern), replacement)
+               for pattern, replacement in (getattr(model, "_checkpoint_conversion_mapping", None) or {}).items()]
+    current = dict(model.named_parameters(remove_duplicate=False))
+    current.update(model.named_buffers(remove_duplicate=False))
+
+    shared = 0
+    for path in sorted(glob.glob(os.path.join(directory, "*.safetensors"))):
+        for name, tensor in read_safetensors(path).items():
+            for pattern, replacement in renames:
+                name, replaced = pattern.subn(replacement, name)
+                if replaced:
+                    break
+            loaded = current.get(name)
+            if loaded is None or loaded.shape != tensor.shape:
+                continue
+            if loaded.device.type == "meta":
+                value = tensor if loaded.dtype == tensor.dtype else tensor.to(loaded.dtype)
+            elif loaded.device.type == "cpu" and loaded.dtype == tensor.dtype:
+                value = tensor
+            else:
+                continue
+            module_name, _, attribute = name.rpartition(".")
+            module = model.get_submodule(module_name)
+            if attribute in module._parameters:
+                module._parameters[attribute] = nn.Parameter(value, requires_grad=False)
+            elif attribute in module._buffers:
+                module._buffers[attribute] = value
+            else:
+                continue
+            if value is tensor:
+                shared += tensor.numel() * tensor.element_size()
+    if getattr(model.config, "tie_word_embeddings", False):
+        model.tie_weights()
+    gc.collect()
+    return shared
+
+
+def share_checkpoint_weights(model, model_path):
+    """Swap an already loaded model's CPU tensors for the checkpoint's memory-mapped ones where identical.
+
+    For loaders that build the model the usual way; the private copies are
+    freed, but each replica held a full copy while loading.
+    """
+    directory = checkpoint_dir(model_path)
+    return assign_checkpoint_weights(model, directory) if directory is not None else 0
+
+
+def load_registered(model_name, precision, share_weights=False):
+    """(model, processor, bytes of weights shared) for a model in registry.MODEL_SPECS, loaded the usual way"""
+    from registry import ModelRegistry, MODEL_SPECS
+
+    entry = ModelRegistry().get(model_name, precision)
+    shared = share_checkpoint_weights(entry.model, MODEL_SPECS[model_name].path) if share_weights else 0
+    return entry.model, entry.processor, shared
+
+
+def load_mapped(model_name, precision, share_weights=True):
+    """(model, processor, bytes of weights shared) for a registry model built on its memory-mapped checkpoint.
+
+    The model is created with empty (meta) parameters that are then assigned
+    from the safetensors files, so the shared weights are never copied into
+    the process. Falls back to load_registered() when sharing is off or the
+    checkpoint is not on disk.
+    """
+    from registry import MODEL_SPECS
+
+    spec = MODEL_SPECS[model_name]
+    directory = checkpoint_dir(spec.path) if share_weights else None
+    if directory is None:
+        return load_registered(model_name, precision)
+
+    import torch
+    import transformers
+    from accelerate import init_empty_weights
+    from prefix_cache import warm_prefix_cache
+    from prompts import SYSTEM_PROMPTS
+    from quantize import apply_precision, load_kwargs
+
+    config = transformers.AutoConfig.from_pretrained(spec.path)
+    dtype = load_kwargs(precision)["torch_dtype"]
+    if dtype == "auto":
+        dtype = getattr(config, "torch_dtype", None) or torch.float32
+    model_class = getattr(transformers, spec.model_class)
+    # Buffers such as rotary frequencies are computed, not stored; only the parameters start empty
+    with init_empty_weights(include_buffers=False):
+        if hasattr(model_class, "from_config"):
+            model = model_class.from_config(config, torch_dtype=dtype)
+        else:
+            model = model_class._from_config(config, torch_dtype=dtype)
+    shared = assign_checkpoint_weights(model, directory)
+    missing = [name for name, parameter in model.named_parameters() if parameter.device.type == "meta"]
+    if missing:
+        raise RuntimeError(f"{len(missing)} parameters of {model_name} are not in its checkpoint, e.g. {missing[0]}")
+    model.eval()
+    try:
+        model.generation_config = transformers.GenerationConfig.from_pretrained(spec.path)
+    except OSError:
+        pass
+
+    model = apply_precision(model, precision)
+    processor = getattr(transformers, spec.processor_class).from_pretrained(spec.path)
+    warm_prefix_cache(model, processor, SYSTEM_PROMPTS)
+    return model, processor, shared
+
+
+def _portable(error):
+    """error if it survives pickling to the parent, else a RuntimeError describing it"""
+    try:
+        pickle.dumps(error)
+        return error
+    except Exception:
+        return RuntimeError(f"{type(error).__name__}: {error}")
+
+
+@contextmanager
+def _thread_env(threads):
+    """OMP_NUM_THREADS and MKL_NUM_THREADS set to threads for the processes started inside"""
+    saved = {name: os.environ.get(name) for name in _THREAD_ENV}
+    os.environ.update(dict.fromkeys(_THREAD_ENV, str(threads)))
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def _worker_main(index, cores, model_name, precision, loader, share_weights, requests, results):
+    """Entry point of one worker process: pin, size the thread pools, load, serve"""
+    os.sched_setaffinity(0, cores)
+    import torch
+    import vlm
+
+    torch.set_num_threads(len(cores))
+    try:
+        # One request at a time per worker; inter-op parallelism would only oversubscribe the cores
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+
+    try:
+        start = time.perf_counter()
+        model, processor, shared_bytes = loader(model_name, precision, share_weights)
+        results.put(("ready", index, {
+            "pid": os.getpid(),
+            "cores": cores,
+            "threads": torch.get_num_threads(),
+            "load_s": time.perf_counter() - start,
+            "weights_shared_mb": shared_bytes / 1024 ** 2,
+            **memory_usage_mb(),
+        }))
+    except Exception as e:
+        logger.exception("worker %d failed to load %s", index, model_name)
+        results.put(("failed", index, _portable(e)))
+        return
+
+    while True:
+        request = requests.get()
+        if request is None:
+            return
+        request_id, kind, args, kwargs = request
+        try:
+            image, *rest = args
+            handler = getattr(vlm, _HANDLERS[kind])
+            # vlm.py's functions take the model and processor after their request arguments
+            value = handler(image, *rest, model, processor, **kwargs)
+            results.put(("done", request_id, value))
+        except Exception as e:
+            results.put(("error", request_id, _portable(e)))
+
+
+class _Worker:
+    def __init__(self, index, cores, process, requests):
+        self.index = index
+        self.cores = cores
+        self.process = process
+        self.requests = requests
+        self.outstanding = 0
+        self.completed = 0
+        self.info = {}
+
+
+class WorkerPool:
+    """N single-model worker processes on disjoint cores, with validate/analyze like InferenceScheduler.
+
+    dispatch is "queue_depth" (the worker with the fewest outstanding
+    requests) or "round_robin". Requests and answers are pickled, so they go
+    to the workers as PIL images and come back as text, verdicts or records.
+    loader(model_name, precision, share_weights) returns (model, processor,
+    bytes of weights shared) and must be importable by the workers;
+    share_weights=False keeps every replica's weights private.
+    """
+
+    def __init__(self, model_name, workers=2, threads_per_worker=None, precision="auto",
+                 dispatch="queue_depth", loader=load_mapped, share_weights=True, cores=None):
+        if dispatch not in DISPATCH_MODES:
+            raise ValueError(f"Unknown dispatch {dispatch!r}; expected one of {', '.join(DISPATCH_MODES)}")
+        self.model_name = model_name
+        self.precision = precision
+        self.dispatch = dispatch
+        self._lock = threading.Lock()
+        self._futures = {}
+        self._ids = itertools.count()
+        self._next = itertools.cycle(range(workers))
+        self._closed = False
+
+        # spawn, not fork: a forked child inherits torch's thread pool and cannot resize it
+        context = multiprocessing.get_context("spawn")
+        self._results = context.Queue()
+        self.workers = []
+        for index, worker_cores in enumerate(partition_cores(workers, threads_per_worker, cores)):
+            requests = context.Queue()
+            process = context.Process(
+                target=_worker_main,
+                args=(index, worker_cores, model_name, precision, loader, share_weights, requests, self._results),
+                name=f"vlm-worker-{index}",
+                daemon=True
+            )
+            with _thread_env(len(worker_cores)):
+                process.start()
+            self.workers.append(_Worker(index, worker_cores, process, requests))
+
+        self._wait_ready()
+        self._collector = threading.Thread(target=self._collect, name="worker-pool-results", daemon=True)
+        self._collector.start()
+
+    def _wait_ready(self):
+        pending = {worker.index for worker in self.workers}
+        while pending:
+            try:
+                status, index, payload = self._results.get(timeout=1)
+            except queue.Empty:
+                dead = [i for i in pending if not self.workers[i].process.is_alive()]
+                if dead:
+                    self._terminate()
+                    raise RuntimeError(f"worker {dead[0]} exited while loading {self.model_name}")
+                continue
+            if status == "failed":
+                self._terminate()
+                raise payload
+            self.workers[index].info = payload
+            pending.discard(index)
+            logger.info(
+                "worker %d on cores %s loaded %s in %.1fs (%.0f MB of weights shared)",
+                index, payload["cores"], self.model_name, payload["load_s"], payload["weights_shared_mb"]
+            )
+
+    def _pick(self):
+        alive = [worker for worker in self.workers if worker.process.is_alive()]
+        if not alive:
+            raise RuntimeError(f"every {self.model_name} worker has exited")
+        if self.dispatch == "round_robin":
+            for _ in self.workers:
+                worker = self.workers[next(self._next)]
+                if worker in alive:
+                    return worker
+        return min(alive, key=lambda worker: worker.outstanding)
+
+    def submit(self, kind, *args, **kwargs):
+        """Queue one request (a key of _HANDLERS) on a worker; the future resolves to its answer"""
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("worker pool is closed")
+            worker = self._pick()
+            request_id = next(self._ids)
+            self._futures[request_id] = (future, worker)
+            worker.outstanding += 1
+        worker.requests.put((request_id, kind, args, kwargs))
+        return future
+
+    def validate(self, image, image_id=None, timeout=None):
+        return self.submit("validate", image, image_id=image_id).result(timeout)
+
+    def analyze(self, image, system_prompt, analysis_type, user_question="", image_id=None, timeout=None, **kwargs):
+        return self.submit(
+            "analyze", image, system_prompt, analysis_type, user_question=user_question, image_id=image_id, **kwargs
+        ).result(timeout)
+
+    def analyze_structured(self, image, analysis_type, image_id=None, timeout=None, **kwargs):
+        return self.submit("structured", image, analysis_type, image_id=image_id, **kwargs).result(timeout)
+
+    def full_report(self, image, image_id=None, timeout=None):
+        return self.submit("full_report", image, image_id=image_id).result(timeout)
+
+    def _collect(self):
+        while True:
+            try:
+                message = self._results.get(timeout=1)
+            except queue.Empty:
+                self._fail_dead_workers()
+                continue
+            if message is None:
+                return
+            status, request_id, payload = message
+            with self._lock:
+                future, worker = self._futures.pop(request_id, (None, None))
+                if worker is not None:
+                    worker.outstanding -= 1
+                    worker.completed += 1
+            if future is None:
+                continue
+            if status == "done":
+                future.set_result(payload)
+            else:
+                future.set_exception(payload)
+
+    def _fail_dead_workers(self):
+        with self._lock:
+            lost = [
+                (request_id, future, worker) for request_id, (future, worker) in self._futures.items()
+                if not worker.process.is_alive()
+            ]
+            for request_id, _, worker in lost:
+                del self._futures[request_id]
+                worker.outstanding -= 1
+        for _, future, worker in lost:
+            future.set_exception(RuntimeError(
+                f"worker {worker.index} exited with code {worker.process.exitcode}"
+            ))
+
+    def stats(self):
+        """Per-worker cores, load details and request counts"""
+        with self._lock:
+            return {
+                "dispatch": self.dispatch,
+                "workers": [
+                    {
+                        **worker.info,
+                        "index": worker.index,
+                        "alive": worker.process.is_alive(),
+                        "outstanding": worker.outstanding,
+                        "completed": worker.completed,
+                    }
+                    for worker in self.workers
+                ],
+            }
+
+    def close(self):
+        """Stop the workers after the requests already queued"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        for worker in self.workers:
+            worker.requests.put(None)
+        for worker in self.workers:
+            worker.process.join()
+        self._results.put(None)
+        self._collector.join()
+
+    def _terminate(self):
+        for worker in self.workers:
+            if worker.process.is_alive():
+                worker.process.terminate()